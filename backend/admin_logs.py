@@ -0,0 +1,153 @@
+import base64
+import json
+import threading
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import text
+from db import advisory_lock
+
+# Admin listings over chat_logs (/admin/chat_logs, /admin/unknown_questions).
+#   - keyset pagination on (created_at, id): pass back next_cursor instead of a page
+#     number and the query seeks in the index instead of skipping OFFSET rows
+#   - page / limit (OFFSET) still works for old clients
+#   - estimate=true returns a planner estimate instead of an exact COUNT(*):
+#     pg_class.reltuples for the whole table, EXPLAIN row estimate for a filter
+
+MAX_PAGE_SIZE = 200
+
+# Rows without created_at (none are written by the app: DEFAULT CURRENT_TIMESTAMP) cannot
+# be placed on the (created_at, id) keyset, so listings and exact counts skip them
+LISTED = "created_at IS NOT NULL"
+
+# (name, definition); built CONCURRENTLY in the background so neither startup nor log
+# writes wait, one process at a time (advisory lock)
+CHAT_LOG_INDEX_LOCK = "chat_logs_index_build"
+CHAT_LOG_INDEXES = [
+    ("chat_logs_created_at_id_idx", "chat_logs (created_at DESC, id DESC)"),
+    # Unknown questions are a small slice of the table: partial index
+    ("chat_logs_unknown_created_at_idx", "chat_logs (created_at DESC, id DESC) WHERE status = 'unknown'"),
+    # Guest limit counts rows per username
+    ("chat_logs_username_idx", "chat_logs (username)"),
+]
+
+
+def build_chat_log_indexes() -> bool:
+    """
+    Returns False when another process is building them.
+    """
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block (lock conn is AUTOCOMMIT)
+    with advisory_lock(CHAT_LOG_INDEX_LOCK) as conn:
+        if conn is None:
+            print("Chat log indexes are being built by another process, skipping")
+            return False
+        for name, definition in CHAT_LOG_INDEXES:
+            # Holding the lock, an INVALID index can only be a leftover of an interrupted
+            # build (not one in progress); IF NOT EXISTS would keep it
+            invalid = conn.execute(text("""
+                SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = :name AND NOT i.indisvalid
+            """), {"name": name}).fetchone()
+            if invalid:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+    return True
+
+
+def start_chat_log_index_build():
+    def run():
+        try:
+            if build_chat_log_indexes():
+                print("✅ Chat log indexes ready")
+        except Exception as e:
+            print(f"⚠️ Chat log index build failed (admin listings fall back to sequential scans): {e}")
+
+    thread = threading.Thread(target=run, name="chat-log-index-build", daemon=True)
+    thread.start()
+    return thread
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Raises ValueError for a malformed cursor.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+async def fetch_log_page(conn, columns: str, where: Optional[str], page: int, limit: int,
+                         cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+    """
+    One page of chat_logs, newest first. Returns (rows, next_cursor): rows hold exactly
+    `columns`; next_cursor is None on the last page.
+    """
+    conditions = [LISTED] + ([where] if where else [])
+    params = {"limit": limit}
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        conditions.append("(created_at, id) < (:cursor_created_at, :cursor_id)")
+        params.update({"cursor_created_at": created_at, "cursor_id": row_id})
+        offset_sql = ""
+    else:
+        params["offset"] = (page - 1) * limit
+        offset_sql = " OFFSET :offset"
+    # The keyset columns are selected after `columns` and split off below
+    rows = (await conn.execute(
+        text(f"""
+            SELECT {columns}, id, created_at FROM chat_logs WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC, id DESC LIMIT :limit{offset_sql}
+        """),
+        params
+    )).fetchall()
+
+    next_cursor = None
+    if len(rows) == limit:
+        last_id, last_created_at = rows[-1][-2:]
+        next_cursor = encode_cursor(last_created_at, last_id)
+    return [row[:-2] for row in rows], next_cursor
+
+
+async def count_logs(conn, where: Optional[str], estimate: bool) -> Tuple[int, bool]:
+    """
+    Returns (total, estimated). Falls back to COUNT(*) when the table has never been analyzed.
+    """
+    where_sql = f" WHERE {where}" if where else ""
+    if estimate:
+        if where:
+            plan = (await conn.execute(text(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM chat_logs{where_sql}"))).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"]), True
+        reltuples = (await conn.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = 'chat_logs'::regclass")
+        )).scalar()
+        if reltuples is not None and reltuples >= 0:
+            return int(reltuples), True
+    listed = f" AND {where}" if where else ""
+    total = (await conn.execute(text(f"SELECT COUNT(*) FROM chat_logs WHERE {LISTED}{listed}"))).scalar()
+    return total, False
+
+
+def clamp_limit(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def page_response(total: int, estimated: bool, logs: List[dict], page: int, limit: int,
+                  next_cursor: Optional[str]) -> dict:
+    # total / logs / page / limit as before; next_cursor and total_estimated are additions
+    return {
+        "total": total,
+        "logs": logs,
+        "page": page,
+        "limit": limit,
+        "next_cursor": next_cursor,
+        "total_estimated": estimated,
+    }
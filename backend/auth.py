@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import Depends, HTTPException, status
@@ -6,7 +7,7 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 from sqlalchemy import text
-from db import engine
+from db import engine, get_async_engine
 
 # Configuration
 SECRET_KEY = "ops-agent-secret-key-change-me"  # In production, use environment variable
@@ -67,6 +68,34 @@ def authenticate_user(username: str, password: str):
         return False
     return user
 
+# Async versions for request handlers (asyncpg pool, no blocking on the event loop)
+async def aget_user(username: str):
+    async with get_async_engine().connect() as conn:
+        result = (await conn.execute(
+            text("SELECT username, role, hashed_password FROM users WHERE username = :username"),
+            {"username": username}
+        )).fetchone()
+
+    if result:
+        return UserInDB(
+            username=result[0],
+            role=result[1],
+            hashed_password=result[2]
+        )
+    return None
+
+async def aauthenticate_user(username: str, password: str):
+    user = await aget_user(username)
+    if not user:
+        return False
+    # bcrypt is deliberately slow (~100 ms): keep it off the event loop
+    if not await asyncio.to_thread(verify_password, password, user.hashed_password):
+        return False
+    return user
+
+async def aget_password_hash(password: str) -> str:
+    return await asyncio.to_thread(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -93,7 +122,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
-    user = get_user(token_data.username)
+    user = await aget_user(token_data.username)
     if user is None:
         raise credentials_exception
     return user
@@ -6,6 +6,13 @@ class Config:
         self.db = {}
         self.llm = {}
         self.server = {}
+        self.rag = {}
+        self.ingest = {}
+        self.jobs = {}
+        self.http = {}
+        self.log_writer = {}
+        self.question_journal = {}
+        self.hot_questions = {}
         self.load_config()
 
     def load_config(self):
@@ -16,6 +23,13 @@ class Config:
                 self.db = config_data.get("database", {})
                 self.llm = config_data.get("llm", {})
                 self.server = config_data.get("server", {})
+                self.rag = config_data.get("rag", {})
+                self.ingest = config_data.get("ingest", {})
+                self.jobs = config_data.get("jobs", {})
+                self.http = config_data.get("http", {})
+                self.log_writer = config_data.get("log_writer", {})
+                self.question_journal = config_data.get("question_journal", {})
+                self.hot_questions = config_data.get("hot_questions", {})
         else:
             print("Warning: config.yaml not found, using defaults/env vars")
 
@@ -1,6 +1,7 @@
 import os
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import URL
 from config_loader import config
@@ -22,3 +23,87 @@ DATABASE_URL = URL.create(
 
 engine = create_engine(DATABASE_URL, echo=True)
 SessionLocal = sessionmaker(bind=engine)
+
+
+@contextmanager
+def advisory_lock(name: str):
+    """
+    Cluster-wide try-lock for maintenance that must run in one process only (index builds).
+    Yields an AUTOCOMMIT connection holding pg_try_advisory_lock, or None when another
+    process holds it. The lock is released on exit (or when the connection dies).
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:name))"), {"name": name}).scalar():
+            yield None
+            return
+        try:
+            yield conn
+        finally:
+            try:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"), {"name": name})
+            except Exception as e:
+                print(f"Error releasing advisory lock {name}: {e}")
+
+# Async engine (asyncpg) for the request path: auth, retrieval, chat logs, admin listings.
+# Startup migrations, ingestion and workers keep using the sync engine above.
+ASYNC_DATABASE_URL = DATABASE_URL.set(drivername="postgresql+asyncpg")
+
+
+def get_pool_config() -> dict:
+    pool_config = db_config.get("pool", {}) or {}
+    return {
+        "size": int(pool_config.get("size", 10)),
+        "max_overflow": int(pool_config.get("max_overflow", 20)),
+        # Seconds to wait for a free pooled connection
+        "timeout": float(pool_config.get("timeout", 30)),
+        "recycle": int(pool_config.get("recycle", 1800)),
+        # Prepared statements cached per connection; 0 behind pgbouncer (transaction pooling)
+        "statement_cache_size": int(pool_config.get("statement_cache_size", 100)),
+        # Client-side timeout per statement (seconds)
+        "command_timeout": float(pool_config.get("command_timeout", 60)),
+        # Server-side statement_timeout (ms), 0 = no limit
+        "statement_timeout_ms": int(pool_config.get("statement_timeout_ms", 30000)),
+    }
+
+
+_async_engine = None
+
+
+def get_async_engine():
+    """
+    Created on first use, so scripts that only need the sync engine do not require asyncpg.
+    """
+    global _async_engine
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from pgvector.asyncpg import register_vector
+
+        cfg = get_pool_config()
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            pool_size=cfg["size"],
+            max_overflow=cfg["max_overflow"],
+            pool_timeout=cfg["timeout"],
+            pool_recycle=cfg["recycle"],
+            pool_pre_ping=True,
+            connect_args={
+                "statement_cache_size": cfg["statement_cache_size"],
+                "command_timeout": cfg["command_timeout"],
+                "server_settings": {"statement_timeout": str(cfg["statement_timeout_ms"])},
+            },
+        )
+
+        @event.listens_for(async_engine.sync_engine, "connect")
+        def _register_vector(dbapi_connection, connection_record):
+            # vector columns are decoded to numpy arrays, lists are accepted as parameters
+            dbapi_connection.run_async(register_vector)
+
+        _async_engine = async_engine
+    return _async_engine
+
+
+async def dispose_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
@@ -0,0 +1,52 @@
+import os
+import sys
+import signal
+import argparse
+import threading
+import multiprocessing
+
+# Add backend directory to sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from rag.jobs import ensure_jobs_table, worker_loop
+from rag.answer_cache import ensure_answer_cache_table
+from db import engine
+
+def run_worker(index: int):
+    """
+    One worker process: claims jobs from ingest_jobs until SIGINT/SIGTERM.
+    """
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        print(f"Worker {index}: received signal {signum}, finishing current job...")
+        stop_event.set()
+
+    # Never reuse pooled connections inherited from the parent: the socket would be shared
+    engine.dispose(close=False)
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    worker_loop(stop_event)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingestion worker for the ingest_jobs queue")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+
+    ensure_jobs_table()
+    # Ingestion bumps the per-KB generations / invalidates chunks of the answer cache
+    ensure_answer_cache_table()
+
+    if args.processes <= 1:
+        run_worker(0)
+    else:
+        # Close the parent's connections before forking (children open their own)
+        engine.dispose()
+        processes = []
+        for i in range(args.processes):
+            p = multiprocessing.Process(target=run_worker, args=(i,), name=f"ingest-worker-{i}")
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
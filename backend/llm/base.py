@@ -1,19 +1,90 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import AsyncIterator, Iterator, List, Optional
 
 class BaseLLM(ABC):
     @abstractmethod
-    def chat(self, messages: List[dict], temperature: float = 0.7) -> str:
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
         """
         Chat with the LLM.
         messages: list of dict, e.g. [{"role": "user", "content": "hello"}]
+        max_tokens: optional cap on the completion length (None = provider default)
         """
         pass
 
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        """
+        Stream the answer as text deltas. Providers override this with native streaming;
+        the default yields the full chat() result at once.
+        """
+        yield self.chat(messages, temperature=temperature, max_tokens=max_tokens)
+
+    async def achat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        """
+        Async chat. Providers with an HTTP API override this on the shared async pool;
+        the default runs chat() in a worker thread.
+        """
+        return await asyncio.to_thread(self.chat, messages, temperature, max_tokens)
+
+    async def astream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Async stream_chat. The default pulls stream_chat() chunks from a worker thread,
+        so SDK-based providers still stream without blocking the event loop.
+        """
+        iterator = self.stream_chat(messages, temperature=temperature, max_tokens=max_tokens)
+        while True:
+            chunk = await asyncio.to_thread(next, iterator, None)
+            if chunk is None:
+                break
+            yield chunk
+
 class BaseEmbedding(ABC):
+    # Request size limits used by embed_batch: default items per request, and a cap on
+    # characters per request (a cheap stand-in for the provider's token limit).
+    max_batch_size: int = 16
+    max_batch_chars: int = 32000
+
     @abstractmethod
     def embed_text(self, text: str) -> List[float]:
         """
         Get embedding for a single text string.
         """
         pass
+
+    async def aembed_text(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.embed_text, text)
+
+    def embed_batch(self, texts: List[str], batch_size: Optional[int] = None) -> List[List[float]]:
+        """
+        Get embeddings for many texts, one request per batch.
+        Results are returned in the same order as texts.
+        """
+        results = []
+        for batch in self.iter_batches(texts, batch_size):
+            vectors = self._embed_batch(batch)
+            if len(vectors) != len(batch):
+                raise ValueError(f"Embedding batch size mismatch: sent {len(batch)}, got {len(vectors)}")
+            results.extend(vectors)
+        return results
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed one batch. Providers override this with a native list request;
+        the default falls back to one request per text.
+        """
+        return [self.embed_text(t) for t in texts]
+
+    def iter_batches(self, texts: List[str], batch_size: Optional[int] = None) -> Iterator[List[str]]:
+        batch_size = max(1, batch_size or self.max_batch_size)
+        batch = []
+        batch_chars = 0
+        for t in texts:
+            # An oversized single text still goes out alone; the server decides whether to truncate
+            if batch and (len(batch) >= batch_size or batch_chars + len(t) > self.max_batch_chars):
+                yield batch
+                batch = []
+                batch_chars = 0
+            batch.append(t)
+            batch_chars += len(t)
+        if batch:
+            yield batch
@@ -1,9 +1,69 @@
-from llm.factory import get_embedding_client
+from llm.factory import get_embedding_client, get_provider_name
+from llm.embedding_cache import get_embedding_cache, make_cache_key
+from llm.embedding_pool import get_embedding_pool
+from config_loader import config
 
-def embed_text(text: str) -> list[float]:
+def embedding_model_id(client=None) -> str:
+    """
+    Identifies the vector space: vectors from different provider/model pairs are not comparable.
+    """
+    client = client or get_embedding_client()
+    return f"{get_provider_name()}:{getattr(client, 'model', '')}"
+
+def embed_text(text: str, use_cache: bool = True) -> list[float]:
     """
     调用统一 Embedding 接口，返回向量 list[float]
     支持 ZhipuAI 和 Ollama (通过 LLM_PROVIDER 环境变量切换)
+    use_cache: 查询向量走两级缓存 (内存 LRU + SQLite)，文档入库时应关闭
+    """
+    client = get_embedding_client()
+    cache = get_embedding_cache() if use_cache else None
+    if cache is None:
+        return client.embed_text(text)
+
+    key = make_cache_key(get_provider_name(), getattr(client, "model", ""), text)
+    vector = cache.get(key)
+    if vector is not None:
+        return vector
+
+    vector = client.embed_text(text)
+    if vector:
+        cache.put(key, vector)
+    return vector
+
+async def aembed_text(text: str, use_cache: bool = True) -> list[float]:
     """
+    embed_text 的异步版本 (请求路径使用，走共享 httpx 连接池)
+    """
+    client = get_embedding_client()
+    cache = get_embedding_cache() if use_cache else None
+    if cache is None:
+        return await client.aembed_text(text)
+
+    key = make_cache_key(get_provider_name(), getattr(client, "model", ""), text)
+    vector = await cache.aget(key)
+    if vector is not None:
+        return vector
+
+    vector = await client.aembed_text(text)
+    if vector:
+        await cache.aput(key, vector)
+    return vector
+
+def embed_batch(texts: list[str], batch_size: int = None, progress=None) -> list[list[float]]:
+    """
+    批量向量化 (文档入库)，按 batch_size / 字符数切分请求，结果顺序与输入一致
+    通过并发池发送 (限流 + 重试，见 config.yaml 的 ingest 段)，不经过查询缓存
+    progress: 可选回调 progress(已完成条数)
+    """
+    if not texts:
+        return []
     client = get_embedding_client()
-    return client.embed_text(text)
+    batch_size = batch_size or int(config.llm.get("embedding_batch_size", client.max_batch_size))
+    return get_embedding_pool().embed(
+        client, texts, provider=get_provider_name(), batch_size=batch_size, progress=progress
+    )
+
+def get_cache_stats() -> dict:
+    cache = get_embedding_cache()
+    return cache.stats() if cache else {"enabled": False}
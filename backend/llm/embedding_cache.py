@@ -0,0 +1,281 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+from config_loader import config
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Rough per-entry bookkeeping overhead (key string, tuple, OrderedDict node)
+_ENTRY_OVERHEAD_BYTES = 200
+# Rough per-row overhead in the SQLite file (key, created_at, b-tree and index entries)
+_ROW_OVERHEAD_BYTES = 150
+# Seconds between prunes of the SQLite tier (per process)
+PERSISTENT_PRUNE_INTERVAL = 600
+
+
+def normalize_text(text: str) -> str:
+    """
+    NFKC folds full-width forms to half-width ("ＤＢ　连接？" -> "DB 连接?"),
+    then whitespace runs are collapsed and trimmed.
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_cache_key(provider: str, model: str, text: str) -> str:
+    raw = f"{provider}\x00{model}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier query embedding cache:
+      1. in-process LRU bounded by entry count, bytes and TTL
+      2. local SQLite file shared by all workers on the host and surviving restarts,
+         pruned periodically by TTL and size (oldest rows first)
+    Vectors are stored as float32.
+    """
+
+    def __init__(self, max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 86400, sqlite_path: Optional[str] = None,
+                 persistent_ttl_seconds: float = 30 * 86400,
+                 persistent_max_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path
+        self.persistent_ttl_seconds = persistent_ttl_seconds
+        self.persistent_max_bytes = persistent_max_bytes
+        self._last_prune = 0.0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, array('f'), size)
+        self._bytes = 0
+        self._local = threading.local()
+
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        if self.sqlite_path:
+            try:
+                directory = os.path.dirname(self.sqlite_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._db().execute("""
+                    CREATE TABLE IF NOT EXISTS embeddings (
+                        key TEXT PRIMARY KEY,
+                        vector BLOB NOT NULL,
+                        created_at REAL NOT NULL
+                    )
+                """)
+                self._db().execute("CREATE INDEX IF NOT EXISTS embeddings_created_at_idx ON embeddings (created_at)")
+            except Exception as e:
+                print(f"Warning: persistent embedding cache disabled ({self.sqlite_path}): {e}")
+                self.sqlite_path = None
+
+    # --- persistent tier -------------------------------------------------
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+            # WAL lets several uvicorn workers read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _persistent_get(self, key: str) -> Optional[array]:
+        if not self.sqlite_path:
+            return None
+        try:
+            row = self._db().execute(
+                "SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        except Exception as e:
+            print(f"Error reading embedding cache: {e}")
+            return None
+        if not row:
+            return None
+        if self.persistent_ttl_seconds and time.time() - row[1] > self.persistent_ttl_seconds:
+            return None
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector
+
+    def _persistent_put(self, key: str, vector: array):
+        if not self.sqlite_path:
+            return
+        try:
+            self._db().execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, vector.tobytes(), time.time())
+            )
+        except Exception as e:
+            print(f"Error writing embedding cache: {e}")
+            return
+        if time.monotonic() - self._last_prune > PERSISTENT_PRUNE_INTERVAL:
+            self._last_prune = time.monotonic()
+            self.prune_persistent(len(vector.tobytes()) + _ROW_OVERHEAD_BYTES)
+
+    def prune_persistent(self, row_bytes: int) -> int:
+        """
+        Drop rows older than the persistent TTL, then the oldest rows beyond
+        persistent_max_bytes (row count estimated from row_bytes). Freed pages are
+        reused by later inserts; the file itself does not shrink. Returns rows deleted.
+        """
+        if not self.sqlite_path:
+            return 0
+        deleted = 0
+        try:
+            db = self._db()
+            if self.persistent_ttl_seconds:
+                deleted += db.execute(
+                    "DELETE FROM embeddings WHERE created_at < ?",
+                    (time.time() - self.persistent_ttl_seconds,)
+                ).rowcount
+            if self.persistent_max_bytes:
+                max_rows = max(self.persistent_max_bytes // row_bytes, 1)
+                excess = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - max_rows
+                if excess > 0:
+                    deleted += db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created_at LIMIT ?)",
+                        (excess,)
+                    ).rowcount
+        except Exception as e:
+            print(f"Error pruning embedding cache: {e}")
+        return deleted
+
+    # --- memory tier -----------------------------------------------------
+
+    def _memory_put(self, key: str, vector: array):
+        size = len(vector) * vector.itemsize + _ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, vector, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _memory_get(self, key: str) -> Optional[array]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, vector, size = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    # --- public API ------------------------------------------------------
+
+    def get(self, key: str) -> Optional[List[float]]:
+        vector = self._memory_get(key)
+        if vector is not None:
+            self.memory_hits += 1
+            return vector.tolist()
+
+        vector = self._persistent_get(key)
+        if vector is not None:
+            self.persistent_hits += 1
+            self._memory_put(key, vector)
+            return vector.tolist()
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, embedding: List[float]):
+        vector = array("f", embedding)
+        self._memory_put(key, vector)
+        self._persistent_put(key, vector)
+
+    # Event-loop versions: the memory tier is checked inline, SQLite reads, writes and
+    # prunes (busy-waits on a locked file) run in a worker thread
+
+    async def aget(self, key: str) -> Optional[List[float]]:
+        vector = self._memory_get(key)
+        if vector is not None:
+            self.memory_hits += 1
+            return vector.tolist()
+
+        if self.sqlite_path:
+            vector = await asyncio.to_thread(self._persistent_get, key)
+            if vector is not None:
+                self.persistent_hits += 1
+                self._memory_put(key, vector)
+                return vector.tolist()
+
+        self.misses += 1
+        return None
+
+    async def aput(self, key: str, embedding: List[float]):
+        vector = array("f", embedding)
+        self._memory_put(key, vector)
+        if self.sqlite_path:
+            await asyncio.to_thread(self._persistent_put, key, vector)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.persistent_hits + self.misses
+        hits = self.memory_hits + self.persistent_hits
+        return {
+            "memory_hits": self.memory_hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "persistent": bool(self.sqlite_path),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    Process-wide cache built from llm.embedding_cache in config.yaml.
+    Returns None when the cache is disabled.
+    """
+    global _cache
+    cache_config = config.llm.get("embedding_cache", {}) or {}
+    if not cache_config.get("enabled", True):
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                sqlite_path = None
+                if cache_config.get("persistent", True):
+                    sqlite_path = cache_config.get("path") or os.getenv("EMBEDDING_CACHE_PATH", "state/embedding_cache.sqlite3")
+                _cache = EmbeddingCache(
+                    max_entries=int(cache_config.get("max_entries", 2048)),
+                    max_bytes=int(float(cache_config.get("max_mb", 64)) * 1024 * 1024),
+                    ttl_seconds=float(cache_config.get("ttl_seconds", 86400)),
+                    sqlite_path=sqlite_path,
+                    persistent_ttl_seconds=float(cache_config.get("persistent_ttl_days", 30)) * 86400,
+                    persistent_max_bytes=int(float(cache_config.get("persistent_max_mb", 512)) * 1024 * 1024),
+                )
+    return _cache
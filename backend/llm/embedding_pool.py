@@ -0,0 +1,167 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, List, Optional
+from .base import BaseEmbedding
+from config_loader import config
+
+# Bounded-concurrency embedding executor for ingestion:
+#   - at most max_in_flight requests per process (shared thread pool)
+#   - token-bucket rate limit per provider, shared by every caller in the process
+#   - exponential backoff with jitter on transient errors (timeouts, 429, 5xx)
+#   - backpressure: a caller never has more than 2 * max_in_flight batches queued
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_seconds = (tokens - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+def get_ingest_config() -> dict:
+    ingest_config = config.ingest or {}
+    return {
+        "max_in_flight": max(1, int(ingest_config.get("max_in_flight", 4))),
+        "rate_limit": float(ingest_config.get("rate_limit", 0) or 0),
+        "burst": ingest_config.get("burst"),
+        "rate_limits": ingest_config.get("rate_limits", {}) or {},
+        "max_retries": int(ingest_config.get("max_retries", 4)),
+        "backoff_base": float(ingest_config.get("backoff_base", 0.5)),
+        "backoff_max": float(ingest_config.get("backoff_max", 30)),
+    }
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str) -> Optional[TokenBucket]:
+    """
+    One bucket per provider (requests/second); None means unlimited.
+    ingest.rate_limits.<provider> overrides ingest.rate_limit.
+    """
+    cfg = get_ingest_config()
+    rate = float(cfg["rate_limits"].get(provider, cfg["rate_limit"]) or 0)
+    if rate <= 0:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(provider)
+        if bucket is None:
+            bucket = TokenBucket(rate, cfg["burst"])
+            _buckets[provider] = bucket
+        return bucket
+
+
+def is_retryable(error: Exception) -> bool:
+    # Client errors (bad request, auth) will not succeed on retry; 429 will
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+        return False
+    return True
+
+
+class EmbeddingPool:
+    def __init__(self, max_in_flight: int = 4, max_retries: int = 4,
+                 backoff_base: float = 0.5, backoff_max: float = 30):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embed")
+
+    def _embed_with_retry(self, client: BaseEmbedding, batch: List[str], limiter: Optional[TokenBucket]):
+        attempt = 0
+        while True:
+            if limiter:
+                limiter.acquire()
+            try:
+                vectors = client.embed_batch(batch, batch_size=len(batch))
+                # Some clients report failures as empty vectors instead of raising
+                if any(not v for v in vectors):
+                    raise ValueError("Embedding service returned an empty vector")
+                return vectors
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not is_retryable(e):
+                    raise
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Embedding batch failed ({e}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed(self, client: BaseEmbedding, texts: Iterable[str], provider: str = "",
+              batch_size: Optional[int] = None,
+              progress: Optional[Callable[[int], None]] = None) -> List[List[float]]:
+        """
+        Embed texts concurrently; results keep input order.
+        progress(n) is called with the number of texts finished so far.
+        """
+        limiter = get_rate_limiter(provider)
+        results = {}
+        pending = {}
+        done_count = 0
+        max_pending = self.max_in_flight * 2
+
+        def collect(block_until_below: int):
+            nonlocal done_count
+            while len(pending) > block_until_below:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, size = pending.pop(future)
+                    results[index] = future.result()
+                    done_count += size
+                    if progress:
+                        progress(done_count)
+
+        try:
+            for index, batch in enumerate(client.iter_batches(texts, batch_size)):
+                # Backpressure: wait for a slot before queueing more work
+                collect(max_pending - 1)
+                future = self._executor.submit(self._embed_with_retry, client, batch, limiter)
+                pending[future] = (index, len(batch))
+            collect(0)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+
+        vectors = []
+        for index in range(len(results)):
+            vectors.extend(results[index])
+        return vectors
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_embedding_pool() -> EmbeddingPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                cfg = get_ingest_config()
+                _pool = EmbeddingPool(
+                    max_in_flight=cfg["max_in_flight"],
+                    max_retries=cfg["max_retries"],
+                    backoff_base=cfg["backoff_base"],
+                    backoff_max=cfg["backoff_max"],
+                )
+    return _pool
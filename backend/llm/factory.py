@@ -1,35 +1,121 @@
 import os
+import json
 from .base import BaseLLM, BaseEmbedding
 from .zhipu_client import ZhipuLLM, ZhipuEmbedding
 from .ollama_client import OllamaLLM, OllamaEmbedding
 from .mock_client import MockLLM, MockEmbedding
-from .openai_client import OpenAILLM, OpenAIEmbedding
+from .openai_client import OpenAILLM, OpenAIEmbedding, clear_endpoint_cache
+from .failover import FailoverLLM, FailoverEmbedding, FailoverGroup, Backend, get_breaker, get_failover_config
+from .registry import registry
 from config_loader import config
 
-def get_llm_client(model: str = None) -> BaseLLM:
+OPENAI_COMPATIBLE = ["openai", "deepseek", "deepseek-v3", "local", "vllm"]
+
+def get_provider_name() -> str:
     provider = config.llm.get("provider") or os.getenv("LLM_PROVIDER", "zhipu")
-    provider = provider.lower()
-    
+    return provider.lower()
+
+def _base_url(kind: str, provider: str) -> str:
+    # Part of the registry key, so a config change yields a new client
+    llm_config = config.llm
+    if provider == "ollama":
+        return os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    if provider == "mock":
+        return ""
+    if provider in OPENAI_COMPATIBLE:
+        specific = llm_config.get("chat_base_url") if kind == "llm" else llm_config.get("embedding_base_url")
+        return specific or llm_config.get("base_url") or os.getenv("OPENAI_BASE_URL") or ""
+    return llm_config.get("base_url") or os.getenv("ZHIPUAI_BASE_URL") or ""
+
+def create_llm_client(provider: str, model: str = None, base_url: str = None, api_key: str = None) -> BaseLLM:
+    # base_url / api_key override the llm section (failover backends)
     if provider == "ollama":
-        return OllamaLLM(model=model or os.getenv("LLM_MODEL", "qwen:7b"))
+        return OllamaLLM(base_url=base_url, model=model or os.getenv("LLM_MODEL", "qwen:7b"))
     elif provider == "mock":
         return MockLLM(model=model or "mock-gpt")
-    elif provider in ["openai", "deepseek", "deepseek-v3", "local", "vllm"]:
-        return OpenAILLM(model=model)
+    elif provider in OPENAI_COMPATIBLE:
+        return OpenAILLM(api_key=api_key, model=model, base_url=base_url)
     else:
         # Pass None to let the client class handle defaults/config
-        return ZhipuLLM(model=model)
+        return ZhipuLLM(api_key=api_key, model=model, base_url=base_url)
 
-def get_embedding_client() -> BaseEmbedding:
-    provider = config.llm.get("provider") or os.getenv("LLM_PROVIDER", "zhipu")
-    provider = provider.lower()
-    
+def create_embedding_client(provider: str, model: str = None, base_url: str = None, api_key: str = None) -> BaseEmbedding:
     if provider == "ollama":
-        return OllamaEmbedding(model=os.getenv("EMBEDDING_MODEL", "nomic-embed-text"))
+        return OllamaEmbedding(base_url=base_url, model=model or os.getenv("EMBEDDING_MODEL", "nomic-embed-text"))
     elif provider == "mock":
-        return MockEmbedding(model="mock-embedding")
-    elif provider in ["openai", "deepseek", "deepseek-v3", "local", "vllm"]:
-        return OpenAIEmbedding(model=None)
+        return MockEmbedding(model=model or "mock-embedding")
+    elif provider in OPENAI_COMPATIBLE:
+        return OpenAIEmbedding(api_key=api_key, model=model, base_url=base_url)
     else:
         # Pass None to let the client class handle defaults/config
-        return ZhipuEmbedding(model=None)
+        return ZhipuEmbedding(api_key=api_key, model=model, base_url=base_url)
+
+def create_failover_client(kind: str, specs: list):
+    """
+    kind: "llm" or "embedding"; specs: llm.failover.chat_backends / embedding_backends,
+    in priority order. Fields left out of an entry come from the llm section.
+    """
+    failover_config = get_failover_config()
+    create = create_llm_client if kind == "llm" else create_embedding_client
+    backends = []
+    for i, spec in enumerate(specs):
+        provider = (spec.get("provider") or get_provider_name()).lower()
+        name = spec.get("name") or f"{provider}-{i}"
+        client = create(provider, model=spec.get("model"), base_url=spec.get("base_url"), api_key=spec.get("api_key"))
+        timeout = float(spec.get("timeout", failover_config["timeout"]))
+        backends.append(Backend(name, provider, client, get_breaker(kind, name, failover_config["breaker"]), timeout))
+    group = FailoverGroup(kind, backends, failover_config["hedge"])
+    return FailoverLLM(group) if kind == "llm" else FailoverEmbedding(group)
+
+def get_llm_client(model: str = None) -> BaseLLM:
+    specs = get_failover_config()["chat_backends"]
+    if specs and not model:
+        # Explicit model (vision questions) stays on the configured provider
+        key = ("llm", "failover", "", json.dumps(specs, sort_keys=True))
+        return registry.get_or_create(key, lambda: create_failover_client("llm", specs))
+    provider = get_provider_name()
+    key = ("llm", provider, model or "", _base_url("llm", provider))
+    return registry.get_or_create(key, lambda: create_llm_client(provider, model))
+
+def get_embedding_client() -> BaseEmbedding:
+    specs = get_failover_config()["embedding_backends"]
+    if specs:
+        key = ("embedding", "failover", "", json.dumps(specs, sort_keys=True))
+        return registry.get_or_create(key, lambda: create_failover_client("embedding", specs))
+    provider = get_provider_name()
+    key = ("embedding", provider, "", _base_url("embedding", provider))
+    return registry.get_or_create(key, lambda: create_embedding_client(provider))
+
+def get_backend_status() -> dict:
+    """
+    Health of the chat / embedding backends: circuit breaker state, failure rate and latency.
+    """
+    status = {}
+    for kind, client in (("chat", get_llm_client()), ("embedding", get_embedding_client())):
+        group = getattr(client, "group", None)
+        if group is not None:
+            status[kind] = group.status()
+        else:
+            status[kind] = {"failover": False, "provider": get_provider_name(), "model": getattr(client, "model", "")}
+    return status
+
+def warm_up_clients():
+    """
+    Build the default chat and embedding clients at startup, so the first question
+    does not pay for SDK/config initialization or endpoint discovery.
+    """
+    for client in (get_llm_client(), get_embedding_client()):
+        resolve = getattr(client, "resolve_endpoint", None)
+        if resolve:
+            try:
+                resolve()
+            except Exception as e:
+                print(f"⚠️ Endpoint discovery failed for {type(client).__name__} (retried on first use): {e}")
+
+def invalidate_clients(provider: str = None) -> int:
+    # base_url may have changed: resolved endpoints are rediscovered on next use
+    clear_endpoint_cache()
+    return registry.invalidate(provider)
+
+def close_clients():
+    registry.invalidate()
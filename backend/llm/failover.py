@@ -0,0 +1,592 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+from .base import BaseLLM, BaseEmbedding
+from config_loader import config
+
+# Ordered provider failover (llm.failover in config.yaml), e.g. DeepSeek-V3 first, local Ollama second.
+#   - every backend has a circuit breaker fed by the error rate and latency of its recent calls
+#   - a backend whose breaker is open is skipped at once instead of waiting for its timeout
+#   - per-backend timeout: a hung call is abandoned and the next backend is tried
+#   - optional hedging (non-streamed calls): if the current backend has not answered after
+#     its p95 latency, the next one is started as well and the first good answer wins
+# Provider clients report most failures as "Error..." strings instead of raising;
+# both count as failures here.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Prefixes of the error strings returned by our chat clients (and rag/qa.py)
+ERROR_PREFIXES = ("Error: ", "Error calling ", "调用 LLM 失败")
+
+
+def get_failover_config() -> dict:
+    failover_config = (config.llm or {}).get("failover", {}) or {}
+    breaker_config = failover_config.get("breaker", {}) or {}
+    hedge_config = failover_config.get("hedge", {}) or {}
+    return {
+        "chat_backends": list(failover_config.get("chat_backends") or []),
+        "embedding_backends": list(failover_config.get("embedding_backends") or []),
+        # Default per-backend timeout (seconds); a backend entry may set its own
+        "timeout": float(failover_config.get("timeout", 60)),
+        "breaker": {
+            "window": int(breaker_config.get("window", 20)),
+            "min_calls": int(breaker_config.get("min_calls", 5)),
+            "failure_rate": float(breaker_config.get("failure_rate", 0.5)),
+            "slow_call_seconds": float(breaker_config.get("slow_call_seconds", 30)),
+            "open_seconds": float(breaker_config.get("open_seconds", 30)),
+        },
+        "hedge": {
+            "enabled": bool(hedge_config.get("enabled", False)),
+            "quantile": float(hedge_config.get("quantile", 0.95)),
+            "min_samples": int(hedge_config.get("min_samples", 20)),
+            "min_delay": float(hedge_config.get("min_delay", 0.5)),
+            # Used until min_samples latencies have been observed
+            "default_delay": float(hedge_config.get("default_delay", 5)),
+        },
+    }
+
+
+def is_error_answer(answer) -> bool:
+    return not isinstance(answer, str) or answer.startswith(ERROR_PREFIXES)
+
+
+def is_empty_embedding(vector) -> bool:
+    return not vector
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Sliding window over the last `window` calls. Opens when at least min_calls are in the
+    window and the share of failed or slow calls reaches failure_rate. After open_seconds a
+    single trial call is let through (half-open): success closes the breaker, failure re-opens it.
+    """
+    # Successful latencies kept for the hedging delay
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, name: str, **cfg):
+        self.name = name
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=int(cfg.get("window", 20)))
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._trial_running = False
+        self.calls = 0
+        self.failures = 0
+        self.last_error = None
+        self.configure(**cfg)
+
+    def configure(self, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                  slow_call_seconds: float = 30, open_seconds: float = 30):
+        with self._lock:
+            if self._outcomes.maxlen != window:
+                self._outcomes = deque(self._outcomes, maxlen=window)
+            self.min_calls = min_calls
+            self.failure_rate = failure_rate
+            self.slow_call_seconds = slow_call_seconds
+            self.open_seconds = open_seconds
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._trial_running = False
+        print(f"⚠️ Circuit breaker for {self.name} opened (last error: {self.last_error})")
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._trial_running = False
+            # Half-open: one trial call at a time
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def release(self):
+        # A granted call was abandoned without an outcome (hedge loser cancelled)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+
+    def record(self, ok: bool, latency: Optional[float] = None, error: Optional[str] = None):
+        """
+        latency None: outcome only (streams, where total duration says nothing about health).
+        """
+        with self._lock:
+            self.calls += 1
+            bad = not ok or (latency is not None and latency > self.slow_call_seconds)
+            if not ok:
+                self.failures += 1
+                self.last_error = error
+            elif latency is not None:
+                self._latencies.append(latency)
+
+            if self.state == HALF_OPEN:
+                if bad:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._trial_running = False
+                    self._outcomes.clear()
+                    print(f"✅ Circuit breaker for {self.name} closed")
+                return
+
+            self._outcomes.append(bad)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate):
+                self._open()
+
+    def hedge_delay(self, quantile: float, min_samples: int, min_delay: float, default_delay: float) -> float:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < min_samples:
+            return default_delay
+        return max(min_delay, samples[min(len(samples) - 1, int(len(samples) * quantile))])
+
+    def status(self) -> dict:
+        with self._lock:
+            outcomes = list(self._outcomes)
+            samples = sorted(self._latencies)
+            state = self.state
+            retry_in = max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)) if state == OPEN else 0.0
+            return {
+                "state": state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "window_failure_rate": round(sum(outcomes) / len(outcomes), 3) if outcomes else 0.0,
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 1) if samples else None,
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1) if samples else None,
+                "retry_in_seconds": round(retry_in, 1),
+                "last_error": self.last_error,
+            }
+
+
+# Breakers outlive client rebuilds (/admin/reload_config), keyed by (kind, backend name)
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(kind: str, name: str, cfg: dict) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get((kind, name))
+        if breaker is None:
+            breaker = CircuitBreaker(f"{kind}:{name}", **cfg)
+            _breakers[(kind, name)] = breaker
+        else:
+            breaker.configure(**cfg)
+    return breaker
+
+
+class Backend:
+    def __init__(self, name: str, provider: str, client, breaker: CircuitBreaker, timeout: float):
+        self.name = name
+        self.provider = provider
+        self.client = client
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "provider": self.provider,
+            "model": getattr(self.client, "model", ""),
+            "timeout": self.timeout,
+            **self.breaker.status(),
+        }
+
+
+class _Attempt:
+    """
+    One call to one backend. The outcome is recorded exactly once: by the call itself,
+    or by the caller when it gives up on the call (timeout).
+    """
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.start = time.monotonic()
+        self.deadline = self.start + backend.timeout
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _close(self) -> bool:
+        with self._lock:
+            if self._closed:
+                return False
+            self._closed = True
+            return True
+
+    def finish(self, ok: bool, error: Optional[str] = None, timed: bool = True):
+        if self._close():
+            latency = time.monotonic() - self.start if timed else None
+            if ok and latency is not None and latency > self.backend.timeout:
+                # Hedge loser that answered after its timeout: a timeout for the breaker
+                ok, error = False, "timeout"
+            self.backend.breaker.record(ok, latency, error)
+
+    def cancel(self):
+        if self._close():
+            self.backend.breaker.release()
+
+
+# Sync calls run here so a hung backend can be abandoned after its timeout
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-failover")
+
+
+def _describe(result) -> str:
+    return str(result)[:200]
+
+
+class FailoverGroup:
+    def __init__(self, kind: str, backends: List[Backend], hedge: dict):
+        self.kind = kind
+        self.backends = backends
+        self.hedge = hedge
+
+    def _next_backend(self, start: int):
+        # Checked at launch time, so a half-open trial slot is only taken when the call happens
+        for index in range(start, len(self.backends)):
+            if self.backends[index].breaker.allow_request():
+                return index, self.backends[index]
+        return len(self.backends), None
+
+    def _hedge_at(self, attempt: _Attempt, hedge: bool) -> Optional[float]:
+        if not (hedge and self.hedge["enabled"]):
+            return None
+        delay = attempt.backend.breaker.hedge_delay(
+            self.hedge["quantile"], self.hedge["min_samples"], self.hedge["min_delay"], self.hedge["default_delay"]
+        )
+        return attempt.start + delay
+
+    def _unavailable(self, errors: List[str]) -> BackendUnavailableError:
+        names = ", ".join(backend.name for backend in self.backends)
+        detail = "; ".join(errors) or "all circuit breakers open"
+        return BackendUnavailableError(f"All {self.kind} backends failed ({names}): {detail}")
+
+    @staticmethod
+    def _run(attempt: _Attempt, fn: Callable, failed: Callable):
+        try:
+            result = fn(attempt.backend.client)
+        except Exception as e:
+            attempt.finish(False, _describe(e))
+            return False, _describe(e)
+        if failed(result):
+            attempt.finish(False, _describe(result))
+            return False, _describe(result)
+        attempt.finish(True)
+        return True, result
+
+    def call(self, fn: Callable, failed: Callable, hedge: bool = True):
+        """
+        fn(client) -> result. Returns the first result for which failed(result) is false.
+        Raises BackendUnavailableError when every backend failed, timed out or is open.
+        """
+        errors = []
+        pending = {}
+        next_index = 0
+        hedge_at = None
+
+        def launch() -> bool:
+            nonlocal next_index, hedge_at
+            next_index, backend = self._next_backend(next_index)
+            if backend is None:
+                return False
+            next_index += 1
+            attempt = _Attempt(backend)
+            pending[_executor.submit(self._run, attempt, fn, failed)] = attempt
+            hedge_at = self._hedge_at(attempt, hedge)
+            return True
+
+        launch()
+        while pending:
+            wake = min(attempt.deadline for attempt in pending.values())
+            if hedge_at is not None:
+                wake = min(wake, hedge_at)
+            done, _ = wait(list(pending), timeout=max(0.0, wake - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = pending.pop(future)
+                ok, result = future.result()
+                if ok:
+                    # A hedged call still running records its own outcome when it ends
+                    return result
+                errors.append(f"{attempt.backend.name}: {result}")
+
+            now = time.monotonic()
+            for future, attempt in list(pending.items()):
+                if now >= attempt.deadline:
+                    pending.pop(future)
+                    attempt.finish(False, "timeout")
+                    errors.append(f"{attempt.backend.name}: timeout after {attempt.backend.timeout:g}s")
+
+            if not pending:
+                launch()
+            elif hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if launch():
+                    print(f"Hedging {self.kind} request to {self.backends[next_index - 1].name}")
+        raise self._unavailable(errors)
+
+    @staticmethod
+    async def _arun(attempt: _Attempt, fn: Callable, failed: Callable):
+        try:
+            result = await fn(attempt.backend.client)
+        except Exception as e:
+            attempt.finish(False, _describe(e))
+            return False, _describe(e)
+        if failed(result):
+            attempt.finish(False, _describe(result))
+            return False, _describe(result)
+        attempt.finish(True)
+        return True, result
+
+    async def acall(self, fn: Callable, failed: Callable, hedge: bool = True):
+        """
+        Async call(): fn(client) returns an awaitable. Losing or timed-out calls are cancelled.
+        """
+        errors = []
+        pending = {}
+        next_index = 0
+        hedge_at = None
+
+        def launch() -> bool:
+            nonlocal next_index, hedge_at
+            next_index, backend = self._next_backend(next_index)
+            if backend is None:
+                return False
+            next_index += 1
+            attempt = _Attempt(backend)
+            pending[asyncio.create_task(self._arun(attempt, fn, failed))] = attempt
+            hedge_at = self._hedge_at(attempt, hedge)
+            return True
+
+        launch()
+        try:
+            while pending:
+                wake = min(attempt.deadline for attempt in pending.values())
+                if hedge_at is not None:
+                    wake = min(wake, hedge_at)
+                done, _ = await asyncio.wait(list(pending), timeout=max(0.0, wake - time.monotonic()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = pending.pop(task)
+                    ok, result = task.result()
+                    if ok:
+                        return result
+                    errors.append(f"{attempt.backend.name}: {result}")
+
+                now = time.monotonic()
+                for task, attempt in list(pending.items()):
+                    if now >= attempt.deadline:
+                        pending.pop(task)
+                        task.cancel()
+                        attempt.finish(False, "timeout")
+                        errors.append(f"{attempt.backend.name}: timeout after {attempt.backend.timeout:g}s")
+
+                if not pending:
+                    launch()
+                elif hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if launch():
+                        print(f"Hedging {self.kind} request to {self.backends[next_index - 1].name}")
+            raise self._unavailable(errors)
+        finally:
+            # Winner found or caller cancelled: stop the other in-flight calls
+            for task, attempt in pending.items():
+                task.cancel()
+                attempt.cancel()
+
+    def stream(self, fn: Callable, failed: Callable) -> Iterator:
+        """
+        fn(client) -> iterator. Fails over until a backend produces a good first chunk;
+        after that the stream is committed to that backend.
+        """
+        errors = []
+        index = 0
+        while True:
+            index, backend = self._next_backend(index)
+            if backend is None:
+                break
+            index += 1
+            attempt = _Attempt(backend)
+            try:
+                iterator = fn(backend.client)
+                first = _executor.submit(next, iterator, None).result(timeout=backend.timeout)
+            except FutureTimeoutError:
+                attempt.finish(False, "timeout")
+                errors.append(f"{backend.name}: no output after {backend.timeout:g}s")
+                continue
+            except Exception as e:
+                attempt.finish(False, _describe(e))
+                errors.append(f"{backend.name}: {_describe(e)}")
+                continue
+            if first is not None and failed(first):
+                attempt.finish(False, _describe(first))
+                errors.append(f"{backend.name}: {_describe(first)}")
+                continue
+
+            attempt.finish(True, timed=False)
+            if first is not None:
+                yield first
+                yield from iterator
+            return
+        raise self._unavailable(errors)
+
+    async def astream(self, fn: Callable, failed: Callable) -> AsyncIterator:
+        errors = []
+        index = 0
+        while True:
+            index, backend = self._next_backend(index)
+            if backend is None:
+                break
+            index += 1
+            attempt = _Attempt(backend)
+            stream = fn(backend.client)
+            try:
+                try:
+                    first = await asyncio.wait_for(stream.__anext__(), timeout=backend.timeout)
+                except StopAsyncIteration:
+                    first = None
+                except asyncio.TimeoutError:
+                    attempt.finish(False, "timeout")
+                    errors.append(f"{backend.name}: no output after {backend.timeout:g}s")
+                    continue
+                except Exception as e:
+                    attempt.finish(False, _describe(e))
+                    errors.append(f"{backend.name}: {_describe(e)}")
+                    continue
+                if first is not None and failed(first):
+                    attempt.finish(False, _describe(first))
+                    errors.append(f"{backend.name}: {_describe(first)}")
+                    continue
+
+                attempt.finish(True, timed=False)
+                if first is not None:
+                    yield first
+                    async for chunk in stream:
+                        yield chunk
+                return
+            finally:
+                # Abandoned, failed or closed by the consumer: release the httpx stream now, not at GC
+                await _aclose(stream)
+        raise self._unavailable(errors)
+
+    def status(self) -> dict:
+        return {
+            "failover": True,
+            "hedge": self.hedge["enabled"],
+            "backends": [backend.status() for backend in self.backends],
+        }
+
+
+async def _aclose(stream):
+    try:
+        await stream.aclose()
+    except Exception as e:
+        print(f"Error closing abandoned stream: {e}")
+
+
+class FailoverLLM(BaseLLM):
+    """
+    Chat client over an ordered list of backends. Keeps the BaseLLM contract:
+    when every backend fails the error comes back as an "Error: ..." answer.
+    """
+    def __init__(self, group: FailoverGroup):
+        self.group = group
+        self.backends = group.backends
+        self.model = getattr(group.backends[0].client, "model", "")
+
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        try:
+            return self.group.call(lambda client: client.chat(messages, temperature, max_tokens), is_error_answer)
+        except BackendUnavailableError as e:
+            print(e)
+            return f"Error: {e}"
+
+    async def achat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        try:
+            return await self.group.acall(lambda client: client.achat(messages, temperature, max_tokens), is_error_answer)
+        except BackendUnavailableError as e:
+            print(e)
+            return f"Error: {e}"
+
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        try:
+            yield from self.group.stream(
+                lambda client: client.stream_chat(messages, temperature=temperature, max_tokens=max_tokens),
+                is_error_answer
+            )
+        except BackendUnavailableError as e:
+            print(e)
+            yield f"Error: {e}"
+
+    async def astream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        try:
+            async for chunk in self.group.astream(
+                lambda client: client.astream_chat(messages, temperature=temperature, max_tokens=max_tokens),
+                is_error_answer
+            ):
+                yield chunk
+        except BackendUnavailableError as e:
+            print(e)
+            yield f"Error: {e}"
+
+    def resolve_endpoint(self):
+        # Startup warm-up: discover every backend's endpoint, not just the primary's
+        for backend in self.backends:
+            resolve = getattr(backend.client, "resolve_endpoint", None)
+            if resolve:
+                try:
+                    resolve()
+                except Exception as e:
+                    print(f"⚠️ Endpoint discovery failed for backend {backend.name}: {e}")
+
+
+class FailoverEmbedding(BaseEmbedding):
+    """
+    Embedding client over an ordered list of backends. All backends must serve the same
+    embedding model (e.g. bge-m3 on two hosts): vectors from different models are not comparable.
+    Raises BackendUnavailableError when every backend fails.
+    """
+    def __init__(self, group: FailoverGroup):
+        self.group = group
+        self.backends = group.backends
+        primary = group.backends[0].client
+        self.model = getattr(primary, "model", "")
+        self.max_batch_size = primary.max_batch_size
+        self.max_batch_chars = primary.max_batch_chars
+
+    def embed_text(self, text: str) -> List[float]:
+        return self.group.call(lambda client: client.embed_text(text), is_empty_embedding)
+
+    async def aembed_text(self, text: str) -> List[float]:
+        return await self.group.acall(lambda client: client.aembed_text(text), is_empty_embedding)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # Ingestion is throughput-bound: fail over, but never duplicate a batch by hedging
+        return self.group.call(
+            lambda client: client._embed_batch(texts),
+            lambda vectors: not vectors or len(vectors) != len(texts),
+            hedge=False
+        )
+
+    def resolve_endpoint(self):
+        for backend in self.backends:
+            resolve = getattr(backend.client, "resolve_endpoint", None)
+            if resolve:
+                try:
+                    resolve()
+                except Exception as e:
+                    print(f"⚠️ Endpoint discovery failed for backend {backend.name}: {e}")
@@ -0,0 +1,77 @@
+import threading
+from typing import Optional
+import httpx
+from config_loader import config
+
+# Shared, connection-pooled HTTP clients for the LLM / embedding providers.
+# One sync client (worker threads, ingestion pool) and one async client (request path)
+# per process, so keep-alive connections and TLS sessions are reused across calls.
+
+
+def get_http_config() -> dict:
+    http_config = config.http or {}
+    return {
+        "max_connections": int(http_config.get("max_connections", 200)),
+        "max_keepalive_connections": int(http_config.get("max_keepalive_connections", 50)),
+        "keepalive_expiry": float(http_config.get("keepalive_expiry", 30)),
+        "connect_timeout": float(http_config.get("connect_timeout", 10)),
+        # Long enough for a full non-streamed completion
+        "read_timeout": float(http_config.get("read_timeout", 120)),
+        "write_timeout": float(http_config.get("write_timeout", 30)),
+        "pool_timeout": float(http_config.get("pool_timeout", 30)),
+    }
+
+
+def build_limits(cfg: dict) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=cfg["max_connections"],
+        max_keepalive_connections=cfg["max_keepalive_connections"],
+        keepalive_expiry=cfg["keepalive_expiry"],
+    )
+
+
+def build_timeout(cfg: dict, read: Optional[float] = None) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=cfg["connect_timeout"],
+        read=read if read is not None else cfg["read_timeout"],
+        write=cfg["write_timeout"],
+        pool=cfg["pool_timeout"],
+    )
+
+
+_client = None
+_async_client = None
+_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                cfg = get_http_config()
+                _client = httpx.Client(limits=build_limits(cfg), timeout=build_timeout(cfg))
+    return _client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    # Created lazily inside the running event loop (uvicorn has a single loop per worker)
+    global _async_client
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                cfg = get_http_config()
+                _async_client = httpx.AsyncClient(limits=build_limits(cfg), timeout=build_timeout(cfg))
+    return _async_client
+
+
+async def close_http_clients():
+    global _client, _async_client
+    with _lock:
+        client, async_client = _client, _async_client
+        _client = None
+        _async_client = None
+    if async_client is not None:
+        await async_client.aclose()
+    if client is not None:
+        client.close()
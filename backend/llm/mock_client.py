@@ -1,13 +1,17 @@
-from typing import List
+from typing import Iterator, List, Optional
 from .base import BaseLLM, BaseEmbedding
 
 class MockLLM(BaseLLM):
     def __init__(self, model: str = "mock-model"):
         self.model = model
 
-    def chat(self, messages: List[dict], temperature: float = 0.7) -> str:
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
         return f"This is a mock response from {self.model}. Your last message was: {messages[-1]['content']}"
 
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        for word in self.chat(messages, temperature, max_tokens).split(" "):
+            yield word + " "
+
 class MockEmbedding(BaseEmbedding):
     def __init__(self, model: str = "mock-embedding"):
         self.model = model
@@ -15,3 +19,6 @@ class MockEmbedding(BaseEmbedding):
     def embed_text(self, text: str) -> List[float]:
         # Return a fixed 1024-dim vector for testing
         return [0.1] * 1024
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return [[0.1] * 1024 for _ in texts]
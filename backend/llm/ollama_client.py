@@ -1,31 +1,85 @@
 import os
-import requests
-from typing import List
+import json
+from typing import AsyncIterator, Iterator, List, Optional
 from .base import BaseLLM, BaseEmbedding
+from .http import get_http_client, get_async_http_client
 
 class OllamaLLM(BaseLLM):
     def __init__(self, base_url: str = None, model: str = "qwen:7b"):
         self.base_url = base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
         self.model = model
 
-    def chat(self, messages: List[dict], temperature: float = 0.7) -> str:
-        # Ollama API: POST /api/chat
-        url = f"{self.base_url}/api/chat"
-        payload = {
+    def _payload(self, messages: List[dict], temperature: float, stream: bool,
+                 max_tokens: Optional[int] = None) -> dict:
+        options = {
+            "temperature": temperature
+        }
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        return {
             "model": self.model,
             "messages": messages,
-            "stream": False,
-            "options": {
-                "temperature": temperature
-            }
+            "stream": stream,
+            "options": options
         }
+
+    @staticmethod
+    def _parse_stream_line(line: str):
+        # Ollama streams NDJSON: one {"message": {"content": ...}, "done": false} object per line
+        data = json.loads(line)
+        return data.get("message", {}).get("content", ""), bool(data.get("done"))
+
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        # Ollama API: POST /api/chat
+        url = f"{self.base_url}/api/chat"
         try:
-            resp = requests.post(url, json=payload)
+            resp = get_http_client().post(url, json=self._payload(messages, temperature, stream=False, max_tokens=max_tokens))
             resp.raise_for_status()
             return resp.json().get("message", {}).get("content", "")
         except Exception as e:
             return f"Error calling Ollama: {str(e)}"
 
+    async def achat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        url = f"{self.base_url}/api/chat"
+        try:
+            resp = await get_async_http_client().post(url, json=self._payload(messages, temperature, stream=False, max_tokens=max_tokens))
+            resp.raise_for_status()
+            return resp.json().get("message", {}).get("content", "")
+        except Exception as e:
+            return f"Error calling Ollama: {str(e)}"
+
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        url = f"{self.base_url}/api/chat"
+        try:
+            with get_http_client().stream("POST", url, json=self._payload(messages, temperature, stream=True, max_tokens=max_tokens)) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    if not line:
+                        continue
+                    content, done = self._parse_stream_line(line)
+                    if content:
+                        yield content
+                    if done:
+                        break
+        except Exception as e:
+            yield f"Error calling Ollama: {str(e)}"
+
+    async def astream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        url = f"{self.base_url}/api/chat"
+        try:
+            async with get_async_http_client().stream("POST", url, json=self._payload(messages, temperature, stream=True, max_tokens=max_tokens)) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    content, done = self._parse_stream_line(line)
+                    if content:
+                        yield content
+                    if done:
+                        break
+        except Exception as e:
+            yield f"Error calling Ollama: {str(e)}"
+
 class OllamaEmbedding(BaseEmbedding):
     def __init__(self, base_url: str = None, model: str = "nomic-embed-text"):
         self.base_url = base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
@@ -39,9 +93,41 @@ class OllamaEmbedding(BaseEmbedding):
             "prompt": text
         }
         try:
-            resp = requests.post(url, json=payload)
+            resp = get_http_client().post(url, json=payload)
             resp.raise_for_status()
             return resp.json().get("embedding", [])
         except Exception as e:
             print(f"Error calling Ollama embedding: {e}")
             return []
+
+    async def aembed_text(self, text: str) -> List[float]:
+        url = f"{self.base_url}/api/embeddings"
+        payload = {
+            "model": self.model,
+            "prompt": text
+        }
+        try:
+            resp = await get_async_http_client().post(url, json=payload)
+            resp.raise_for_status()
+            return resp.json().get("embedding", [])
+        except Exception as e:
+            print(f"Error calling Ollama embedding: {e}")
+            return []
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # Ollama >= 0.3: POST /api/embed accepts a list input
+        url = f"{self.base_url}/api/embed"
+        payload = {
+            "model": self.model,
+            "input": texts
+        }
+        try:
+            resp = get_http_client().post(url, json=payload)
+            if resp.status_code == 404:
+                # Older Ollama without /api/embed: one request per text
+                return [self.embed_text(t) for t in texts]
+            resp.raise_for_status()
+            return resp.json().get("embeddings", [])
+        except Exception as e:
+            print(f"Error calling Ollama batch embedding: {e}")
+            raise e
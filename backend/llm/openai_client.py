@@ -1,16 +1,69 @@
 import os
-import requests
 import json
-from typing import List, Dict, Any, Union
+import asyncio
+import threading
+from typing import AsyncIterator, Iterator, List, Dict, Any, Optional, Union
 from .base import BaseLLM, BaseEmbedding
+from .http import get_http_client, get_async_http_client
 from config_loader import config
 
+# Resolved endpoint per (kind, base_url). Self-hosted OpenAI-compatible servers differ in
+# whether they mount under /v1 and whether they use /chat/completions or /chat, so the
+# candidates are probed once and the winner is reused until it answers 404.
+_endpoints: Dict[tuple, str] = {}
+_endpoints_lock = threading.Lock()
+
+# Route exists but rejects the empty probe body (400/401/422) vs. route does not exist
+_MISSING_STATUS = (404, 405)
+
+
+def probe_endpoint(url: str, headers: dict) -> bool:
+    # An empty JSON body is cheap: no tokens are generated or embedded
+    response = get_http_client().post(url, headers=headers, json={})
+    return response.status_code not in _MISSING_STATUS
+
+
+def cached_endpoint(kind: str, base_url: str) -> Optional[str]:
+    return _endpoints.get((kind, base_url))
+
+
+def discover_endpoint(kind: str, base_url: str, candidates: List[str], headers: dict) -> Optional[str]:
+    """
+    Returns the first candidate URL that exists, or None if all are missing.
+    Connection errors propagate (wrong host is not fixed by another path).
+    """
+    key = (kind, base_url)
+    url = _endpoints.get(key)
+    if url:
+        return url
+    with _endpoints_lock:
+        url = _endpoints.get(key)
+        if url:
+            return url
+        for candidate in candidates:
+            if probe_endpoint(candidate, headers):
+                print(f"Resolved OpenAI-compatible {kind} endpoint: {candidate}")
+                _endpoints[key] = candidate
+                return candidate
+            print(f"DEBUG: 404 Not Found at {candidate}")
+    return None
+
+
+def forget_endpoint(kind: str, base_url: str):
+    with _endpoints_lock:
+        _endpoints.pop((kind, base_url), None)
+
+
+def clear_endpoint_cache():
+    with _endpoints_lock:
+        _endpoints.clear()
+
 class OpenAILLM(BaseLLM):
-    def __init__(self, api_key: str = None, model: str = None):
+    def __init__(self, api_key: str = None, model: str = None, base_url: str = None):
         llm_config = config.llm
         self.api_key = api_key or llm_config.get("api_key") or "dummy"
-        # Prioritize chat_base_url, then base_url
-        self.base_url = llm_config.get("chat_base_url") or llm_config.get("base_url") or os.getenv("OPENAI_BASE_URL") or "http://localhost:8000/v1"
+        # Prioritize explicit base_url (failover backends), then chat_base_url, then base_url
+        self.base_url = base_url or llm_config.get("chat_base_url") or llm_config.get("base_url") or os.getenv("OPENAI_BASE_URL") or "http://localhost:8000/v1"
         self.model = model or llm_config.get("model") or "gpt-3.5-turbo"
 
         # Fix base_url
@@ -22,9 +75,9 @@ class OpenAILLM(BaseLLM):
         if self.base_url.endswith("/"):
             self.base_url = self.base_url[:-1]
         
-        print(f"Initializing OpenAI LLM (Requests) with base_url={self.base_url}, model={self.model}")
+        print(f"Initializing OpenAI LLM (httpx) with base_url={self.base_url}, model={self.model}")
 
-    def chat(self, messages: List[dict], temperature: float = 0.7) -> str:
+    def _candidate_urls(self) -> List[str]:
         # Define candidate URLs
         candidate_urls = [f"{self.base_url}/chat/completions"]
         
@@ -40,58 +93,196 @@ class OpenAILLM(BaseLLM):
         if self.base_url.endswith("/v1"):
              base_no_v1 = self.base_url[:-3]
              candidate_urls.append(f"{base_no_v1}/chat")
+        return candidate_urls
 
+    def _headers(self, stream: bool = False) -> dict:
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
+
+    def _payload(self, messages: List[dict], temperature: float, stream: bool = False,
+                 max_tokens: Optional[int] = None) -> dict:
         payload = {
             "model": self.model,
             "messages": messages,
             "temperature": temperature
         }
-        
-        last_error = None
-        
-        for url in candidate_urls:
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    @staticmethod
+    def _parse_stream_line(line: str):
+        """
+        OpenAI-compatible SSE: "data: {json}" lines, terminated by "data: [DONE]".
+        Returns the text delta, "" for lines without content, None at [DONE].
+        """
+        if not line or not line.startswith("data:"):
+            return ""
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return None
+        chunk = json.loads(data)
+        choices = chunk.get("choices") or []
+        if choices:
+            return (choices[0].get("delta") or {}).get("content") or ""
+        return ""
+
+    def resolve_endpoint(self) -> Optional[str]:
+        return discover_endpoint("chat", self.base_url, self._candidate_urls(), self._headers())
+
+    async def aresolve_endpoint(self) -> Optional[str]:
+        return cached_endpoint("chat", self.base_url) or await asyncio.to_thread(self.resolve_endpoint)
+
+    def _not_found_error(self) -> str:
+        return f"Error: Could not find valid chat endpoint. Tried: {self._candidate_urls()}"
+
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        client = get_http_client()
+        payload = self._payload(messages, temperature, max_tokens=max_tokens)
+
+        # Second pass only after a 404 from a previously resolved endpoint
+        for _ in range(2):
+            try:
+                url = self.resolve_endpoint()
+                if url is None:
+                    return self._not_found_error()
+                response = client.post(url, headers=self._headers(), json=payload)
+            except Exception as e:
+                # Connection error usually means host is wrong or down, not path is wrong.
+                print(f"Connection error calling {self.base_url}: {e}")
+                return f"Error: Connection error: {e}"
+
+            if response.status_code == 404:
+                print(f"DEBUG: 404 Not Found at {url}, rediscovering endpoint")
+                forget_endpoint("chat", self.base_url)
+                continue
+
+            try:
+                response.raise_for_status()
+                return response.json()["choices"][0]["message"]["content"]
+            except Exception as e:
+                error_msg = f"Error calling OpenAI Chat API ({url}): {e} Response: {response.text}"
+                print(error_msg)
+                return f"Error: {error_msg}"
+
+        return self._not_found_error()
+
+    async def achat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
+        client = get_async_http_client()
+        payload = self._payload(messages, temperature, max_tokens=max_tokens)
+
+        for _ in range(2):
+            try:
+                url = await self.aresolve_endpoint()
+                if url is None:
+                    return self._not_found_error()
+                response = await client.post(url, headers=self._headers(), json=payload)
+            except Exception as e:
+                print(f"Connection error calling {self.base_url}: {e}")
+                return f"Error: Connection error: {e}"
+
+            if response.status_code == 404:
+                print(f"DEBUG: 404 Not Found at {url}, rediscovering endpoint")
+                forget_endpoint("chat", self.base_url)
+                continue
+
             try:
-                print(f"DEBUG: Trying Chat URL: {url}")
-                response = requests.post(url, headers=headers, json=payload, timeout=60)
-                
-                if response.status_code == 404:
-                    print(f"DEBUG: 404 Not Found at {url}")
-                    last_error = f"404 Not Found at {url}"
-                    continue # Try next URL
-                
                 response.raise_for_status()
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
-                
+                return response.json()["choices"][0]["message"]["content"]
             except Exception as e:
-                # If exception is raised by raise_for_status() other than 404 (e.g. 500, 400), we stop.
-                # If it's a connection error, we might want to fail too unless we want to try other URLs for connection issues?
-                # Assume 404 is the main reason to switch URLs.
-                last_error = str(e)
-                if 'response' in locals() and response.status_code != 404:
-                     error_msg = f"Error calling OpenAI Chat API ({url}): {last_error} Response: {response.text}"
-                     print(error_msg)
-                     return f"Error: {error_msg}"
-                elif not 'response' in locals():
-                     # Connection error
-                     print(f"Connection error calling {url}: {last_error}")
-                     # Maybe try next URL if it's a connection error? 
-                     # No, connection error usually means host is wrong or down, not path is wrong.
-                     return f"Error: Connection error: {last_error}"
-
-        # If we exhausted all URLs
-        return f"Error: Could not find valid chat endpoint. Tried: {candidate_urls}. Last error: {last_error}"
+                error_msg = f"Error calling OpenAI Chat API ({url}): {e} Response: {response.text}"
+                print(error_msg)
+                return f"Error: {error_msg}"
+
+        return self._not_found_error()
+
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        client = get_http_client()
+        payload = self._payload(messages, temperature, stream=True, max_tokens=max_tokens)
+
+        for _ in range(2):
+            try:
+                url = self.resolve_endpoint()
+                if url is None:
+                    yield self._not_found_error()
+                    return
+                with client.stream("POST", url, headers=self._headers(stream=True), json=payload) as response:
+                    if response.status_code == 404:
+                        print(f"DEBUG: 404 Not Found at {url}, rediscovering endpoint")
+                        forget_endpoint("chat", self.base_url)
+                        continue
+                    if response.status_code >= 400:
+                        response.read()
+                        error_msg = f"Error calling OpenAI Chat API ({url}): {response.status_code} Response: {response.text}"
+                        print(error_msg)
+                        yield f"Error: {error_msg}"
+                        return
+
+                    for line in response.iter_lines():
+                        content = self._parse_stream_line(line)
+                        if content is None:
+                            return
+                        if content:
+                            yield content
+                    return
+            except Exception as e:
+                error_msg = f"Error streaming from OpenAI Chat API ({self.base_url}): {str(e)}"
+                print(error_msg)
+                yield f"Error: {error_msg}"
+                return
+
+        yield self._not_found_error()
+
+    async def astream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        client = get_async_http_client()
+        payload = self._payload(messages, temperature, stream=True, max_tokens=max_tokens)
+
+        for _ in range(2):
+            try:
+                url = await self.aresolve_endpoint()
+                if url is None:
+                    yield self._not_found_error()
+                    return
+                async with client.stream("POST", url, headers=self._headers(stream=True), json=payload) as response:
+                    if response.status_code == 404:
+                        print(f"DEBUG: 404 Not Found at {url}, rediscovering endpoint")
+                        forget_endpoint("chat", self.base_url)
+                        continue
+                    if response.status_code >= 400:
+                        await response.aread()
+                        error_msg = f"Error calling OpenAI Chat API ({url}): {response.status_code} Response: {response.text}"
+                        print(error_msg)
+                        yield f"Error: {error_msg}"
+                        return
+
+                    async for line in response.aiter_lines():
+                        content = self._parse_stream_line(line)
+                        if content is None:
+                            return
+                        if content:
+                            yield content
+                    return
+            except Exception as e:
+                error_msg = f"Error streaming from OpenAI Chat API ({self.base_url}): {str(e)}"
+                print(error_msg)
+                yield f"Error: {error_msg}"
+                return
+
+        yield self._not_found_error()
 
 class OpenAIEmbedding(BaseEmbedding):
-    def __init__(self, api_key: str = None, model: str = None):
+    def __init__(self, api_key: str = None, model: str = None, base_url: str = None):
         llm_config = config.llm
         self.api_key = api_key or llm_config.get("api_key") or "dummy"
-        # Prioritize embedding_base_url, then base_url
-        self.base_url = llm_config.get("embedding_base_url") or llm_config.get("base_url") or os.getenv("OPENAI_BASE_URL") or "http://localhost:8000/v1"
+        # Prioritize explicit base_url (failover backends), then embedding_base_url, then base_url
+        self.base_url = base_url or llm_config.get("embedding_base_url") or llm_config.get("base_url") or os.getenv("OPENAI_BASE_URL") or "http://localhost:8000/v1"
         # Note: config.llm.get("model") might be the chat model, check embedding_model first
         self.model = model or llm_config.get("embedding_model") or llm_config.get("model") or "text-embedding-ada-002"
 
@@ -104,61 +295,149 @@ class OpenAIEmbedding(BaseEmbedding):
         if self.base_url.endswith("/"):
             self.base_url = self.base_url[:-1]
 
-        print(f"Initializing OpenAI Embedding (Requests) with base_url={self.base_url}, model={self.model}")
+        print(f"Initializing OpenAI Embedding (httpx) with base_url={self.base_url}, model={self.model}")
 
-    def embed_text(self, text: str) -> List[float]:
-        url = f"{self.base_url}/embeddings"
-        headers = {
+    def _headers(self) -> dict:
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+
+    @staticmethod
+    def _extract_embedding(data: dict) -> List[float]:
+        # Robust extraction logic to handle various response formats
+        if "data" in data:
+            items = data["data"]
+            
+            # Case 1: Standard OpenAI List
+            if isinstance(items, list):
+                if len(items) > 0:
+                    return items[0]["embedding"]
+            
+            # Case 2: Dictionary mimicking list or direct object
+            elif isinstance(items, dict):
+                # Try integer index 0
+                if 0 in items:
+                    return items[0]["embedding"]
+                # Try string index "0"
+                if "0" in items:
+                    return items["0"]["embedding"]
+                # Try direct embedding field (if data is the item itself)
+                if "embedding" in items:
+                    return items["embedding"]
+                # Try first value if it's a dict of items
+                if items:
+                    first_val = list(items.values())[0]
+                    if isinstance(first_val, dict) and "embedding" in first_val:
+                        return first_val["embedding"]
+        
+        # Debugging info if we fail
+        debug_info = {
+            "keys": list(data.keys()),
+            "data_type": str(type(data.get("data"))),
+            "data_sample": str(data.get("data"))[:200]
+        }
+        raise ValueError(f"Unexpected response format. Debug: {debug_info}")
+
+    def _candidate_urls(self) -> List[str]:
+        candidate_urls = [f"{self.base_url}/embeddings"]
+        if self.base_url.endswith("/v1"):
+            candidate_urls.append(f"{self.base_url[:-3]}/embeddings")
+        else:
+            candidate_urls.append(f"{self.base_url}/v1/embeddings")
+        return candidate_urls
+
+    def resolve_endpoint(self) -> str:
+        url = discover_endpoint("embedding", self.base_url, self._candidate_urls(), self._headers())
+        if url is None:
+            raise ValueError(f"Could not find valid embedding endpoint. Tried: {self._candidate_urls()}")
+        return url
+
+    def _post(self, payload: dict):
+        client = get_http_client()
+        url = self.resolve_endpoint()
+        response = client.post(url, headers=self._headers(), json=payload)
+        if response.status_code == 404:
+            # Resolved endpoint disappeared (server reconfigured): rediscover once
+            forget_endpoint("embedding", self.base_url)
+            url = self.resolve_endpoint()
+            response = client.post(url, headers=self._headers(), json=payload)
+        return url, response
+
+    async def _apost(self, payload: dict):
+        client = get_async_http_client()
+        url = cached_endpoint("embedding", self.base_url) or await asyncio.to_thread(self.resolve_endpoint)
+        response = await client.post(url, headers=self._headers(), json=payload)
+        if response.status_code == 404:
+            forget_endpoint("embedding", self.base_url)
+            url = await asyncio.to_thread(self.resolve_endpoint)
+            response = await client.post(url, headers=self._headers(), json=payload)
+        return url, response
+
+    def embed_text(self, text: str) -> List[float]:
+        url = self.base_url
         payload = {
             "model": self.model,
             "input": text
         }
         
+        response = None
         try:
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            url, response = self._post(payload)
             response.raise_for_status()
-            data = response.json()
-            
-            # Robust extraction logic to handle various response formats
-            if "data" in data:
-                items = data["data"]
-                
-                # Case 1: Standard OpenAI List
-                if isinstance(items, list):
-                    if len(items) > 0:
-                        return items[0]["embedding"]
-                
-                # Case 2: Dictionary mimicking list or direct object
-                elif isinstance(items, dict):
-                    # Try integer index 0
-                    if 0 in items:
-                        return items[0]["embedding"]
-                    # Try string index "0"
-                    if "0" in items:
-                        return items["0"]["embedding"]
-                    # Try direct embedding field (if data is the item itself)
-                    if "embedding" in items:
-                        return items["embedding"]
-                    # Try first value if it's a dict of items
-                    if items:
-                        first_val = list(items.values())[0]
-                        if isinstance(first_val, dict) and "embedding" in first_val:
-                            return first_val["embedding"]
-            
-            # Debugging info if we fail
-            debug_info = {
-                "keys": list(data.keys()),
-                "data_type": str(type(data.get("data"))),
-                "data_sample": str(data.get("data"))[:200]
-            }
-            raise ValueError(f"Unexpected response format. Debug: {debug_info}")
+            return self._extract_embedding(response.json())
+        except Exception as e:
+            error_msg = f"Error calling OpenAI Embedding API ({url}): {str(e)}"
+            if response is not None:
+                error_msg += f" Response: {response.text}"
+            print(error_msg)
+            raise e
+
+    async def aembed_text(self, text: str) -> List[float]:
+        url = self.base_url
+        payload = {
+            "model": self.model,
+            "input": text
+        }
 
+        response = None
+        try:
+            url, response = await self._apost(payload)
+            response.raise_for_status()
+            return self._extract_embedding(response.json())
         except Exception as e:
             error_msg = f"Error calling OpenAI Embedding API ({url}): {str(e)}"
-            if 'response' in locals():
+            if response is not None:
+                error_msg += f" Response: {response.text}"
+            print(error_msg)
+            raise e
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        url = self.base_url
+        payload = {
+            "model": self.model,
+            "input": texts
+        }
+
+        response = None
+        try:
+            url, response = self._post(payload)
+            response.raise_for_status()
+            data = response.json()
+
+            items = data.get("data")
+            if isinstance(items, list) and len(items) == len(texts):
+                # OpenAI does not guarantee order; each item carries its "index"
+                if all(isinstance(item, dict) and "index" in item for item in items):
+                    items = sorted(items, key=lambda item: item["index"])
+                return [item["embedding"] for item in items]
+        except Exception as e:
+            error_msg = f"Error calling OpenAI Embedding API ({url}) with {len(texts)} inputs: {str(e)}"
+            if response is not None:
                 error_msg += f" Response: {response.text}"
             print(error_msg)
             raise e
+
+        # Server answered but not in list form (some self-hosted servers): one request per text
+        print(f"Warning: batch embedding response not understood at {url}, falling back to single requests")
+        return [self.embed_text(t) for t in texts]
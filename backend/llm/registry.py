@@ -0,0 +1,59 @@
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+# Process-wide cache of provider clients, keyed by (kind, provider, model, base_url).
+# Building a client is not free (ZhipuAI SDK instances carry their own HTTP client,
+# OpenAI clients re-parse config), so each distinct configuration is built once and shared.
+# Clients must therefore be stateless / thread-safe, which all of ours are.
+
+ClientKey = Tuple[str, str, str, str]
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._clients: Dict[ClientKey, object] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key: ClientKey, builder: Callable[[], object]):
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = builder()
+                self._clients[key] = client
+        return client
+
+    def invalidate(self, provider: Optional[str] = None) -> int:
+        """
+        Drop cached clients (all, or one provider's) and close them.
+        The next get_*_client() call rebuilds from the current config.
+        """
+        with self._lock:
+            keys = [key for key in self._clients if provider is None or key[1] == provider]
+            removed = [self._clients.pop(key) for key in keys]
+        for client in removed:
+            close_client(client)
+        return len(removed)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._clients)
+
+
+def close_client(client):
+    # Failover clients wrap one provider client per backend
+    for backend in getattr(client, "backends", None) or []:
+        close_client(backend.client)
+    # ZhipuAI SDK clients own an HTTP connection pool; requests-free clients have nothing to close
+    inner = getattr(client, "client", None)
+    close = getattr(inner, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception as e:
+            print(f"Error closing {type(client).__name__}: {e}")
+
+
+registry = ClientRegistry()
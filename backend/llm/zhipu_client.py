@@ -1,14 +1,14 @@
 import os
-from typing import List
+from typing import Iterator, List, Optional
 from zhipuai import ZhipuAI
 from .base import BaseLLM, BaseEmbedding
 from config_loader import config
 
 class ZhipuLLM(BaseLLM):
-    def __init__(self, api_key: str = None, model: str = None):
+    def __init__(self, api_key: str = None, model: str = None, base_url: str = None):
         llm_config = config.llm
         self.api_key = api_key or llm_config.get("api_key") or os.getenv("ZHIPUAI_API_KEY") or "dummy"
-        self.base_url = llm_config.get("base_url") or os.getenv("ZHIPUAI_BASE_URL")
+        self.base_url = base_url or llm_config.get("base_url") or os.getenv("ZHIPUAI_BASE_URL")
         
         # If using internal LLM, api_key might be optional or dummy, but SDK might require it.
         
@@ -19,22 +19,43 @@ class ZhipuLLM(BaseLLM):
             
         self.model = model or llm_config.get("model") or "glm-4"
 
-    def chat(self, messages: List[dict], temperature: float = 0.7) -> str:
+    @staticmethod
+    def _limits(max_tokens: Optional[int]) -> dict:
+        # Only send max_tokens when set, so the model default applies otherwise
+        return {"max_tokens": max_tokens} if max_tokens else {}
+
+    def chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> str:
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
-                temperature=temperature
+                temperature=temperature,
+                **self._limits(max_tokens)
             )
             return response.choices[0].message.content
         except Exception as e:
             return f"Error calling ZhipuAI: {str(e)}"
 
+    def stream_chat(self, messages: List[dict], temperature: float = 0.7, max_tokens: Optional[int] = None) -> Iterator[str]:
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                **self._limits(max_tokens)
+            )
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            yield f"Error calling ZhipuAI: {str(e)}"
+
 class ZhipuEmbedding(BaseEmbedding):
-    def __init__(self, api_key: str = None, model: str = None):
+    def __init__(self, api_key: str = None, model: str = None, base_url: str = None):
         llm_config = config.llm
         self.api_key = api_key or llm_config.get("api_key") or os.getenv("ZHIPUAI_API_KEY") or "dummy"
-        self.base_url = llm_config.get("base_url") or os.getenv("ZHIPUAI_BASE_URL")
+        self.base_url = base_url or llm_config.get("base_url") or os.getenv("ZHIPUAI_BASE_URL")
         
         if self.base_url:
             self.client = ZhipuAI(api_key=self.api_key, base_url=self.base_url)
@@ -49,3 +70,12 @@ class ZhipuEmbedding(BaseEmbedding):
             input=text
         )
         return resp.data[0].embedding
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # SDK accepts a list input; items carry their position in "index"
+        resp = self.client.embeddings.create(
+            model=self.model,
+            input=texts
+        )
+        items = sorted(resp.data, key=lambda item: item.index)
+        return [item.embedding for item in items]
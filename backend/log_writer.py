@@ -0,0 +1,432 @@
+import asyncio
+import glob
+import json
+import os
+import socket
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import text
+from config_loader import config
+from db import get_async_engine
+from question_stats import update_question_stats
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process locking, single API process assumed (one shared spool)
+    fcntl = None
+
+# Write-behind for /get_answer side effects (question_history, chat_logs).
+# Rows are queued in process and written as multi-row INSERTs every flush_interval_ms
+# or batch_size rows, so the answer never waits on the database. Every queued row is
+# first appended to a local spool file (JSON lines); the spool holds exactly the rows
+# not yet committed and is replayed at startup after a crash.
+# chat_logs ids are reserved from the table's sequence in blocks, so the response can
+# carry question_id before the row exists; question_history rows get a client-side
+# log_key. A crash between commit and spool rewrite replays committed rows: both
+# tables use ON CONFLICT DO NOTHING and question_stats only counts rows actually inserted.
+# Each API process spools to its own file next to spool_path (log_spool.<host>.<pid>.jsonl)
+# and holds an exclusive flock on its .lock file while running. At startup a process
+# also adopts every log_spool*.jsonl whose lock is free (left by a crashed or recreated
+# worker, or the old single spool_path): the rows are copied into its own spool first,
+# then the orphan is removed.
+# created_at is stamped when the row is queued, on the database clock (LOCALTIMESTAMP,
+# what DEFAULT CURRENT_TIMESTAMP stores): the offset to the local clock is refreshed
+# with every id block, so queued rows sort with rows the database stamped itself.
+
+CHAT_LOG_COLUMNS = ("id", "question", "answer", "username", "image_path", "status", "sources", "intent", "created_at")
+
+
+def get_log_writer_config() -> dict:
+    writer_config = config.log_writer or {}
+    return {
+        "enabled": bool(writer_config.get("enabled", True)),
+        "flush_interval_ms": int(writer_config.get("flush_interval_ms", 200)),
+        "batch_size": int(writer_config.get("batch_size", 100)),
+        # Keep both files on a mounted volume (docker-compose: ./data/state -> /app/state)
+        "spool_path": writer_config.get("spool_path") or "state/log_spool.jsonl",
+        # Rows the database rejects (e.g. NUL characters) are moved here instead of blocking the queue
+        "dead_letter_path": writer_config.get("dead_letter_path") or "state/log_dead_letter.jsonl",
+        # chat_logs ids reserved per sequence round trip
+        "id_block": int(writer_config.get("id_block", 50)),
+    }
+
+
+def _multi_row_insert(table: str, columns, rows: List[dict], suffix: str = ""):
+    values = []
+    params = {}
+    for i, row in enumerate(rows):
+        names = []
+        for column in columns:
+            name = f"{column}_{i}"
+            names.append(f":{name}")
+            params[name] = row.get(column)
+        values.append(f"({', '.join(names)})")
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join(values)} {suffix}"
+    return text(sql), params
+
+
+def _db_row(record: dict) -> dict:
+    row = dict(record)
+    row.pop("table", None)
+    if row.get("created_at"):
+        row["created_at"] = datetime.fromisoformat(row["created_at"])
+    if row.get("log_key"):
+        row["log_key"] = uuid.UUID(row["log_key"])
+    if "sources" in row:
+        # Stored as JSON text; the jsonb column parses it
+        row["sources"] = json.dumps(row["sources"] or [], ensure_ascii=False)
+    return row
+
+
+async def write_records(records: List[dict]):
+    """
+    Insert queued records in one transaction, one multi-row INSERT per table;
+    question_stats is updated in the same transaction.
+    """
+    questions = [_db_row(r) for r in records if r["table"] == "question_history"]
+    chats = [_db_row(r) for r in records if r["table"] == "chat_logs"]
+    async with get_async_engine().begin() as conn:
+        if questions:
+            statement, params = _multi_row_insert(
+                "question_history", ("question", "created_at", "log_key"), questions, suffix="ON CONFLICT (log_key) DO NOTHING"
+            )
+            await conn.execute(statement, params)
+        if chats:
+            statement, params = _multi_row_insert(
+                "chat_logs", CHAT_LOG_COLUMNS, chats, suffix="ON CONFLICT (id) DO NOTHING RETURNING id"
+            )
+            inserted = {row[0] for row in (await conn.execute(statement, params)).fetchall()}
+            try:
+                # Savepoint: a stats failure must not keep the chat_logs rows queued
+                async with conn.begin_nested():
+                    await update_question_stats(conn, [c for c in chats if c["id"] in inserted])
+            except Exception as e:
+                print(f"Error updating question_stats: {e}")
+
+
+def _read_spool(path: str) -> List[dict]:
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Torn last line from a crash mid-write
+                continue
+    return records
+
+
+def _lock_spool(path: str):
+    """
+    Exclusive, non-blocking flock on <path>.lock. Returns the open lock file, or None
+    when another process holds it. Without fcntl every call succeeds.
+    """
+    lock = open(f"{path}.lock", "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+    return lock
+
+
+def _remove_spool(path: str, lock):
+    # Unlinked while the lock is held, so no other process is reading it
+    for name in (path, f"{path}.lock"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+    lock.close()
+
+
+class LogWriter:
+    def __init__(self):
+        self.cfg = get_log_writer_config()
+        self._records: List[dict] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._id_lock: Optional[asyncio.Lock] = None
+        self._ids = deque()
+        self._task = None
+        self._spool = None
+        self._spool_path: Optional[str] = None
+        self._spool_lock = None
+        # Queued chat_logs ids / per-user counts, for feedback and the guest limit
+        self._pending_ids = set()
+        self._pending_users = Counter()
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.dead_letters = 0
+        self._clock_offset: Optional[timedelta] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        self.cfg = get_log_writer_config()
+        if not self.cfg["enabled"] or self.running:
+            return
+        for path in (self.cfg["spool_path"], self.cfg["dead_letter_path"]):
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._id_lock = asyncio.Lock()
+        try:
+            async with get_async_engine().connect() as conn:
+                self._set_clock((await conn.execute(text("SELECT LOCALTIMESTAMP"))).scalar())
+        except Exception as e:
+            print(f"⚠️ Could not read the database clock, stamping log rows with the local clock: {e}")
+        self._spool_path = self._own_spool_path()
+        self._spool_lock = _lock_spool(self._spool_path)
+        if self._spool_lock is None:
+            raise RuntimeError(f"Log spool {self._spool_path} is owned by another running process")
+        await self._replay_spool()
+        if self._spool is None:
+            self._spool = open(self._spool_path, "a", encoding="utf-8")
+        self._task = asyncio.create_task(self._run())
+
+    def _own_spool_path(self) -> str:
+        path = self.cfg["spool_path"]
+        if fcntl is None:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{socket.gethostname()}.{os.getpid()}{ext}"
+
+    async def _replay_spool(self):
+        # Own file first (pid reused after a container restart), then orphans
+        records = _read_spool(self._spool_path)
+        adopted = []
+        if fcntl is not None:
+            root, ext = os.path.splitext(self.cfg["spool_path"])
+            for path in sorted(glob.glob(f"{glob.escape(root)}*{ext}")):
+                if path == self._spool_path:
+                    continue
+                lock = _lock_spool(path)
+                if lock is None:
+                    # Another live process owns it
+                    continue
+                if os.path.exists(path):
+                    records.extend(_read_spool(path))
+                adopted.append((path, lock))
+
+        # Left in memory (and in the own spool) if the database is still unavailable
+        self._records = records
+        for record in records:
+            self._track(record, 1)
+        self._rewrite_spool()
+        # Only now that the rows are in the own spool; a crash before this replays them twice (deduplicated)
+        for path, lock in adopted:
+            _remove_spool(path, lock)
+        if records:
+            await self.flush()
+            print(f"✅ Replayed {len(records)} spooled log rows")
+
+    def _track(self, record: dict, delta: int):
+        if record["table"] != "chat_logs":
+            return
+        if delta > 0:
+            self._pending_ids.add(record["id"])
+        else:
+            self._pending_ids.discard(record["id"])
+        if record.get("username"):
+            self._pending_users[record["username"]] += delta
+            if self._pending_users[record["username"]] <= 0:
+                del self._pending_users[record["username"]]
+
+    def _rewrite_spool(self):
+        # Called after a flush: the spool keeps only rows that are still queued
+        path = self._spool_path
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if self._spool is not None:
+            self._spool.close()
+        # Atomic swap: a crash leaves either the old or the new spool, never a partial one
+        os.replace(tmp_path, path)
+        self._spool = open(path, "a", encoding="utf-8")
+
+    async def _enqueue(self, record: dict):
+        self._spool.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._spool.flush()
+        self._records.append(record)
+        self._track(record, 1)
+        if len(self._records) >= self.cfg["batch_size"]:
+            self._wakeup.set()
+
+    async def _run(self):
+        interval = self.cfg["flush_interval_ms"] / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error in log write-behind loop: {e}")
+
+    async def flush(self) -> int:
+        """
+        Write everything queued so far, batch_size rows per INSERT. Returns rows taken off
+        the queue (written or dead-lettered).
+        """
+        written = []
+        done = 0
+        async with self._flush_lock:
+            target = len(self._records)
+            while done < target:
+                batch = self._records[:min(self.cfg["batch_size"], target - done)]
+                try:
+                    await write_records(batch)
+                    batch_written = batch
+                except Exception as e:
+                    self.failed_flushes += 1
+                    if not await self._database_reachable():
+                        # Rows stay queued and spooled; retried on the next tick
+                        print(f"⚠️ Log write-behind flush failed ({len(self._records)} rows queued): {e}")
+                        break
+                    # The database is up, so some row itself is rejected: isolate it
+                    batch_written = await self._write_one_by_one(batch)
+                # Rows enqueued meanwhile were appended after the batch
+                self._records = self._records[len(batch):]
+                for record in batch:
+                    self._track(record, -1)
+                written.extend(batch_written)
+                done += len(batch)
+            if done:
+                self.flushed_rows += len(written)
+                self._rewrite_spool()
+        return done
+
+    async def _database_reachable(self) -> bool:
+        try:
+            async with get_async_engine().connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    async def _write_one_by_one(self, batch: List[dict]) -> List[dict]:
+        """
+        Retry a failed batch row by row; rows that still fail go to the dead-letter file.
+        Returns the rows written.
+        """
+        written = []
+        for record in batch:
+            try:
+                await write_records([record])
+                written.append(record)
+            except Exception as e:
+                self._dead_letter(record, e)
+        return written
+
+    def _dead_letter(self, record: dict, error: Exception):
+        self.dead_letters += 1
+        print(f"⚠️ Log row rejected by the database, moved to {self.cfg['dead_letter_path']}: {error}")
+        try:
+            with open(self.cfg["dead_letter_path"], "a", encoding="utf-8") as f:
+                f.write(json.dumps({"record": record, "error": str(error)}, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error writing log dead letter: {e}")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Drain everything; whatever cannot be written stays in the spool for the next start
+        while self._records and await self.flush():
+            pass
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self._spool_lock is not None:
+            if self._records:
+                # Kept for the next start (or another process) to replay
+                self._spool_lock.close()
+            else:
+                _remove_spool(self._spool_path, self._spool_lock)
+            self._spool_lock = None
+
+    async def allocate_chat_log_id(self) -> int:
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    async with get_async_engine().connect() as conn:
+                        rows = (await conn.execute(
+                            text("SELECT nextval(pg_get_serial_sequence('chat_logs', 'id')), LOCALTIMESTAMP FROM generate_series(1, :n)"),
+                            {"n": self.cfg["id_block"]}
+                        )).fetchall()
+                        self._ids.extend(row[0] for row in rows)
+                        self._set_clock(rows[0][1])
+        return self._ids.popleft()
+
+    def _set_clock(self, db_now: datetime):
+        self._clock_offset = db_now - datetime.now()
+
+    def now(self) -> datetime:
+        # Database clock; the local clock only until the database has been reached once
+        return datetime.now() + (self._clock_offset or timedelta(0))
+
+    async def log_question(self, question: str):
+        await self._enqueue({
+            "table": "question_history",
+            "log_key": str(uuid.uuid4()),
+            "question": question,
+            "created_at": self.now().isoformat(),
+        })
+
+    async def log_chat(self, question: str, answer: str, username: str, image_path: Optional[str],
+                       status: str, sources: list, intent: Optional[str]) -> int:
+        question_id = await self.allocate_chat_log_id()
+        await self._enqueue({
+            "table": "chat_logs",
+            "id": question_id,
+            "question": question,
+            "answer": answer,
+            "username": username,
+            "image_path": image_path,
+            "status": status,
+            "sources": sources,
+            "intent": intent,
+            "created_at": self.now().isoformat(),
+        })
+        return question_id
+
+    def pending_for_user(self, username: str) -> int:
+        return self._pending_users.get(username, 0)
+
+    async def ensure_flushed(self, question_id: int):
+        """
+        Make sure a chat_logs row exists before it is updated (feedback).
+        """
+        if question_id in self._pending_ids:
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.running,
+            "queued": len(self._records),
+            "reserved_ids": len(self._ids),
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "dead_letters": self.dead_letters,
+        }
+
+
+log_writer = LogWriter()
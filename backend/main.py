@@ -1,30 +1,42 @@
 import sys
 from fastapi import FastAPI, Request, UploadFile, File, Depends, HTTPException, status, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 # from fastapi.templating import Jinja2Templates # Removed
 from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uuid
 import os
 import shutil
-from collections import Counter, deque
-from rag.qa import answer_question
-from rag.loader import load_document, load_text_content
-from db import engine
+from collections import Counter
+from rag.qa import aanswer_question, astream_answer
+from rag.router import INTENT_CHAT, route_question
+from rag.loader import get_current_time_str
+from rag.manifest import ensure_manifest_table
+from rag.jobs import ensure_jobs_table, enqueue_job, get_job, list_jobs, start_embedded_workers
+from rag.vector_index import ensure_vector_index, rebuild_vector_index, get_index_status
+from rag.schema import ensure_document_columns
+from rag.lexical import start_lexical_backfill
+from llm.embedding import get_cache_stats, embedding_model_id
+from llm.http import close_http_clients
+from llm.factory import warm_up_clients, invalidate_clients, close_clients, get_backend_status
+from rag.embedding_store import ensure_embedding_store_table, start_embedding_store_seed
+from rag.answer_cache import ensure_answer_cache_table, get_answer_cache_stats
+from rag.rerank import get_rerank_config
+from rag.timings import get_timing_summary
+from rag.learned_qa import ensure_learned_qa_columns, save_learned_answer, lookup_learned_answer, start_learned_qa_embedding
+from db import engine, get_async_engine, dispose_async_engine
+from log_writer import log_writer
+from question_journal import question_journal
+from admin_logs import start_chat_log_index_build, fetch_log_page, count_logs, clamp_limit, page_response
+from question_stats import ensure_question_stats_table, start_question_stats_backfill, update_question_stats, cached_hot_questions
 from sqlalchemy import text
 from typing import List, Optional, Dict, Union
-from datetime import timedelta, datetime, timezone
+from datetime import timedelta, datetime
 import io
-import base64
-
-# Define China Timezone
-CN_TZ = timezone(timedelta(hours=8))
-
-def get_current_time_str():
-    return datetime.now(CN_TZ).strftime("%Y-%m-%d %H:%M:%S")
-
+import threading
 import base64
 from captcha.image import ImageCaptcha
 import uvicorn
@@ -34,8 +46,8 @@ import json
 
 # Import Auth
 from auth import (
-    User, UserInDB, Token, authenticate_user, create_access_token, 
-    get_current_active_user, get_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
+    User, UserInDB, Token, authenticate_user, aauthenticate_user, create_access_token,
+    get_current_active_user, get_password_hash, aget_password_hash, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
 def resource_path(relative_path):
@@ -61,26 +73,15 @@ app.mount("/user_images", StaticFiles(directory="user_images"), name="user_image
 # CAPTCHA Store (In-memory for simplicity)
 CAPTCHA_STORE = {}
 
-# Local file persistence for questions
-QUESTION_HISTORY_FILE = "question_history.json"
-
-def load_question_history():
-    if os.path.exists(QUESTION_HISTORY_FILE):
-        try:
-            with open(QUESTION_HISTORY_FILE, "r", encoding="utf-8") as f:
-                return deque(json.load(f), maxlen=500)
-        except Exception as e:
-            print(f"Error loading question history: {e}")
-    return deque(maxlen=500)
-
-def save_question_history(buffer):
-    try:
-        with open(QUESTION_HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(list(buffer), f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving question history: {e}")
+# Local file persistence for questions: append-only journal + in-memory ring
+# (question_journal.py; imports the old question_history.json on first start)
+try:
+    question_journal.open()
+except Exception as e:
+    print(f"⚠️ Question journal unavailable, keeping recent questions in memory only: {e}")
 
-question_buffer = load_question_history()
+# Signals embedded ingestion workers to stop on shutdown
+ingest_worker_stop = threading.Event()
 
 # 数据库初始化 (适配 Docker/Mac 首次运行)
 @app.on_event("startup")
@@ -118,6 +119,8 @@ async def startup_event():
                     conn.execute(text("ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS username VARCHAR(50)"))
                     conn.execute(text("ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS image_path VARCHAR(512)"))
                     conn.execute(text("ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'normal'"))
+                    # Intent router decision (chat / ops), NULL for learned answers
+                    conn.execute(text("ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS intent VARCHAR(20)"))
                     conn.execute(text("ALTER TABLE chat_logs ADD COLUMN IF NOT EXISTS sources JSONB"))
                 except Exception as e:
                     print(f"Migration note: {e}")
@@ -138,6 +141,9 @@ async def startup_event():
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """))
+                # Client-side key of write-behind rows: spool replays skip rows already committed
+                conn.execute(text("ALTER TABLE question_history ADD COLUMN IF NOT EXISTS log_key UUID"))
+                conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS question_history_log_key_idx ON question_history (log_key)"))
 
                 conn.execute(text("""
                     CREATE TABLE IF NOT EXISTS uploaded_files (
@@ -145,7 +151,7 @@ async def startup_event():
                         filename VARCHAR(255) NOT NULL,
                         file_path VARCHAR(512) NOT NULL,
                         uploader VARCHAR(50) NOT NULL,
-                        status VARCHAR(20) DEFAULT 'pending', -- pending, approved, rejected
+                        status VARCHAR(20) DEFAULT 'pending', -- pending, ingesting, approved, rejected, failed
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """))
@@ -174,6 +180,66 @@ async def startup_event():
             except Exception as e:
                 print(f"⚠️ Vector extension/documents table failed (RAG may not work): {e}")
 
+            # 3.1 Typed columns promoted out of documents.metadata (kb_type, source, ...)
+            try:
+                ensure_document_columns()
+                start_lexical_backfill()
+                print("✅ Documents columns migrated")
+            except Exception as e:
+                print(f"⚠️ Documents column migration failed: {e}")
+
+            # 3.2 Chunk embedding store (content-hash reuse during ingestion)
+            try:
+                ensure_embedding_store_table()
+                start_embedding_store_seed(embedding_model_id())
+                print("✅ Chunk embedding store initialized")
+            except Exception as e:
+                print(f"⚠️ Chunk embedding store init failed: {e}")
+
+            # 3.3 ANN index on documents.embedding (see rag.vector_index in config.yaml)
+            try:
+                if ensure_vector_index() is None:
+                    print("✅ Vector index initialized")
+            except Exception as e:
+                print(f"⚠️ Vector index creation failed (retrieval falls back to sequential scan): {e}")
+
+            # 3.3.1 Semantic answer cache + per-KB generation counters
+            try:
+                ensure_answer_cache_table()
+                print("✅ Answer cache initialized")
+            except Exception as e:
+                print(f"⚠️ Answer cache init failed: {e}")
+
+            # 3.3.2 learned_qa: normalized question hash + embedding for near-match
+            try:
+                ensure_learned_qa_columns()
+                start_learned_qa_embedding()
+                print("✅ Learned QA index initialized")
+            except Exception as e:
+                print(f"⚠️ Learned QA index init failed (lookup falls back to exact text): {e}")
+
+            # 3.3.3 chat_logs indexes for the admin listings and the guest limit
+            try:
+                start_chat_log_index_build()
+            except Exception as e:
+                print(f"⚠️ Chat log index build could not be started: {e}")
+
+            # 3.3.4 Hot question aggregates (backfilled from chat_logs once)
+            try:
+                ensure_question_stats_table()
+                start_question_stats_backfill()
+                print("✅ Question stats initialized")
+            except Exception as e:
+                print(f"⚠️ Question stats init failed (hot questions fall back to recent questions): {e}")
+
+            # 3.4 Ingestion job queue
+            try:
+                ensure_jobs_table()
+                ensure_manifest_table()
+                print("✅ Ingestion job queue initialized")
+            except Exception as e:
+                print(f"⚠️ Ingestion job queue init failed: {e}")
+
             # 4. Seed Default Users
             try:
                 # Check if admin exists
@@ -197,6 +263,37 @@ async def startup_event():
     except Exception as e:
         print(f"⚠️ Database initialization critical error: {e}")
 
+    # Ingestion workers inside the API process (jobs.embedded_workers, 0 = external ingest_worker.py)
+    start_embedded_workers(ingest_worker_stop)
+
+    # Build the default LLM / embedding clients once (cached in llm.registry)
+    try:
+        warm_up_clients()
+        print("✅ LLM clients initialized")
+    except Exception as e:
+        print(f"⚠️ LLM client warm-up failed (will retry on first request): {e}")
+
+    # Write-behind for question_history / chat_logs (replays spools left by crashed or recreated processes)
+    try:
+        await log_writer.start()
+        if log_writer.running:
+            print("✅ Log write-behind started")
+    except Exception as e:
+        print(f"⚠️ Log write-behind unavailable, writing logs synchronously: {e}")
+
+    # Background compaction of the question journal
+    question_journal.start_compactor()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    ingest_worker_stop.set()
+    # Flush queued log rows before the pools go away
+    await log_writer.stop()
+    close_clients()
+    await close_http_clients()
+    await dispose_async_engine()
+    question_journal.close()
+
 # 允许跨域请求
 app.add_middleware(
     CORSMiddleware,
@@ -261,7 +358,7 @@ async def login_for_access_token(
     # Remove used captcha
     del CAPTCHA_STORE[captcha_id]
 
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await aauthenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -283,15 +380,17 @@ async def register(request: RegisterRequest):
     if request.username == "admin":
          raise HTTPException(status_code=400, detail="Cannot register as admin")
 
+    # Hash before taking a pooled connection (bcrypt runs in a worker thread)
+    hashed_pwd = await aget_password_hash(request.password)
+
     # Check if user exists
-    with engine.begin() as conn:
-        existing = conn.execute(text("SELECT username FROM users WHERE username = :u"), {"u": request.username}).fetchone()
+    async with get_async_engine().begin() as conn:
+        existing = (await conn.execute(text("SELECT username FROM users WHERE username = :u"), {"u": request.username})).fetchone()
         if existing:
             raise HTTPException(status_code=400, detail="Username already registered")
         
         # Create user (force role='user')
-        hashed_pwd = get_password_hash(request.password)
-        conn.execute(
+        await conn.execute(
             text("INSERT INTO users (username, hashed_password, role) VALUES (:u, :p, 'user')"),
             {"u": request.username, "p": hashed_pwd}
         )
@@ -309,9 +408,9 @@ async def guest_token():
     guest_id = f"guest_{uuid.uuid4().hex[:8]}"
     
     # Add guest user with random password
-    with engine.begin() as conn:
-        random_pwd = get_password_hash(uuid.uuid4().hex)
-        conn.execute(
+    random_pwd = await aget_password_hash(uuid.uuid4().hex)
+    async with get_async_engine().begin() as conn:
+        await conn.execute(
             text("INSERT INTO users (username, hashed_password, role) VALUES (:u, :p, 'guest')"),
             {"u": guest_id, "p": random_pwd}
         )
@@ -341,7 +440,8 @@ def upload_document(
     # Admin -> Approved (Direct Ingestion)
     # User -> Pending (Needs Approval)
     is_admin = current_user.role == 'admin'
-    status_code = "approved" if is_admin else "pending"
+    # Admin uploads become 'approved' when the ingestion job succeeds
+    status_code = "ingesting" if is_admin else "pending"
     
     # KB Type determination
     # If admin, use target_kb (default 'admin' which is Ops KB)
@@ -367,26 +467,33 @@ def upload_document(
             with open(file_path, "wb") as buffer:
                 shutil.copyfileobj(file.file, buffer)
                 
-            # Record in uploaded_files table
+            # Record in uploaded_files table (and the ingest job in the same transaction)
             with engine.begin() as conn:
-                conn.execute(
-                    text("INSERT INTO uploaded_files (filename, file_path, uploader, status) VALUES (:f, :p, :u, :s)"),
+                upload_id = conn.execute(
+                    text("INSERT INTO uploaded_files (filename, file_path, uploader, status) VALUES (:f, :p, :u, :s) RETURNING id"),
                     {"f": file.filename, "p": file_path, "u": current_user.username, "s": status_code}
-                )
+                ).scalar()
+
+                if is_admin:
+                    # 入库 (异步任务，进度见 /jobs/{job_id})
+                    metadata = {
+                        "source": file_path,
+                        "filename": file.filename,
+                        "type": "user_upload",
+                        "uploader": current_user.username,
+                        "upload_time": get_current_time_str()
+                    }
+
+                    job_id = enqueue_job(
+                        "ingest_file",
+                        {"file_path": file_path, "metadata": metadata, "kb_type": kb_type,
+                         "upload_id": upload_id, "upload_failed_status": "failed"},
+                        created_by=current_user.username,
+                        conn=conn
+                    )
 
             if is_admin:
-                # 入库
-                metadata = {
-                    "source": file_path,
-                    "filename": file.filename,
-                    "type": "user_upload",
-                    "uploader": current_user.username,
-                    "upload_time": get_current_time_str()
-                }
-                
-                # 调用 loader 进行入库，传入 kb_type
-                load_document(file_path, metadata, kb_type=kb_type)
-                results.append({"filename": file.filename, "status": "success", "message": f"上传并入库成功 ({kb_type} 库)"})
+                results.append({"filename": file.filename, "status": "success", "message": f"上传成功，已加入入库队列 ({kb_type} 库)", "job_id": job_id})
             else:
                 results.append({"filename": file.filename, "status": "pending", "message": "上传成功，等待管理员审批"})
             
@@ -396,12 +503,12 @@ def upload_document(
     return {"results": results}
 
 @app.get("/pending_docs")
-def get_pending_docs(current_user: User = Depends(get_current_active_user)):
+async def get_pending_docs(current_user: User = Depends(get_current_active_user)):
     if current_user.role != 'admin':
         raise HTTPException(status_code=403, detail="Permission denied")
     
-    with engine.connect() as conn:
-        result = conn.execute(text("SELECT id, filename, uploader, created_at FROM uploaded_files WHERE status = 'pending' ORDER BY created_at DESC")).fetchall()
+    async with get_async_engine().connect() as conn:
+        result = (await conn.execute(text("SELECT id, filename, uploader, created_at FROM uploaded_files WHERE status = 'pending' ORDER BY created_at DESC"))).fetchall()
         # Convert to list of dicts
         docs = [{"id": row[0], "filename": row[1], "uploader": row[2], "created_at": str(row[3])} for row in result]
     return {"docs": docs}
@@ -432,7 +539,7 @@ def download_source(doc_id: int, current_user: User = Depends(get_current_active
     with engine.connect() as conn:
         # Get source path from documents table metadata
         row = conn.execute(
-            text("SELECT metadata->>'source' as source, metadata->>'filename' as filename FROM documents WHERE id = :id"), 
+            text("SELECT source, filename FROM documents WHERE id = :id"), 
             {"id": doc_id}
         ).fetchone()
         
@@ -463,24 +570,26 @@ def approve_doc(doc_id: int, current_user: User = Depends(get_current_active_use
         
         filename, file_path, uploader, created_at = row
         
-        # Ingest
-        try:
-            metadata = {
-                "source": file_path,
-                "filename": filename,
-                "type": "user_upload",
-                "uploader": uploader,
-                "upload_time": created_at.strftime("%Y-%m-%d %H:%M:%S")
-            }
-            # Approve -> Ingest into 'user' KB (since uploader was likely 'user')
-            load_document(file_path, metadata, kb_type="user")
-            
-            # Update status
-            conn.execute(text("UPDATE uploaded_files SET status = 'approved' WHERE id = :id"), {"id": doc_id})
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Ingestion failed: {str(e)}")
+        # 'approved' is set by the ingestion job once the chunks are in (back to 'pending' if it fails)
+        conn.execute(text("UPDATE uploaded_files SET status = 'ingesting' WHERE id = :id"), {"id": doc_id})
+
+        # Ingest (async job), in the same transaction: no 'ingesting' upload without a job
+        metadata = {
+            "source": file_path,
+            "filename": filename,
+            "type": "user_upload",
+            "uploader": uploader,
+            "upload_time": created_at.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        # Approve -> Ingest into 'user' KB (since uploader was likely 'user')
+        job_id = enqueue_job(
+            "ingest_file",
+            {"file_path": file_path, "metadata": metadata, "kb_type": "user", "upload_id": doc_id},
+            created_by=current_user.username,
+            conn=conn
+        )
 
-    return {"message": "Document approved and ingested"}
+    return {"message": "Document approved, ingestion queued", "job_id": job_id}
 
 @app.post("/reject_doc/{doc_id}")
 def reject_doc(doc_id: int, current_user: User = Depends(get_current_active_user)):
@@ -495,17 +604,24 @@ def reject_doc(doc_id: int, current_user: User = Depends(get_current_active_user
     return {"message": "Document rejected"}
 
 @app.get("/admin/chat_logs")
-def get_admin_chat_logs(page: int = 1, limit: int = 20, current_user: User = Depends(get_current_active_user)):
+async def get_admin_chat_logs(page: int = 1, limit: int = 20, cursor: Optional[str] = None, estimate: bool = False,
+                              current_user: User = Depends(get_current_active_user)):
+    """
+    Newest first. Pass next_cursor from the previous response as `cursor` (keyset, any depth);
+    page still works but gets slower the deeper it goes. estimate=true skips the exact COUNT(*).
+    """
     if current_user.role != 'admin':
         raise HTTPException(status_code=403, detail="Permission denied")
     
-    offset = (page - 1) * limit
-    with engine.connect() as conn:
-        total = conn.execute(text("SELECT COUNT(*) FROM chat_logs")).scalar()
-        result = conn.execute(
-            text("SELECT id, username, question, answer, image_path, created_at, sources FROM chat_logs ORDER BY created_at DESC LIMIT :limit OFFSET :offset"),
-            {"limit": limit, "offset": offset}
-        ).fetchall()
+    limit = clamp_limit(limit)
+    async with get_async_engine().connect() as conn:
+        total, estimated = await count_logs(conn, None, estimate)
+        try:
+            result, next_cursor = await fetch_log_page(
+                conn, "id, username, question, answer, image_path, created_at, sources", None, page, limit, cursor
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         logs = []
         for row in result:
@@ -519,7 +635,7 @@ def get_admin_chat_logs(page: int = 1, limit: int = 20, current_user: User = Dep
                 "sources": row[6] if row[6] else []
             })
             
-    return {"total": total, "logs": logs, "page": page, "limit": limit}
+    return page_response(total, estimated, logs, page, limit, next_cursor)
 
 
 @app.post("/reprocess_docs")
@@ -527,118 +643,82 @@ def reprocess_docs(force: bool = False):
     """
     Trigger ingestion of files in the uploads directory.
     Also handles deletion of files that are no longer on disk (Sync).
+    Runs as a background job; poll /jobs/{job_id} for the result.
     """
     upload_dir = "uploads"
     if not os.path.exists(upload_dir):
         return {"message": "Uploads directory does not exist", "count": 0}
-    
-    # 1. Get all files on disk
-    disk_files = set()
-    for filename in os.listdir(upload_dir):
-        file_path = os.path.join(upload_dir, filename)
-        if os.path.isfile(file_path):
-             disk_files.add(file_path)
-             
-    # 2. Get all sources in DB
-    db_files = set()
+
+    job_id = enqueue_job("reprocess", {"upload_dir": upload_dir, "force": force})
+    return {
+        "message": f"同步任务已提交 (任务 #{job_id})，请稍后查看结果",
+        "job_id": job_id,
+        "processed": 0,
+        "deleted": 0,
+        "skipped": 0,
+        "errors": []
+    }
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: int, current_user: User = Depends(get_current_active_user)):
+    job = get_job(job_id)
+    if not job or (current_user.role != 'admin' and job["created_by"] != current_user.username):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs")
+def get_jobs(limit: int = 50, status: Optional[str] = None, current_user: User = Depends(get_current_active_user)):
+    # Non-admin users only see their own jobs
+    created_by = None if current_user.role == 'admin' else current_user.username
+    return {"jobs": list_jobs(limit=min(limit, 200), status=status, created_by=created_by)}
+
+@app.get("/admin/vector_index")
+def get_vector_index(current_user: User = Depends(get_current_active_user)):
+    if current_user.role != 'admin':
+        raise HTTPException(status_code=403, detail="Permission denied")
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text("SELECT DISTINCT metadata->>'source' FROM documents")).fetchall()
-            # Only consider files that look like they are in 'uploads/' to avoid deleting other things
-            for row in result:
-                source = row[0]
-                if source and source.startswith(upload_dir + os.sep):
-                    db_files.add(source)
+        return get_index_status()
     except Exception as e:
-        print(f"Error fetching existing sources: {e}")
-        return {"message": f"Database error: {str(e)}", "processed": 0}
-
-    # 3. Calculate diff
-    # Files to add: on disk but not in DB
-    files_to_add = disk_files - db_files
-    # Files to delete: in DB but not on disk
-    files_to_delete = db_files - disk_files
-    
-    deleted_count = 0
-    processed_count = 0
-    skipped_count = 0
-    errors = []
-    
-    # 4. Handle Deletions
-    if files_to_delete:
-        try:
-            with engine.begin() as conn:
-                for source in files_to_delete:
-                    # Delete from documents (vector store)
-                    conn.execute(text("DELETE FROM documents WHERE metadata->>'source' = :s"), {"s": source})
-                    # Delete from uploaded_files table to sync UI status
-                    conn.execute(text("DELETE FROM uploaded_files WHERE file_path = :s"), {"s": source})
-                    deleted_count += 1
-        except Exception as e:
-             errors.append(f"Deletion error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to read index status: {str(e)}")
 
-    # 5. Handle Additions
-    files_to_process = disk_files if force else files_to_add
-    
-    if not force:
-        skipped_count = len(disk_files) - len(files_to_add)
+@app.post("/admin/vector_index/rebuild")
+def rebuild_index(current_user: User = Depends(get_current_active_user)):
+    """
+    Rebuild the ANN index from the current rag.vector_index config.
+    Useful after bulk loads (IVFFlat) or after changing metric/params.
+    """
+    if current_user.role != 'admin':
+        raise HTTPException(status_code=403, detail="Permission denied")
+    try:
+        rebuilt = rebuild_vector_index()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Index rebuild failed: {str(e)}")
+    if not rebuilt:
+        raise HTTPException(status_code=409, detail="An index build is already running")
+    return {"message": "Vector index rebuilt", **get_index_status()}
 
-    for file_path in files_to_process:
-        try:
-             filename = os.path.basename(file_path)
-             upload_time = get_current_time_str()
-             metadata = {
-                 "source": file_path,
-                 "filename": filename,
-                 "type": "manual_reprocess",
-                 "upload_time": upload_time
-             }
-             # Default to user KB for auto-reprocess
-             load_document(file_path, metadata, kb_type="user")
-             processed_count += 1
-             
-             # Add to uploaded_files if not exists (to show in Admin UI)
-             with engine.begin() as conn:
-                 res = conn.execute(text("SELECT id FROM uploaded_files WHERE file_path = :p"), {"p": file_path}).fetchone()
-                 if not res:
-                     conn.execute(
-                        text("INSERT INTO uploaded_files (filename, file_path, uploader, status) VALUES (:f, :p, :u, :s)"),
-                        {"f": filename, "p": file_path, "u": "system_scan", "s": "approved"}
-                    )
-        except Exception as e:
-             errors.append(f"{os.path.basename(file_path)}: {str(e)}")
-             
-    msg = f"已同步：新增 {processed_count} 个，剔除 {deleted_count} 个"
-    if skipped_count > 0:
-        msg += f"，跳过 {skipped_count} 个现有文件"
-    if errors:
-        msg += f" (有 {len(errors)} 个错误)"
-    
-    return {
-        "message": msg,
-        "processed": processed_count,
-        "deleted": deleted_count,
-        "skipped": skipped_count,
-        "errors": errors
-    }
+@app.post("/admin/reload_config")
+def reload_config(current_user: User = Depends(get_current_active_user)):
+    """
+    Re-read config.yaml and drop cached LLM / embedding clients,
+    so provider, model or base_url changes apply without a restart.
+    """
+    if current_user.role != 'admin':
+        raise HTTPException(status_code=403, detail="Permission denied")
+    config.load_config()
+    removed = invalidate_clients()
+    return {"message": "Config reloaded", "clients_invalidated": removed}
 
 @app.get("/hot_questions")
 def get_hot_questions():
     questions = []
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT question, COUNT(*) as count 
-                FROM chat_logs 
-                GROUP BY question 
-                ORDER BY count DESC 
-                LIMIT 10
-            """)).fetchall()
-            questions = [row[0] for row in result]
+        # question_stats (time-decayed counts), cached in process for hot_questions.cache_ttl
+        questions = list(cached_hot_questions())
     except Exception as e:
         print(f"Database error in hot_questions (using buffer fallback): {e}")
         # Fallback to buffer if DB fails
-        questions = [q for q, _ in Counter(question_buffer).most_common(10)]
+        questions = [q for q, _ in Counter(question_journal.recent()).most_common(10)]
     
     try:
         # Fill with default questions if not enough
@@ -673,17 +753,21 @@ class ManualQARequest(BaseModel):
     answer: str
 
 @app.get("/admin/unknown_questions")
-def get_unknown_questions(page: int = 1, limit: int = 20, current_user: User = Depends(get_current_active_user)):
+async def get_unknown_questions(page: int = 1, limit: int = 20, cursor: Optional[str] = None, estimate: bool = False,
+                                current_user: User = Depends(get_current_active_user)):
     if current_user.role != 'admin':
         raise HTTPException(status_code=403, detail="Permission denied")
     
-    offset = (page - 1) * limit
-    with engine.connect() as conn:
-        total = conn.execute(text("SELECT COUNT(*) FROM chat_logs WHERE status = 'unknown'")).scalar()
-        result = conn.execute(
-            text("SELECT id, username, question, answer, image_path, created_at FROM chat_logs WHERE status = 'unknown' ORDER BY created_at DESC LIMIT :limit OFFSET :offset"),
-            {"limit": limit, "offset": offset}
-        ).fetchall()
+    limit = clamp_limit(limit)
+    async with get_async_engine().connect() as conn:
+        # Served by the partial index chat_logs_unknown_created_at_idx
+        total, estimated = await count_logs(conn, "status = 'unknown'", estimate)
+        try:
+            result, next_cursor = await fetch_log_page(
+                conn, "id, username, question, answer, image_path, created_at", "status = 'unknown'", page, limit, cursor
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         logs = []
         for row in result:
@@ -696,7 +780,7 @@ def get_unknown_questions(page: int = 1, limit: int = 20, current_user: User = D
                 "created_at": str(row[5])
             })
             
-    return {"total": total, "logs": logs, "page": page, "limit": limit}
+    return page_response(total, estimated, logs, page, limit, next_cursor)
 
 @app.post("/admin/learn")
 def learn_question(req: LearnRequest, current_user: User = Depends(get_current_active_user)):
@@ -713,11 +797,8 @@ def learn_question(req: LearnRequest, current_user: User = Depends(get_current_a
         # 1. Update chat_logs status
         conn.execute(text("UPDATE chat_logs SET status = 'learned' WHERE id = :id"), {"id": req.question_id})
         
-        # 2. Insert into learned_qa
-        conn.execute(
-            text("INSERT INTO learned_qa (question, answer) VALUES (:q, :a)"),
-            {"q": question, "a": req.answer}
-        )
+        # 2. Insert into learned_qa (replaces an earlier answer to the same normalized question)
+        qa_id = save_learned_answer(conn, question, req.answer)
         
         # 3. Ingest into Vector DB
         metadata = {
@@ -730,25 +811,16 @@ def learn_question(req: LearnRequest, current_user: User = Depends(get_current_a
         # Combine Q and A for better retrieval context
         content = f"问题：{question}\n答案：{req.answer}"
         
-        # Use load_text_content directly
-        # Note: We need to handle this inside the function or here. 
-        # load_text_content is in loader.py and uses its own engine.begin()
-        # Since we are already in a transaction here, calling another function that starts a transaction 
-        # might be fine if it uses a new connection or if we move logic.
-        # However, loader.py uses `from db import engine` which is the same engine.
-        # SQLAlchemy supports nested transactions (savepoints) if using begin_nested(), 
-        # but engine.begin() usually creates a new connection/transaction.
-        # It is safer to call it AFTER this transaction commits.
-        
-    # Call load_text_content outside the transaction block to avoid potential locking/nesting issues
-    # Although separate connections are usually fine.
+    # Question embedding for near-match lookup, and vector ingestion as a background job,
+    # both after the learned_qa row is committed
+    start_learned_qa_embedding([qa_id])
     try:
-        load_text_content(content, metadata)
+        job_id = enqueue_job("ingest_text", {"content": content, "metadata": metadata}, created_by=current_user.username)
     except Exception as e:
-        print(f"Error ingesting learned QA: {e}")
+        print(f"Error queueing learned QA ingestion: {e}")
         return {"status": "partial_success", "message": "Learned but vector ingestion failed"}
 
-    return {"status": "success", "message": "Question learned and ingested"}
+    return {"status": "success", "message": "Question learned, ingestion queued", "job_id": job_id}
 
 @app.post("/admin/add_qa")
 def add_qa(req: ManualQARequest, current_user: User = Depends(get_current_active_user)):
@@ -762,11 +834,8 @@ def add_qa(req: ManualQARequest, current_user: User = Depends(get_current_active
         raise HTTPException(status_code=400, detail="Question and Answer cannot be empty")
 
     with engine.begin() as conn:
-        # 1. Insert into learned_qa
-        conn.execute(
-            text("INSERT INTO learned_qa (question, answer) VALUES (:q, :a)"),
-            {"q": question, "a": answer}
-        )
+        # 1. Insert into learned_qa (replaces an earlier answer to the same normalized question)
+        qa_id = save_learned_answer(conn, question, answer)
         
         # 2. Ingest into Vector DB
         metadata = {
@@ -778,58 +847,159 @@ def add_qa(req: ManualQARequest, current_user: User = Depends(get_current_active
         }
         content = f"问题：{question}\n答案：{answer}"
         
+    start_learned_qa_embedding([qa_id])
     try:
-        load_text_content(content, metadata)
+        job_id = enqueue_job("ingest_text", {"content": content, "metadata": metadata}, created_by=current_user.username)
     except Exception as e:
-        print(f"Error ingesting manual QA: {e}")
+        print(f"Error queueing manual QA ingestion: {e}")
         return {"status": "partial_success", "message": "Saved but vector ingestion failed"}
 
-    return {"status": "success", "message": "Question added to knowledge base"}
+    return {"status": "success", "message": "Question added to knowledge base", "job_id": job_id}
 
 # 接受用户问题并返回答案
-@app.post("/get_answer")
-def get_answer(req: QuestionRequest, current_user: User = Depends(get_current_active_user)):
-    question = req.question
-    image_data = req.image
-    
+GUEST_QUESTION_LIMIT = 5
+# Disable proxy buffering (nginx) so tokens reach the browser as they are produced
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+GUEST_LIMIT_MESSAGE = "您是访客用户，提问次数已达上限 (5次)。请注册或登录以继续使用。"
+UNKNOWN_KEYWORDS = ["未在现有运维知识库中找到", "我不知道", "无法回答"]
+
+async def guest_limit_reached(current_user: User) -> bool:
     # Guest Limit Check
-    if current_user.role == 'guest':
-        with engine.connect() as conn:
-            count = conn.execute(text("SELECT COUNT(*) FROM chat_logs WHERE username = :u"), {"u": current_user.username}).scalar()
-            if count >= 5:
-                return {
-                    "answer": "您是访客用户，提问次数已达上限 (5次)。请注册或登录以继续使用。",
-                    "sources": [],
-                    "images": []
-                }
-    
-    # 记录问题历史 (Legacy file)
-    question_buffer.appendleft(question)
-    save_question_history(question_buffer)
-    
+    if current_user.role != 'guest':
+        return False
+    async with get_async_engine().connect() as conn:
+        count = (await conn.execute(text("SELECT COUNT(*) FROM chat_logs WHERE username = :u"), {"u": current_user.username})).scalar()
+    # Answers still queued in the write-behind count too
+    return count + log_writer.pending_for_user(current_user.username) >= GUEST_QUESTION_LIMIT
+
+async def record_question(question: str):
+    # 记录问题历史 (本地 journal：一次追加写，不再整文件重写)
+    question_journal.append(question)
+    if log_writer.running:
+        await log_writer.log_question(question)
+        return
+
     # 记录问题历史 (DB - question_history)
-    with engine.begin() as conn:
-        conn.execute(text("INSERT INTO question_history (question) VALUES (:q)"), {"q": question})
+    async with get_async_engine().begin() as conn:
+        await conn.execute(text("INSERT INTO question_history (question) VALUES (:q)"), {"q": question})
 
+def save_user_image(image_data: Optional[str]) -> Optional[str]:
     # Save user image if present
-    saved_image_path = None
-    if image_data:
+    if not image_data:
+        return None
+    try:
+        # image_data is base64 string
+        if "," in image_data:
+            header, encoded = image_data.split(",", 1)
+        else:
+            encoded = image_data
+        
+        data = base64.b64decode(encoded)
+        # Simple unique filename
+        filename = f"{uuid.uuid4()}.png"
+        save_path = os.path.join("user_images", filename)
+        with open(save_path, "wb") as f:
+            f.write(data)
+        return filename
+    except Exception as e:
+        print(f"Error saving user image: {e}")
+        return None
+
+def find_learned_answer(question: str) -> Optional[str]:
+    # Small talk (intent router) only gets the exact match: the near match would embed "你好"
+    intent, _ = route_question(question)
+    try:
+        return lookup_learned_answer(question, near_match=intent != INTENT_CHAT)
+    except Exception as e:
+        # Table might not exist yet if startup hasn't run fully or connection issue
+        print(f"Error checking learned_qa: {e}")
+        return None
+
+def kb_type_for_user(current_user: User) -> str:
+    # Map guest to user KB, admin to all
+    kb_type = current_user.role
+    if kb_type == 'guest':
+        kb_type = 'user'
+    elif kb_type == 'admin':
+        kb_type = 'all'
+    return kb_type
+
+def filter_cited_sources(answer: str, sources: list) -> list:
+    # Source Filtering Heuristic:
+    # If the answer explicitly cites documents (contains filenames),
+    # filter the sources list to only include those mentioned.
+    # This addresses user feedback about "attachments mismatch".
+    if not (sources and answer):
+        return sources
+    cited_sources = []
+    for src in sources:
+        filename = src.get("filename", "")
+        # Robust check:
+        # 1. Exact match
+        # 2. Match without extension (e.g. "Manual" in answer, filename is "Manual.pdf")
+        if filename:
+            base_name = os.path.splitext(filename)[0]
+            if (filename in answer) or (base_name in answer):
+                cited_sources.append(src)
+    
+    # If at least one source is cited, use the filtered list.
+    # Otherwise, keep all (fallback, maybe LLM didn't follow citation format).
+    return cited_sources if cited_sources else sources
+
+async def finalize_answer(question: str, answer: str, sources: list, is_learned: bool,
+                    username: str, saved_image_path: Optional[str], intent: Optional[str] = None):
+    """
+    Determine status, log chat to DB. Returns (status, sources, question_id).
+    """
+    # Default status
+    status_code = "normal"
+    if is_learned:
+        status_code = "learned"
+    else:
+        # Check for unknown keywords
+        for kw in UNKNOWN_KEYWORDS:
+            if kw in answer:
+                status_code = "unknown"
+                # If unknown, clear sources to avoid confusion
+                sources = []
+                break
+
+    if log_writer.running:
+        # id comes from a reserved sequence block; the row is written by the next flush
+        question_id = await log_writer.log_chat(question, answer, username, saved_image_path, status_code, sources, intent)
+        return status_code, sources, question_id
+
+    # Log chat to DB (with username, image_path, status, sources, intent)
+    async with get_async_engine().begin() as conn:
+        result = await conn.execute(
+            text("INSERT INTO chat_logs (question, answer, username, image_path, status, sources, intent) VALUES (:q, :a, :u, :i, :s, :src, :intent) RETURNING id, created_at"),
+            {"q": question, "a": answer, "u": username, "i": saved_image_path, "s": status_code, "src": json.dumps(sources), "intent": intent}
+        )
+        question_id, created_at = result.fetchone()
         try:
-            # image_data is base64 string
-            if "," in image_data:
-                header, encoded = image_data.split(",", 1)
-            else:
-                encoded = image_data
-            
-            data = base64.b64decode(encoded)
-            # Simple unique filename
-            filename = f"{uuid.uuid4()}.png"
-            save_path = os.path.join("user_images", filename)
-            with open(save_path, "wb") as f:
-                f.write(data)
-            saved_image_path = filename
+            async with conn.begin_nested():
+                await update_question_stats(conn, [{"question": question, "intent": intent, "created_at": created_at}])
         except Exception as e:
-            print(f"Error saving user image: {e}")
+            print(f"Error updating question_stats: {e}")
+    return status_code, sources, question_id
+
+@app.post("/get_answer")
+async def get_answer(req: QuestionRequest, current_user: User = Depends(get_current_active_user)):
+    # Async end to end: LLM / embedding calls go through the shared httpx pool, auth,
+    # retrieval and chat logs through the asyncpg pool; the remaining sync pieces
+    # (learned QA, image file) run in the threadpool.
+    question = req.question
+    image_data = req.image
+    
+    if await guest_limit_reached(current_user):
+        return {
+            "answer": GUEST_LIMIT_MESSAGE,
+            "sources": [],
+            "images": []
+        }
+    
+    await record_question(question)
+    saved_image_path = await run_in_threadpool(save_user_image, image_data)
 
     # Step 1: Check learned_qa (Direct Answer)
     # Only do this if no image is present (assuming learned QA is text-based)
@@ -837,93 +1007,99 @@ def get_answer(req: QuestionRequest, current_user: User = Depends(get_current_ac
     answer = None
     sources = []
     images = []
+    timings = None
+    intent = None
     is_learned = False
     
     if not image_data:
-        with engine.connect() as conn:
-            # Try exact match first
-            try:
-                # Check if learned_qa table exists to avoid errors during initial migration
-                learned = conn.execute(text("SELECT answer FROM learned_qa WHERE question = :q ORDER BY created_at DESC LIMIT 1"), {"q": question}).fetchone()
-                if learned:
-                    answer = learned[0]
-                    is_learned = True
-            except Exception as e:
-                # Table might not exist yet if startup hasn't run fully or connection issue
-                print(f"Error checking learned_qa: {e}")
+        answer = await run_in_threadpool(find_learned_answer, question)
+        is_learned = answer is not None
     
     if not answer:
         # Step 2: Call RAG logic
         # Pass user role to answer_question to filter KB
-        # Map guest to user KB, admin to all
-        kb_type = current_user.role
-        if kb_type == 'guest':
-            kb_type = 'user'
-        elif kb_type == 'admin':
-            kb_type = 'all'
-            
-        rag_result = answer_question(question, image_data, kb_type=kb_type)
+        rag_result = await aanswer_question(question, image_data, kb_type=kb_type_for_user(current_user))
         if isinstance(rag_result, dict):
             answer = rag_result.get("answer")
-            sources = rag_result.get("sources", [])
-            
-            # Source Filtering Heuristic:
-            # If the answer explicitly cites documents (contains filenames),
-            # filter the sources list to only include those mentioned.
-            # This addresses user feedback about "attachments mismatch".
-            if sources and answer:
-                cited_sources = []
-                has_citation = False
-                for src in sources:
-                    filename = src.get("filename", "")
-                    # Robust check:
-                    # 1. Exact match
-                    # 2. Match without extension (e.g. "Manual" in answer, filename is "Manual.pdf")
-                    if filename:
-                        base_name = os.path.splitext(filename)[0]
-                        if (filename in answer) or (base_name in answer):
-                            cited_sources.append(src)
-                            has_citation = True
-                
-                # If at least one source is cited, use the filtered list.
-                # Otherwise, keep all (fallback, maybe LLM didn't follow citation format).
-                if has_citation:
-                    sources = cited_sources
+            sources = filter_cited_sources(answer, rag_result.get("sources", []))
+            timings = rag_result.get("timings")
+            intent = rag_result.get("intent")
         else:
             answer = rag_result
             sources = []
 
-    # Step 3: Determine Status
-    # Default status
-    status_code = "normal"
-    if is_learned:
-        status_code = "learned"
-    else:
-        # Check for unknown keywords
-        unknown_keywords = ["未在现有运维知识库中找到", "我不知道", "无法回答"]
-        for kw in unknown_keywords:
-            if kw in answer:
-                status_code = "unknown"
-                # If unknown, clear sources to avoid confusion
-                sources = []
-                break
+    # Step 3: Determine Status + log
+    _, sources, question_id = await finalize_answer(
+        question, answer, sources, is_learned, current_user.username, saved_image_path, intent
+    )
 
-        # Log chat to DB (with username, image_path, status, sources)
-    question_id = None
-    with engine.begin() as conn:
-        result = conn.execute(
-            text("INSERT INTO chat_logs (question, answer, username, image_path, status, sources) VALUES (:q, :a, :u, :i, :s, :src) RETURNING id"),
-            {"q": question, "a": answer, "u": current_user.username, "i": saved_image_path, "s": status_code, "src": json.dumps(sources)}
-        )
-        question_id = result.scalar()
+    return {"answer": answer, "sources": sources, "images": images, "question_id": question_id,
+            "intent": intent, "timings": timings}
+
+def sse_event(event: str, data) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+@app.post("/get_answer/stream")
+async def get_answer_stream(req: QuestionRequest, current_user: User = Depends(get_current_active_user)):
+    """
+    Same pipeline as /get_answer, streamed as Server-Sent Events:
+      event: sources  -> retrieved sources (before generation starts)
+      event: token    -> {"text": "..."} answer fragments
+      event: done     -> {"question_id", "status", "sources", "intent"} after the chat log is written
+    """
+    question = req.question
+    image_data = req.image
+
+    if await guest_limit_reached(current_user):
+        async def limited():
+            yield sse_event("token", {"text": GUEST_LIMIT_MESSAGE})
+            yield sse_event("done", {"question_id": None, "status": "limited", "sources": []})
+        return StreamingResponse(limited(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    await record_question(question)
+    saved_image_path = await run_in_threadpool(save_user_image, image_data)
+    username = current_user.username
 
-    return {"answer": answer, "sources": sources, "images": images, "question_id": question_id}
+    learned_answer = await run_in_threadpool(find_learned_answer, question) if not image_data else None
+
+    async def events():
+        intent = None
+        if learned_answer is not None:
+            sources = []
+            parts = [learned_answer]
+            yield sse_event("sources", sources)
+            yield sse_event("token", {"text": learned_answer})
+        else:
+            # Retrieval runs here so the headers go out immediately
+            prepared, tokens = await astream_answer(question, image_data, kb_type=kb_type_for_user(current_user))
+            sources, intent = prepared.sources, prepared.intent
+            yield sse_event("sources", sources)
+            parts = []
+            async for token in tokens:
+                parts.append(token)
+                yield sse_event("token", {"text": token})
+
+        answer = "".join(parts)
+        final_sources = filter_cited_sources(answer, sources)
+        try:
+            status_code, final_sources, question_id = await finalize_answer(
+                question, answer, final_sources, learned_answer is not None, username, saved_image_path, intent
+            )
+        except Exception as e:
+            print(f"Error logging streamed answer: {e}")
+            status_code, question_id = "normal", None
+        yield sse_event("done", {"question_id": question_id, "status": status_code, "sources": final_sources, "intent": intent})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 @app.post("/feedback")
-def submit_feedback(request: FeedbackRequest):
+async def submit_feedback(request: FeedbackRequest):
     try:
-        with engine.begin() as conn:
-            conn.execute(
+        # The chat_logs row may still be queued in the write-behind
+        await log_writer.ensure_flushed(request.question_id)
+        async with get_async_engine().begin() as conn:
+            await conn.execute(
                 text("UPDATE chat_logs SET feedback = :status WHERE id = :id"),
                 {"status": request.status, "id": request.question_id}
             )
@@ -935,7 +1111,7 @@ def submit_feedback(request: FeedbackRequest):
 
 @app.get("/debug/db_status")
 def debug_db_status():
-    info = {"buffer_len": len(question_buffer)}
+    info = {"buffer_len": len(question_journal), "log_writer": log_writer.stats()}
     try:
         with engine.connect() as conn:
             exists = conn.execute(text("""
@@ -957,6 +1133,24 @@ def debug_db_status():
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/debug/rag_timings")
+def debug_rag_timings():
+    """
+    Per-stage latency of recent answers (embed, answer_cache, retrieve, rerank, context, llm).
+    """
+    return {"rerank": get_rerank_config()["type"], "stages": get_timing_summary()}
+
+@app.get("/debug/cache_stats")
+def debug_cache_stats():
+    return {"embedding": get_cache_stats(), "answer": get_answer_cache_stats()}
+
+@app.get("/debug/llm_backends")
+def debug_llm_backends():
+    """
+    Chat / embedding backend health: circuit breaker state, failure rate, latency percentiles.
+    """
+    return get_backend_status()
+
 # Static Files Serving (Moved to end of file to avoid blocking API routes)
 static_dir = resource_path("static")
 if os.path.exists(static_dir):
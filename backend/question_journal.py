@@ -0,0 +1,223 @@
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from typing import List, Optional, Tuple
+from config_loader import config
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process locking, single API process assumed
+    fcntl = None
+
+# Recent questions (fallback for /hot_questions), replacing the question_history.json rewrite.
+#   - on disk: append-only journal, one record per question:
+#       <u32 payload length><u32 crc32(payload)><utf-8 payload>   (little endian)
+#     each record is a single O_APPEND write, so several API processes can share the file
+#   - in memory: fixed ring of the last `capacity` questions; slots are claimed with
+#     itertools.count (atomic under the GIL), so appends and reads take no lock
+#   - startup: the journal is scanned through mmap; a torn last record is ignored
+#   - a background thread compacts the journal to the last `capacity` records once it
+#     grows past compact_min_bytes (rewrite + os.replace under an exclusive flock)
+
+HEADER = struct.Struct("<II")
+LEGACY_HISTORY_FILE = "question_history.json"
+
+
+def get_journal_config() -> dict:
+    journal_config = config.question_journal or {}
+    return {
+        # On the mounted state/ volume (docker-compose.yml), not in the container layer
+        "path": journal_config.get("path") or "state/question_history.journal",
+        "capacity": int(journal_config.get("capacity", 500)),
+        "compact_interval": float(journal_config.get("compact_interval", 300)),
+        "compact_min_bytes": int(journal_config.get("compact_min_bytes", 1024 * 1024)),
+    }
+
+
+def encode_record(question: str) -> bytes:
+    payload = question.encode("utf-8")
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def scan_records(path: str, limit: Optional[int] = None) -> Tuple[List[str], int]:
+    """
+    Returns (questions oldest first, only the last `limit` if given; offset where the valid
+    records end). Stops at the first incomplete or corrupt record.
+    """
+    records = deque(maxlen=limit)
+    offset = 0
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return [], offset
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            while offset + HEADER.size <= size:
+                length, crc = HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                end = start + length
+                if end > size:
+                    break
+                payload = data[start:end]
+                if zlib.crc32(payload) != crc:
+                    print(f"⚠️ Corrupt record in {path} at offset {offset}, ignoring the rest")
+                    break
+                records.append(payload.decode("utf-8", errors="replace"))
+                offset = end
+    return list(records), offset
+
+
+def read_records(path: str, limit: Optional[int] = None) -> List[str]:
+    return scan_records(path, limit)[0]
+
+
+class QuestionRing:
+    """
+    Last `capacity` questions. Writers claim a slot with next(counter); a reader may see a
+    slot mid-update, which for a hot-question statistic is harmless.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._counter = itertools.count()
+
+    def append(self, question: str):
+        seq = next(self._counter)
+        self._slots[seq % self.capacity] = (seq, question)
+
+    def recent(self) -> List[str]:
+        # Newest first
+        entries = [slot for slot in list(self._slots) if slot is not None]
+        entries.sort(key=lambda slot: slot[0], reverse=True)
+        return [question for _, question in entries]
+
+    def __len__(self) -> int:
+        return sum(1 for slot in self._slots if slot is not None)
+
+
+class QuestionJournal:
+    def __init__(self):
+        self.cfg = get_journal_config()
+        self.ring = QuestionRing(self.cfg["capacity"])
+        self._fd = None
+        self._stop = threading.Event()
+        self._compactor = None
+
+    def open(self):
+        path = self.cfg["path"]
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._import_legacy(path)
+        questions, valid_end = scan_records(path, limit=self.cfg["capacity"])
+        if os.path.exists(path) and os.path.getsize(path) > valid_end:
+            # Drop a torn tail, otherwise records appended after it could not be read back
+            os.truncate(path, valid_end)
+        for question in questions:
+            self.ring.append(question)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _import_legacy(self, path: str):
+        # One-off migration from question_history.json (newest first) to the journal.
+        # The json file is left in place (it may be a bind mount, which cannot be renamed);
+        # the existing journal marks the import as done.
+        if os.path.exists(path) or not os.path.exists(LEGACY_HISTORY_FILE):
+            return
+        try:
+            with open(LEGACY_HISTORY_FILE, "r", encoding="utf-8") as f:
+                questions = json.load(f)
+            tmp_path = f"{path}.import"
+            with open(tmp_path, "wb") as f:
+                for question in reversed(questions):
+                    f.write(encode_record(str(question)))
+            os.replace(tmp_path, path)
+            print(f"✅ Imported {len(questions)} questions from {LEGACY_HISTORY_FILE}")
+        except Exception as e:
+            print(f"Error importing legacy question history: {e}")
+
+    def _reopen_if_replaced(self):
+        # After another process compacted the journal our fd points at the old inode
+        try:
+            if os.stat(self.cfg["path"]).st_ino != os.fstat(self._fd).st_ino:
+                os.close(self._fd)
+                self._fd = os.open(self.cfg["path"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.close(self._fd)
+            self._fd = os.open(self.cfg["path"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def append(self, question: str):
+        self.ring.append(question)
+        if self._fd is None:
+            return
+        record = encode_record(question)
+        try:
+            if fcntl is not None:
+                # Shared lock: appends run concurrently, compaction waits for them
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+                try:
+                    self._reopen_if_replaced()
+                    os.write(self._fd, record)
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                self._reopen_if_replaced()
+                os.write(self._fd, record)
+        except OSError as e:
+            print(f"Error appending to question journal: {e}")
+
+    def recent(self) -> List[str]:
+        return self.ring.recent()
+
+    def __len__(self) -> int:
+        return len(self.ring)
+
+    def compact(self) -> bool:
+        """
+        Rewrite the journal with its last `capacity` records. Returns True if it ran.
+        """
+        path = self.cfg["path"]
+        if not os.path.exists(path) or os.path.getsize(path) < self.cfg["compact_min_bytes"]:
+            return False
+        with open(path, "rb") as locked:
+            if fcntl is not None:
+                fcntl.flock(locked.fileno(), fcntl.LOCK_EX)
+            try:
+                # Read from disk, not the ring: other processes' questions are in the file too
+                questions = read_records(path, limit=self.cfg["capacity"])
+                tmp_path = f"{path}.compact"
+                with open(tmp_path, "wb") as f:
+                    for question in questions:
+                        f.write(encode_record(question))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(locked.fileno(), fcntl.LOCK_UN)
+        print(f"✅ Question journal compacted to {len(questions)} records")
+        return True
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.cfg["compact_interval"]):
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Error compacting question journal: {e}")
+
+    def start_compactor(self):
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=self._compact_loop, name="question-journal-compactor", daemon=True)
+            self._compactor.start()
+
+    def close(self):
+        self._stop.set()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+question_journal = QuestionJournal()
@@ -0,0 +1,288 @@
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import text
+from config_loader import config
+from db import engine
+from rag.learned_qa import question_hash
+from rag.embedding_store import vector_literal, parse_vector
+
+# Hot questions (/hot_questions) without aggregating chat_logs on every page load.
+# question_stats keeps one row per normalized question (learned_qa.question_hash),
+# updated in the same transaction that writes the chat_logs rows (log_writer flush or
+# the synchronous fallback in finalize_answer).
+#
+# Scores use forward exponential decay: each ask adds exp(lambda * (t - EPOCH)), so
+# older asks weigh less relative to new ones without ever rewriting old rows.
+# The sum is stored as its logarithm (log_score) to stay finite; the order is the same.
+#   lambda = ln 2 / half_life_hours  (an ask half_life_hours old counts half)
+# Small talk routed to the chat prompt (intent = 'chat') is not counted.
+
+EPOCH = datetime(2024, 1, 1)
+BACKFILL_BATCH_SIZE = 500
+
+
+def get_hot_questions_config() -> dict:
+    hot_config = config.hot_questions or {}
+    cluster_config = hot_config.get("cluster", {}) or {}
+    return {
+        "half_life_hours": float(hot_config.get("half_life_hours", 72)),
+        # Seconds /hot_questions is served from memory
+        "cache_ttl": float(hot_config.get("cache_ttl", 30)),
+        "limit": int(hot_config.get("limit", 10)),
+        # Merge near-duplicate phrasings (cosine similarity of question embeddings)
+        "cluster": bool(cluster_config.get("enabled", False)),
+        "cluster_threshold": float(cluster_config.get("threshold", 0.9)),
+        "cluster_candidates": int(cluster_config.get("candidates", 50)),
+    }
+
+
+def decay_weight(created_at: datetime, half_life_hours: float) -> float:
+    """
+    log of the forward-decay weight of one ask.
+    """
+    hours = (created_at - EPOCH).total_seconds() / 3600
+    return math.log(2) / half_life_hours * hours
+
+
+def log_add(a: Optional[float], b: float) -> float:
+    # log(exp(a) + exp(b)) without overflow
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def ensure_question_stats_table():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS question_stats (
+                question_hash VARCHAR(64) PRIMARY KEY,
+                question TEXT NOT NULL,
+                total_count BIGINT NOT NULL DEFAULT 0,
+                log_score DOUBLE PRECISION NOT NULL,
+                last_seen TIMESTAMP NOT NULL,
+                embedding vector(1024),
+                embedding_model VARCHAR(200)
+            )
+        """))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS question_stats_log_score_idx ON question_stats (log_score DESC)"
+        ))
+        # One row once the backfill from chat_logs has committed
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS question_stats_backfill (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                finished_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+
+
+def aggregate(rows: List[dict], half_life_hours: float) -> List[dict]:
+    """
+    chat_logs-shaped rows ({question, created_at, intent}) -> one stats delta per question hash.
+    """
+    stats: Dict[str, dict] = {}
+    for row in rows:
+        if row.get("intent") == "chat":
+            continue
+        created_at = row["created_at"]
+        key = question_hash(row["question"])
+        entry = stats.get(key)
+        if entry is None:
+            entry = stats[key] = {
+                "question_hash": key,
+                "question": row["question"],
+                "total_count": 0,
+                "log_score": None,
+                "last_seen": created_at,
+            }
+        entry["total_count"] += row.get("count", 1)
+        entry["log_score"] = log_add(entry["log_score"], row.get("log_score", decay_weight(created_at, half_life_hours)))
+        if created_at >= entry["last_seen"]:
+            # Show the most recent phrasing
+            entry["question"] = row["question"]
+            entry["last_seen"] = created_at
+    return list(stats.values())
+
+
+_UPSERT_SQL = text("""
+    INSERT INTO question_stats (question_hash, question, total_count, log_score, last_seen)
+    SELECT * FROM UNNEST(
+        CAST(:hashes AS VARCHAR[]), CAST(:questions AS TEXT[]), CAST(:counts AS BIGINT[]),
+        CAST(:scores AS DOUBLE PRECISION[]), CAST(:seen AS TIMESTAMP[])
+    )
+    ON CONFLICT (question_hash) DO UPDATE SET
+        total_count = question_stats.total_count + EXCLUDED.total_count,
+        log_score = GREATEST(question_stats.log_score, EXCLUDED.log_score)
+            + LN(1 + EXP(-ABS(question_stats.log_score - EXCLUDED.log_score))),
+        question = CASE WHEN EXCLUDED.last_seen >= question_stats.last_seen
+                        THEN EXCLUDED.question ELSE question_stats.question END,
+        last_seen = GREATEST(question_stats.last_seen, EXCLUDED.last_seen)
+""")
+
+
+def _upsert_params(entries: List[dict]) -> dict:
+    # Sorted by key: concurrent flushes lock rows in the same order (no deadlocks)
+    entries = sorted(entries, key=lambda e: e["question_hash"])
+    return {
+        "hashes": [e["question_hash"] for e in entries],
+        "questions": [e["question"] for e in entries],
+        "counts": [e["total_count"] for e in entries],
+        "scores": [e["log_score"] for e in entries],
+        "seen": [e["last_seen"] for e in entries],
+    }
+
+
+async def update_question_stats(conn, rows: List[dict]):
+    """
+    Add freshly logged chat_logs rows to question_stats, on the caller's (async) connection
+    so the counts commit together with the rows.
+    """
+    entries = aggregate(rows, get_hot_questions_config()["half_life_hours"])
+    if entries:
+        await conn.execute(_UPSERT_SQL, _upsert_params(entries))
+
+
+def backfill_question_stats() -> int:
+    """
+    One-off: build question_stats from chat_logs until the question_stats_backfill marker
+    exists. Log flushes may already have counted some rows, so the table is rebuilt from
+    scratch under an exclusive lock: a flush commits its chat_logs rows and their stats
+    together, so every chat_logs row visible here is either already in question_stats
+    (and recounted after the DELETE) or waits on the lock and is added after the backfill.
+    """
+    half_life_hours = get_hot_questions_config()["half_life_hours"]
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE question_stats IN EXCLUSIVE MODE"))
+        if conn.execute(text("SELECT 1 FROM question_stats_backfill")).fetchone():
+            return 0
+        conn.execute(text("DELETE FROM question_stats"))
+        # Per exact question text: count, last ask and the log-sum of the decay weights
+        rows = conn.execute(text("""
+            WITH weighted AS (
+                SELECT question, created_at,
+                       :rate * EXTRACT(EPOCH FROM (created_at - :epoch)) / 3600 AS w
+                FROM chat_logs
+                WHERE intent IS DISTINCT FROM 'chat' AND created_at IS NOT NULL
+            ), peak AS (
+                SELECT question, MAX(w) AS max_w FROM weighted GROUP BY question
+            )
+            SELECT weighted.question, COUNT(*), MAX(weighted.created_at),
+                   peak.max_w + LN(SUM(EXP(weighted.w - peak.max_w)))
+            FROM weighted JOIN peak USING (question)
+            GROUP BY weighted.question, peak.max_w
+        """), {"rate": math.log(2) / half_life_hours, "epoch": EPOCH}).fetchall()
+        entries = aggregate(
+            [{"question": row[0], "count": row[1], "created_at": row[2], "log_score": float(row[3])} for row in rows],
+            half_life_hours
+        )
+        for start in range(0, len(entries), BACKFILL_BATCH_SIZE):
+            conn.execute(_UPSERT_SQL, _upsert_params(entries[start:start + BACKFILL_BATCH_SIZE]))
+        conn.execute(text("INSERT INTO question_stats_backfill DEFAULT VALUES ON CONFLICT DO NOTHING"))
+    if entries:
+        print(f"✅ Backfilled question_stats with {len(entries)} questions from chat_logs")
+    return len(entries)
+
+
+def start_question_stats_backfill():
+    def run():
+        try:
+            backfill_question_stats()
+        except Exception as e:
+            print(f"Error backfilling question_stats: {e}")
+
+    thread = threading.Thread(target=run, name="question-stats-backfill", daemon=True)
+    thread.start()
+    return thread
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = sum(x * x for x in a) ** 0.5
+    norm_b = sum(y * y for y in b) ** 0.5
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+def _candidate_vectors(conn, rows) -> Dict[str, List[float]]:
+    """
+    Question embeddings for clustering: stored ones, missing ones computed and stored.
+    """
+    from llm.embedding import embed_batch, embedding_model_id
+
+    model_id = embedding_model_id()
+    vectors = {row[0]: parse_vector(row[2]) for row in rows if row[2] is not None and row[3] == model_id}
+    missing = [row for row in rows if row[0] not in vectors]
+    if missing:
+        new_vectors = embed_batch([row[1] for row in missing])
+        conn.execute(
+            text("UPDATE question_stats SET embedding = CAST(:embedding AS vector), embedding_model = :model WHERE question_hash = :hash"),
+            [{"hash": row[0], "embedding": vector_literal(vector), "model": model_id}
+             for row, vector in zip(missing, new_vectors) if vector]
+        )
+        conn.commit()
+        vectors.update({row[0]: vector for row, vector in zip(missing, new_vectors) if vector})
+    return vectors
+
+
+def query_hot_questions(limit: int) -> List[str]:
+    cfg = get_hot_questions_config()
+    with engine.connect() as conn:
+        if not cfg["cluster"]:
+            rows = conn.execute(
+                text("SELECT question FROM question_stats ORDER BY log_score DESC LIMIT :limit"),
+                {"limit": limit}
+            ).fetchall()
+            return [row[0] for row in rows]
+
+        rows = conn.execute(
+            text("""
+                SELECT question_hash, question, embedding, embedding_model FROM question_stats
+                ORDER BY log_score DESC LIMIT :limit
+            """),
+            {"limit": max(limit, cfg["cluster_candidates"])}
+        ).fetchall()
+        try:
+            vectors = _candidate_vectors(conn, rows)
+        except Exception as e:
+            print(f"Error embedding hot questions (showing them unclustered): {e}")
+            vectors = {}
+
+    # Greedy: highest score first, skip phrasings too close to one already shown
+    picked, picked_vectors = [], []
+    for row in rows:
+        vector = vectors.get(row[0])
+        if vector is not None and any(_cosine(vector, v) >= cfg["cluster_threshold"] for v in picked_vectors):
+            continue
+        picked.append(row[1])
+        if vector is not None:
+            picked_vectors.append(vector)
+        if len(picked) >= limit:
+            break
+    return picked
+
+
+_cache = {"expires": 0.0, "questions": None}
+_cache_lock = threading.Lock()
+
+
+def cached_hot_questions() -> List[str]:
+    """
+    Top questions by decayed score, cached in process for cache_ttl seconds.
+    Raises on database errors (the endpoint falls back to the question journal).
+    """
+    cfg = get_hot_questions_config()
+    now = time.monotonic()
+    if _cache["questions"] is not None and now < _cache["expires"]:
+        return _cache["questions"]
+    with _cache_lock:
+        if _cache["questions"] is not None and time.monotonic() < _cache["expires"]:
+            return _cache["questions"]
+        questions = query_hot_questions(cfg["limit"])
+        _cache["questions"] = questions
+        _cache["expires"] = time.monotonic() + cfg["cache_ttl"]
+    return questions
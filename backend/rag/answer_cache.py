@@ -0,0 +1,215 @@
+import json
+import threading
+from typing import List, Optional
+from sqlalchemy import text
+from db import engine
+from config_loader import config
+from rag.embedding_store import vector_literal
+from rag.schema import COMMON_KB
+
+# Semantic answer cache: questions whose embedding is within a cosine threshold of a
+# previously answered question (same KB scope, same embedding model) reuse its answer.
+#
+# Invalidation:
+#   - deleted chunks: entries whose chunk_ids overlap them are deleted in the same
+#     transaction (GIN index on chunk_ids); entries for other documents survive
+#   - added chunks (may change the best answer): kb_generation keeps one counter per
+#     kb_type, bumped in its own short transaction right after the documents commit
+#     (no row lock held for the whole ingest). An entry is tagged with the sum of the
+#     counters its scope reads (kb_type + common, or all for 'all') and only matches
+#     while that sum is unchanged.
+
+
+def get_answer_cache_config() -> dict:
+    cache_config = (config.rag or {}).get("answer_cache", {}) or {}
+    return {
+        "enabled": bool(cache_config.get("enabled", True)),
+        # Cosine similarity (1 - cosine distance) required for a hit
+        "threshold": float(cache_config.get("threshold", 0.95)),
+        "ttl_hours": float(cache_config.get("ttl_hours", 24)),
+    }
+
+
+def ensure_answer_cache_table():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS kb_generation (
+                name VARCHAR(50) PRIMARY KEY,
+                generation BIGINT NOT NULL DEFAULT 0
+            )
+        """))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id SERIAL PRIMARY KEY,
+                model VARCHAR(200) NOT NULL,
+                kb_type VARCHAR(20) NOT NULL,
+                generation BIGINT NOT NULL,
+                question TEXT NOT NULL,
+                embedding vector(1024) NOT NULL,
+                answer TEXT NOT NULL,
+                sources JSONB,
+                chunk_ids INTEGER[],
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        # Cosine distance regardless of rag.vector_index.metric: the threshold is a similarity
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS answer_cache_embedding_idx ON answer_cache USING hnsw (embedding vector_cosine_ops)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS answer_cache_generation_idx ON answer_cache (generation)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS answer_cache_chunk_ids_idx ON answer_cache USING gin (chunk_ids)"))
+
+
+def bump_kb_generation(kb_type: Optional[str]):
+    """
+    Call after the transaction that added chunks to kb_type has committed. Bumping
+    after the commit is safe: a lookup in between can only tag its entry with the old
+    value, which this bump then invalidates.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                INSERT INTO kb_generation (name, generation) VALUES (:name, 1)
+                ON CONFLICT (name) DO UPDATE SET generation = kb_generation.generation + 1
+            """),
+            {"name": kb_type or COMMON_KB}
+        )
+
+
+def invalidate_chunks(conn, chunk_ids: List[int]) -> int:
+    """
+    Call inside the transaction that deletes the chunks. Returns entries dropped.
+    """
+    if not chunk_ids:
+        return 0
+    return conn.execute(
+        text("DELETE FROM answer_cache WHERE chunk_ids && CAST(:ids AS INTEGER[])"),
+        {"ids": list(chunk_ids)}
+    ).rowcount
+
+
+def current_generation(conn, kb_type: str) -> int:
+    if kb_type == "all":
+        return conn.execute(text("SELECT COALESCE(SUM(generation), 0) FROM kb_generation")).scalar()
+    return conn.execute(
+        text("SELECT COALESCE(SUM(generation), 0) FROM kb_generation WHERE name IN (:kb_type, :common_kb)"),
+        {"kb_type": kb_type, "common_kb": COMMON_KB}
+    ).scalar()
+
+
+class AnswerCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def record(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+stats = AnswerCacheStats()
+
+
+def lookup_answer(model_id: str, kb_type: str, query_embedding: List[float]) -> Optional[dict]:
+    """
+    Returns {"answer", "sources", "generation", "similarity"} on a hit.
+    On a miss returns {"generation": ...} so the caller can tag the new entry
+    with the KB state it started from; None when the cache is unavailable.
+    """
+    cfg = get_answer_cache_config()
+    if not cfg["enabled"]:
+        return None
+    try:
+        with engine.begin() as conn:
+            generation = current_generation(conn, kb_type)
+            row = conn.execute(
+                text("""
+                    SELECT id, answer, sources, 1 - (embedding <=> CAST(:embedding AS vector)) AS similarity
+                    FROM answer_cache
+                    WHERE model = :model AND kb_type = :kb_type AND generation = :generation
+                      AND created_at > CURRENT_TIMESTAMP - make_interval(hours => :ttl_hours)
+                    ORDER BY embedding <=> CAST(:embedding AS vector)
+                    LIMIT 1
+                """),
+                {
+                    "embedding": vector_literal(query_embedding),
+                    "model": model_id,
+                    "kb_type": kb_type,
+                    "generation": generation,
+                    "ttl_hours": cfg["ttl_hours"],
+                }
+            ).fetchone()
+            if row and row[3] >= cfg["threshold"]:
+                conn.execute(text("UPDATE answer_cache SET hits = hits + 1 WHERE id = :id"), {"id": row[0]})
+                stats.record("hits")
+                return {"answer": row[1], "sources": row[2] or [], "generation": generation, "similarity": float(row[3])}
+    except Exception as e:
+        stats.record("errors")
+        print(f"Error reading answer cache: {e}")
+        return None
+
+    stats.record("misses")
+    return {"generation": generation}
+
+
+def store_answer(model_id: str, kb_type: str, generation: int, question: str,
+                 query_embedding: List[float], answer: str, sources: list, chunk_ids: list):
+    if not get_answer_cache_config()["enabled"]:
+        return
+    try:
+        with engine.begin() as conn:
+            # Entries of this scope from older KB generations can never hit again
+            conn.execute(
+                text("DELETE FROM answer_cache WHERE kb_type = :kb_type AND generation < :generation"),
+                {"kb_type": kb_type, "generation": generation}
+            )
+            # Skipped if a chunk was deleted while the answer was generated
+            conn.execute(
+                text("""
+                    INSERT INTO answer_cache (model, kb_type, generation, question, embedding, answer, sources, chunk_ids)
+                    SELECT :model, :kb_type, :generation, :question, CAST(:embedding AS vector), :answer,
+                           CAST(:sources AS jsonb), CAST(:chunk_ids AS INTEGER[])
+                    WHERE (SELECT COUNT(*) FROM documents WHERE id = ANY(CAST(:chunk_ids AS INTEGER[])))
+                          = cardinality(CAST(:chunk_ids AS INTEGER[]))
+                """),
+                {
+                    "model": model_id,
+                    "kb_type": kb_type,
+                    "generation": generation,
+                    "question": question,
+                    "embedding": vector_literal(query_embedding),
+                    "answer": answer,
+                    "sources": json.dumps(sources, ensure_ascii=False),
+                    "chunk_ids": list(chunk_ids),
+                }
+            )
+        stats.record("stores")
+    except Exception as e:
+        stats.record("errors")
+        print(f"Error writing answer cache: {e}")
+
+
+def is_cacheable(answer: Optional[str]) -> bool:
+    # Never cache provider failures (clients report them as text)
+    if not answer:
+        return False
+    return not (answer.startswith("Error") or answer.startswith("调用 LLM 失败"))
+
+
+def get_answer_cache_stats() -> dict:
+    return {"enabled": get_answer_cache_config()["enabled"], **stats.to_dict()}
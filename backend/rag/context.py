@@ -0,0 +1,169 @@
+import re
+from typing import List, Optional
+from config_loader import config
+
+# Context assembly: turns retrieved chunks into the 【参考文档】 block of the prompt.
+#   - identical chunks are kept once
+#   - consecutive chunks of the same document are merged, dropping the text that
+#     split_ops_doc repeats between neighbours (chunk_overlap)
+#   - only citation fields are rendered (filename, section, upload date), not the metadata JSON
+#   - blocks are added in retrieval-score order until the token budget is used up
+
+# Longest overlap looked for between neighbouring chunks (split_ops_doc uses 100 characters)
+MAX_OVERLAP_CHARS = 200
+
+# Section headings used as split points by split_ops_doc
+SECTION_HEADINGS = ("处理步骤", "故障现象", "告警说明", "注意事项")
+
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+NO_CONTEXT = "（未检索到相关文档）"
+
+
+def get_context_config() -> dict:
+    context_config = (config.rag or {}).get("context", {}) or {}
+    return {
+        "max_tokens": int(context_config.get("max_tokens", 3000)),
+        # approx: no dependency, no network; tiktoken: exact for OpenAI-family BPE vocabularies
+        "tokenizer": str(context_config.get("tokenizer", "approx")).lower(),
+        "tiktoken_encoding": context_config.get("tiktoken_encoding", "cl100k_base"),
+    }
+
+
+def approximate_tokens(text: str) -> int:
+    # CJK characters are roughly one token each, other text roughly four characters per token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+_encoder = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoder
+    cfg = get_context_config()
+    if cfg["tokenizer"] == "tiktoken":
+        if _encoder is None:
+            try:
+                import tiktoken
+                _encoder = tiktoken.get_encoding(cfg["tiktoken_encoding"])
+            except Exception as e:
+                # Offline hosts cannot download the BPE file: stay on the approximation
+                print(f"Warning: tiktoken unavailable ({e}), using approximate token counts")
+                _encoder = False
+        if _encoder:
+            return len(_encoder.encode(text))
+    return approximate_tokens(text)
+
+
+def strip_overlap(previous: str, current: str) -> str:
+    """
+    Remove the prefix of current that repeats the end of previous.
+    """
+    limit = min(len(previous), len(current), MAX_OVERLAP_CHARS)
+    for size in range(limit, 0, -1):
+        if previous.endswith(current[:size]):
+            return current[size:]
+    return current
+
+
+def detect_section(content: str) -> Optional[str]:
+    first_line = content.lstrip().split("\n", 1)[0].strip()
+    for heading in SECTION_HEADINGS:
+        if first_line.startswith(heading):
+            return first_line[:50]
+    return None
+
+
+class ContextBlock:
+    def __init__(self, rank: int, doc):
+        # doc structure: (id, content, metadata, distance, chunk_index)
+        metadata = doc[2] or {}
+        self.rank = rank
+        self.metadata = metadata
+        self.source = metadata.get("source")
+        self.chunk_indexes = [doc[4] if len(doc) > 4 else None]
+        self.content = doc[1] or ""
+
+    def mergeable(self) -> bool:
+        # Learned QA entries share a source but are separate documents
+        return (self.source is not None and self.chunk_indexes[0] is not None
+                and self.metadata.get("type") != "learned_qa")
+
+    def try_merge(self, other: "ContextBlock") -> bool:
+        if not (self.mergeable() and other.mergeable() and self.source == other.source):
+            return False
+        if other.chunk_indexes[0] == self.chunk_indexes[-1] + 1:
+            self.content += strip_overlap(self.content, other.content)
+            self.chunk_indexes = self.chunk_indexes + other.chunk_indexes
+        elif other.chunk_indexes[-1] + 1 == self.chunk_indexes[0]:
+            self.content = other.content + strip_overlap(other.content, self.content)
+            self.chunk_indexes = other.chunk_indexes + self.chunk_indexes
+        else:
+            return False
+        self.rank = min(self.rank, other.rank)
+        return True
+
+    def render(self, number: int, content: Optional[str] = None) -> str:
+        content = self.content if content is None else content
+        header = f"【文档 {number}】"
+        filename = self.metadata.get("filename")
+        if filename:
+            header += f"《{filename}》"
+        section = self.metadata.get("section") or detect_section(content)
+        if section:
+            header += f" 章节：{section}"
+        upload_time = self.metadata.get("upload_time") or self.metadata.get("created_at")
+        if upload_time:
+            header += f"（上传时间：{str(upload_time)[:10]}）"
+        return f"{header}\n{content.strip()}\n"
+
+
+def merge_blocks(docs) -> List[ContextBlock]:
+    blocks = []
+    seen_contents = set()
+    for rank, doc in enumerate(docs):
+        key = (doc[1] or "").strip()
+        if not key or key in seen_contents:
+            continue
+        seen_contents.add(key)
+        block = ContextBlock(rank, doc)
+        # A chunk can bridge two blocks (chunks 3 and 5 retrieved, then 4): merge repeatedly
+        merged = True
+        while merged:
+            merged = False
+            for existing in blocks:
+                if existing.try_merge(block):
+                    blocks.remove(existing)
+                    block = existing
+                    merged = True
+                    break
+        blocks.append(block)
+    return sorted(blocks, key=lambda b: b.rank)
+
+
+def build_context(docs, max_tokens: Optional[int] = None) -> str:
+    """
+    docs: retrieved rows, best first.
+    """
+    if not docs:
+        return NO_CONTEXT
+    budget = max_tokens or get_context_config()["max_tokens"]
+
+    rendered = []
+    used = 0
+    for block in merge_blocks(docs):
+        text = block.render(len(rendered) + 1)
+        tokens = count_tokens(text)
+        if used + tokens <= budget:
+            rendered.append(text)
+            used += tokens
+        elif not rendered:
+            # Best block alone exceeds the budget: keep its beginning rather than nothing
+            content = block.content
+            while content and count_tokens(block.render(1, content)) > budget:
+                content = content[:int(len(content) * 0.8)]
+            if content:
+                rendered.append(block.render(1, content))
+            break
+    return "\n".join(rendered) if rendered else NO_CONTEXT
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import threading
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import text
+from db import engine
+
+# Chunk embedding store: (embedding model, sha256(chunk text)) -> vector.
+# Re-ingesting a document only calls the embedding service for chunks whose text
+# was never embedded by the current model.
+
+
+def content_hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def ensure_embedding_store_table():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                model VARCHAR(200) NOT NULL,
+                content_hash VARCHAR(64) NOT NULL,
+                embedding vector(1024) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (model, content_hash)
+            )
+        """))
+
+
+def seed_embedding_store(model_id: str) -> int:
+    """
+    First run for a model: copy the vectors of chunks already in documents so the first
+    re-upload does not re-embed everything. Only chunks whose documents.embedding_model
+    is this model are copied; chunks of unknown or other models are embedded again.
+    """
+    with engine.begin() as conn:
+        seeded = conn.execute(
+            text("SELECT EXISTS (SELECT 1 FROM chunk_embeddings WHERE model = :model)"),
+            {"model": model_id}
+        ).scalar()
+        if seeded:
+            return 0
+        result = conn.execute(
+            text("""
+                INSERT INTO chunk_embeddings (model, content_hash, embedding)
+                SELECT :model, encode(sha256(convert_to(content, 'UTF8')), 'hex'), embedding
+                FROM documents
+                WHERE embedding_model = :model AND content IS NOT NULL AND embedding IS NOT NULL
+                ON CONFLICT DO NOTHING
+            """),
+            {"model": model_id}
+        )
+    if result.rowcount:
+        print(f"Seeded chunk embedding store with {result.rowcount} vectors")
+    return result.rowcount or 0
+
+
+def start_embedding_store_seed(model_id: str):
+    # Reads every chunk of the model: in the background, like the other backfills
+    def run():
+        try:
+            seed_embedding_store(model_id)
+        except Exception as e:
+            print(f"Error seeding chunk embedding store: {e}")
+
+    thread = threading.Thread(target=run, name="embedding-store-seed", daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_vector(value) -> List[float]:
+    # Without pgvector's psycopg2 adapter, vectors come back as '[0.1,0.2,...]'
+    if isinstance(value, str):
+        return json.loads(value)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return list(value)
+
+
+def lookup_embeddings(conn, model_id: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+    hashes = list(set(hashes))
+    if not hashes:
+        return {}
+    rows = conn.execute(
+        text("""
+            SELECT content_hash, embedding FROM chunk_embeddings
+            WHERE model = :model AND content_hash = ANY(:hashes)
+        """),
+        {"model": model_id, "hashes": hashes}
+    ).fetchall()
+    return {row[0]: parse_vector(row[1]) for row in rows}
+
+
+def vector_literal(vector) -> str:
+    # pgvector text input; cheaper to send and parse than a numeric[] array
+    return "[" + ",".join(str(float(x)) for x in vector) + "]"
+
+
+def save_embeddings(conn, model_id: str, items: List[Tuple[str, List[float]]]):
+    if not items:
+        return
+    # Single statement for the whole batch: parallel arrays unnested server-side
+    conn.execute(
+        text("""
+            INSERT INTO chunk_embeddings (model, content_hash, embedding)
+            SELECT :model, t.hash, CAST(t.embedding AS vector)
+            FROM unnest(CAST(:hashes AS text[]), CAST(:embeddings AS text[])) AS t(hash, embedding)
+            ON CONFLICT DO NOTHING
+        """),
+        {
+            "model": model_id,
+            "hashes": [h for h, _ in items],
+            "embeddings": [vector_literal(vector) for _, vector in items],
+        }
+    )
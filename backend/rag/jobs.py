@@ -0,0 +1,382 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from typing import Optional
+from sqlalchemy import text
+from db import engine
+from config_loader import config
+
+# Durable ingestion job queue backed by Postgres.
+# Jobs are claimed with FOR UPDATE SKIP LOCKED, so any number of workers
+# (threads in the API process or `python ingest_worker.py --processes N`) can share it.
+
+JOB_COLUMNS = """
+    id, kind, status, payload, result, error, progress_done, progress_total,
+    attempts, worker, created_by, created_at, started_at, finished_at
+"""
+
+# Minimum seconds between progress writes for one job
+PROGRESS_INTERVAL = 1.0
+
+
+def get_jobs_config() -> dict:
+    jobs_config = config.jobs or {}
+    return {
+        # Worker threads started inside the API process (0 = rely on ingest_worker.py)
+        "embedded_workers": int(jobs_config.get("embedded_workers", 1)),
+        "poll_interval": float(jobs_config.get("poll_interval", 1.0)),
+        # A running job without heartbeat for this long is assumed crashed and re-queued
+        "stale_after": int(jobs_config.get("stale_after", 600)),
+        "max_attempts": int(jobs_config.get("max_attempts", 3)),
+    }
+
+
+def ensure_jobs_table():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id SERIAL PRIMARY KEY,
+                kind VARCHAR(30) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued', -- queued, running, succeeded, failed
+                payload JSONB,
+                result JSONB,
+                error TEXT,
+                progress_done INTEGER DEFAULT 0,
+                progress_total INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
+                worker VARCHAR(100),
+                created_by VARCHAR(50),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                heartbeat_at TIMESTAMP
+            )
+        """))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ingest_jobs_pending_idx ON ingest_jobs (id) WHERE status IN ('queued', 'running')"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ingest_jobs_created_by_idx ON ingest_jobs (created_by, id)"))
+
+
+def enqueue_job(kind: str, payload: dict, created_by: Optional[str] = None, conn=None) -> int:
+    """
+    conn: insert on the caller's transaction, so the job commits (or not) together
+    with the caller's own writes (e.g. uploaded_files.status)
+    """
+    if conn is None:
+        with engine.begin() as conn:
+            return enqueue_job(kind, payload, created_by, conn)
+    return conn.execute(
+        text("""
+            INSERT INTO ingest_jobs (kind, payload, created_by)
+            VALUES (:kind, CAST(:payload AS jsonb), :created_by)
+            RETURNING id
+        """),
+        {"kind": kind, "payload": json.dumps(payload, ensure_ascii=False), "created_by": created_by}
+    ).scalar()
+
+
+def claim_job(worker_id: str) -> Optional[dict]:
+    cfg = get_jobs_config()
+    with engine.begin() as conn:
+        # Crashed jobs with no attempt left would otherwise stay 'running' forever
+        abandoned = conn.execute(
+            text("""
+                UPDATE ingest_jobs SET
+                    status = 'failed',
+                    error = 'Worker stopped sending heartbeats and no attempts are left',
+                    finished_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM ingest_jobs
+                    WHERE status = 'running' AND attempts >= :max_attempts
+                      AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => :stale)
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, kind, payload
+            """),
+            {"stale": cfg["stale_after"], "max_attempts": cfg["max_attempts"]}
+        ).fetchall()
+        row = conn.execute(
+            text(f"""
+                UPDATE ingest_jobs SET
+                    status = 'running',
+                    worker = :worker,
+                    attempts = attempts + 1,
+                    started_at = CURRENT_TIMESTAMP,
+                    heartbeat_at = CURRENT_TIMESTAMP,
+                    error = NULL
+                WHERE id = (
+                    SELECT id FROM ingest_jobs
+                    WHERE status = 'queued'
+                       OR (status = 'running' AND attempts < :max_attempts
+                           AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => :stale))
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING {JOB_COLUMNS}
+            """),
+            {"worker": worker_id, "stale": cfg["stale_after"], "max_attempts": cfg["max_attempts"]}
+        ).fetchone()
+    for job_id, kind, payload in abandoned:
+        print(f"Job {job_id} ({kind}) abandoned by its worker, marked failed")
+        _run_failure_handler({"id": job_id, "kind": kind, "payload": payload or {}})
+    return job_to_dict(row) if row else None
+
+
+def touch_heartbeat(job_id: int):
+    with engine.begin() as conn:
+        conn.execute(
+            text("UPDATE ingest_jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = :id AND status = 'running'"),
+            {"id": job_id}
+        )
+
+
+def start_heartbeat(job_id: int) -> threading.Event:
+    """
+    Refresh heartbeat_at from a timer thread while the job runs: one embedding batch can
+    take longer than stale_after, and progress is only written between batches.
+    Set the returned event to stop.
+    """
+    stop = threading.Event()
+    interval = max(get_jobs_config()["stale_after"] / 3, 1)
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                touch_heartbeat(job_id)
+            except Exception as e:
+                print(f"Job {job_id}: heartbeat failed: {e}")
+
+    threading.Thread(target=beat, name=f"job-{job_id}-heartbeat", daemon=True).start()
+    return stop
+
+
+def update_progress(job_id: int, done: int, total: int):
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE ingest_jobs
+                SET progress_done = :done, progress_total = :total, heartbeat_at = CURRENT_TIMESTAMP
+                WHERE id = :id
+            """),
+            {"id": job_id, "done": done, "total": total}
+        )
+
+
+def finish_job(job_id: int, result: dict):
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE ingest_jobs
+                SET status = 'succeeded', result = CAST(:result AS jsonb), finished_at = CURRENT_TIMESTAMP
+                WHERE id = :id
+            """),
+            {"id": job_id, "result": json.dumps(result, ensure_ascii=False)}
+        )
+
+
+def fail_job(job_id: int, error: str, retry: bool):
+    with engine.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE ingest_jobs
+                SET status = :status, error = :error, finished_at = CASE WHEN :retry THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = :id
+            """),
+            {"id": job_id, "status": "queued" if retry else "failed", "error": error, "retry": retry}
+        )
+
+
+def job_to_dict(row) -> dict:
+    (job_id, kind, status, payload, result, error, done, total,
+     attempts, worker, created_by, created_at, started_at, finished_at) = row
+
+    timings = {}
+    if started_at and created_at:
+        timings["queued_seconds"] = round((started_at - created_at).total_seconds(), 3)
+    if finished_at and started_at:
+        timings["run_seconds"] = round((finished_at - started_at).total_seconds(), 3)
+
+    return {
+        "id": job_id,
+        "kind": kind,
+        "status": status,
+        "payload": payload,
+        "result": result,
+        "error": error,
+        "progress": {"done": done or 0, "total": total or 0},
+        "attempts": attempts,
+        "worker": worker,
+        "created_by": created_by,
+        "created_at": str(created_at) if created_at else None,
+        "started_at": str(started_at) if started_at else None,
+        "finished_at": str(finished_at) if finished_at else None,
+        "timings": timings,
+    }
+
+
+def get_job(job_id: int) -> Optional[dict]:
+    with engine.connect() as conn:
+        row = conn.execute(
+            text(f"SELECT {JOB_COLUMNS} FROM ingest_jobs WHERE id = :id"),
+            {"id": job_id}
+        ).fetchone()
+    return job_to_dict(row) if row else None
+
+
+def list_jobs(limit: int = 50, status: Optional[str] = None, created_by: Optional[str] = None) -> list:
+    conditions = []
+    params = {"limit": limit}
+    if status:
+        conditions.append("status = :status")
+        params["status"] = status
+    if created_by:
+        conditions.append("created_by = :created_by")
+        params["created_by"] = created_by
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(f"SELECT {JOB_COLUMNS} FROM ingest_jobs {where} ORDER BY id DESC LIMIT :limit"),
+            params
+        ).fetchall()
+    return [job_to_dict(row) for row in rows]
+
+
+# --- job handlers --------------------------------------------------------
+
+def _progress_reporter(job_id: int):
+    last = {"at": 0.0}
+
+    def report(done: int, total: int):
+        now = time.monotonic()
+        if done < total and now - last["at"] < PROGRESS_INTERVAL:
+            return
+        last["at"] = now
+        update_progress(job_id, done, total)
+
+    return report
+
+
+def _run_ingest_file(job: dict, progress) -> dict:
+    from rag.loader import load_document
+
+    payload = job["payload"]
+    file_path = payload["file_path"]
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    chunks = load_document(file_path, payload.get("metadata", {}), kb_type=payload.get("kb_type", "user"), progress=progress)
+    if chunks is None:
+        raise ValueError(f"No text could be extracted from {os.path.basename(file_path)} (empty or unreadable)")
+    if payload.get("upload_id"):
+        # uploaded_files turns 'approved' only once the chunks are in
+        set_upload_status(payload["upload_id"], "approved")
+    return {"file_path": file_path, "chunks": chunks}
+
+
+def set_upload_status(upload_id: int, status: str):
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE uploaded_files SET status = :status WHERE id = :id"), {"id": upload_id, "status": status})
+
+
+def _ingest_file_failed(job: dict):
+    # Approved user uploads go back to the pending list, so the admin can approve again;
+    # direct admin uploads are marked 'failed' (re-approving would ingest into the user KB)
+    upload_id = job["payload"].get("upload_id")
+    if upload_id:
+        set_upload_status(upload_id, job["payload"].get("upload_failed_status", "pending"))
+
+
+def _run_ingest_text(job: dict, progress) -> dict:
+    from rag.loader import load_text_content
+
+    payload = job["payload"]
+    chunks = load_text_content(payload["content"], payload.get("metadata", {}), progress=progress)
+    return {"chunks": chunks}
+
+
+def _run_reprocess(job: dict, progress) -> dict:
+    from rag.sync import sync_upload_dir
+
+    payload = job["payload"]
+    return sync_upload_dir(payload.get("upload_dir", "uploads"), force=payload.get("force", False), progress=progress)
+
+
+JOB_HANDLERS = {
+    "ingest_file": _run_ingest_file,
+    "ingest_text": _run_ingest_text,
+    "reprocess": _run_reprocess,
+}
+
+# Called once a job has failed for good (no retry left)
+JOB_FAILURE_HANDLERS = {
+    "ingest_file": _ingest_file_failed,
+}
+
+
+def run_job(job: dict):
+    handler = JOB_HANDLERS.get(job["kind"])
+    cfg = get_jobs_config()
+    heartbeat = start_heartbeat(job["id"])
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job['kind']}")
+        result = handler(job, _progress_reporter(job["id"]))
+        finish_job(job["id"], result)
+        print(f"Job {job['id']} ({job['kind']}) succeeded")
+    except Exception as e:
+        retry = handler is not None and job["attempts"] < cfg["max_attempts"]
+        print(f"Job {job['id']} ({job['kind']}) failed (attempt {job['attempts']}): {e}")
+        traceback.print_exc()
+        fail_job(job["id"], str(e), retry=retry)
+        if not retry:
+            _run_failure_handler(job)
+    finally:
+        heartbeat.set()
+
+
+def _run_failure_handler(job: dict):
+    handler = JOB_FAILURE_HANDLERS.get(job["kind"])
+    if handler is None:
+        return
+    try:
+        handler(job)
+    except Exception as e:
+        print(f"Error in failure handler of job {job['id']}: {e}")
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def worker_loop(stop_event: threading.Event, worker_id: Optional[str] = None):
+    """
+    Claim and run jobs until stop_event is set. Sleeps poll_interval when the queue is empty.
+    """
+    worker_id = worker_id or default_worker_id()
+    poll_interval = get_jobs_config()["poll_interval"]
+    print(f"Ingestion worker {worker_id} started")
+    while not stop_event.is_set():
+        try:
+            job = claim_job(worker_id)
+        except Exception as e:
+            print(f"Ingestion worker {worker_id}: cannot claim job: {e}")
+            job = None
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+        run_job(job)
+    print(f"Ingestion worker {worker_id} stopped")
+
+
+def start_embedded_workers(stop_event: threading.Event) -> list:
+    threads = []
+    for i in range(get_jobs_config()["embedded_workers"]):
+        thread = threading.Thread(target=worker_loop, args=(stop_event,), name=f"ingest-worker-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,191 @@
+import hashlib
+import threading
+from typing import List, Optional
+from sqlalchemy import text
+from db import engine
+from config_loader import config
+from llm.embedding import embed_text, embed_batch, embedding_model_id
+from llm.embedding_cache import normalize_text
+from rag.embedding_store import vector_literal
+
+# Curated answers (admin "learn" / manual QA) are answered before RAG:
+#   1. exact match on a normalized-question hash (unique index)
+#   2. optional near-match on the question embedding (cosine threshold)
+
+BACKFILL_BATCH_SIZE = 500
+
+# Trailing punctuation that does not change the question ("如何重启？" == "如何重启")
+_TRAILING_PUNCTUATION = "?？!！。.,，;；~～ "
+
+
+def get_learned_qa_config() -> dict:
+    learned_config = (config.rag or {}).get("learned_qa", {}) or {}
+    return {
+        "near_match": bool(learned_config.get("near_match", True)),
+        # Cosine similarity required to serve a curated answer for a differently phrased question
+        "threshold": float(learned_config.get("threshold", 0.92)),
+    }
+
+
+def normalize_question(question: str) -> str:
+    return normalize_text(question).casefold().rstrip(_TRAILING_PUNCTUATION)
+
+
+def question_hash(question: str) -> str:
+    return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+
+
+def ensure_learned_qa_columns():
+    """
+    Add question_hash / embedding columns, backfill hashes, drop duplicates
+    (the newest answer wins, as the old ORDER BY created_at DESC lookup did)
+    and create the unique index.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE learned_qa ADD COLUMN IF NOT EXISTS question_hash VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE learned_qa ADD COLUMN IF NOT EXISTS embedding vector(1024)"))
+        conn.execute(text("ALTER TABLE learned_qa ADD COLUMN IF NOT EXISTS embedding_model VARCHAR(200)"))
+
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("SELECT id, question FROM learned_qa WHERE question_hash IS NULL LIMIT :batch"),
+                {"batch": BACKFILL_BATCH_SIZE}
+            ).fetchall()
+            if not rows:
+                break
+            conn.execute(
+                text("UPDATE learned_qa SET question_hash = :hash WHERE id = :id"),
+                [{"id": row[0], "hash": question_hash(row[1])} for row in rows]
+            )
+
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            DELETE FROM learned_qa a
+            USING learned_qa b
+            WHERE a.question_hash = b.question_hash
+              AND (a.created_at, a.id) < (b.created_at, b.id)
+        """))
+        if result.rowcount:
+            print(f"Removed {result.rowcount} duplicate learned QA entries")
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS learned_qa_question_hash_idx ON learned_qa (question_hash)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS learned_qa_embedding_idx ON learned_qa USING hnsw (embedding vector_cosine_ops)"
+        ))
+
+
+def save_learned_answer(conn, question: str, answer: str) -> int:
+    """
+    Insert or replace the curated answer for a question (normalized). Returns the row id.
+    The embedding is cleared and recomputed by embed_learned_questions().
+    """
+    return conn.execute(
+        text("""
+            INSERT INTO learned_qa (question, answer, question_hash)
+            VALUES (:q, :a, :hash)
+            ON CONFLICT (question_hash) DO UPDATE SET
+                question = EXCLUDED.question,
+                answer = EXCLUDED.answer,
+                created_at = CURRENT_TIMESTAMP,
+                embedding = NULL,
+                embedding_model = NULL
+            RETURNING id
+        """),
+        {"q": question, "a": answer, "hash": question_hash(question)}
+    ).scalar()
+
+
+def embed_learned_questions(ids: Optional[List[int]] = None) -> int:
+    """
+    Compute question embeddings for near-matching: the given rows, or every row
+    missing an embedding for the current model.
+    """
+    model_id = embedding_model_id()
+    total = 0
+    while True:
+        with engine.connect() as conn:
+            if ids is not None:
+                rows = conn.execute(
+                    text("SELECT id, question FROM learned_qa WHERE id = ANY(:ids)"),
+                    {"ids": list(ids)}
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    text("""
+                        SELECT id, question FROM learned_qa
+                        WHERE embedding IS NULL OR embedding_model IS DISTINCT FROM :model
+                        LIMIT :batch
+                    """),
+                    {"model": model_id, "batch": BACKFILL_BATCH_SIZE}
+                ).fetchall()
+        if not rows:
+            break
+
+        vectors = embed_batch([row[1] for row in rows])
+        with engine.begin() as conn:
+            conn.execute(
+                text("UPDATE learned_qa SET embedding = CAST(:embedding AS vector), embedding_model = :model WHERE id = :id"),
+                [{"id": row[0], "embedding": vector_literal(vector), "model": model_id} for row, vector in zip(rows, vectors)]
+            )
+        total += len(rows)
+        if ids is not None:
+            break
+
+    if total and ids is None:
+        print(f"Embedded {total} learned QA questions")
+    return total
+
+
+def start_learned_qa_embedding(ids: Optional[List[int]] = None):
+    """
+    Embed in a daemon thread: the admin request and startup do not wait for the
+    embedding service. Until then the entry is still found by exact match.
+    """
+    if not get_learned_qa_config()["near_match"]:
+        return None
+
+    def run():
+        try:
+            embed_learned_questions(ids)
+        except Exception as e:
+            print(f"Error embedding learned QA questions: {e}")
+
+    thread = threading.Thread(target=run, name="learned-qa-embedding", daemon=True)
+    thread.start()
+    return thread
+
+
+def lookup_learned_answer(question: str, near_match: bool = True) -> Optional[str]:
+    """
+    near_match=False: exact hash lookup only (no embedding call), used for small talk.
+    """
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("SELECT answer FROM learned_qa WHERE question_hash = :hash"),
+            {"hash": question_hash(question)}
+        ).fetchone()
+        if row:
+            return row[0]
+
+    cfg = get_learned_qa_config()
+    if not cfg["near_match"] or not near_match:
+        return None
+
+    # Query embedding goes through the embedding cache, so RAG reuses it on a miss
+    query_embedding = embed_text(question)
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("""
+                SELECT answer, 1 - (embedding <=> CAST(:embedding AS vector)) AS similarity
+                FROM learned_qa
+                WHERE embedding_model = :model
+                ORDER BY embedding <=> CAST(:embedding AS vector)
+                LIMIT 1
+            """),
+            {"embedding": vector_literal(query_embedding), "model": embedding_model_id()}
+        ).fetchone()
+    if row and row[1] >= cfg["threshold"]:
+        return row[0]
+    return None
@@ -0,0 +1,113 @@
+import re
+import threading
+import unicodedata
+from typing import List
+from sqlalchemy import text
+from db import engine
+
+# Keyword channel for hybrid retrieval.
+# Postgres has no Chinese word segmentation out of the box (zhparser is not bundled),
+# so tokens are produced here and stored as a pre-built tsvector:
+#   - CJK runs      -> overlapping bigrams ("天线经纬度" -> 天线 线经 经纬 纬度)
+#   - ASCII words   -> lowercased whole token plus its parts, so alarm codes and
+#                      device models match exactly ("ERR-1024" -> err-1024 err 1024)
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9_.\-/]*|[㐀-䶿一-鿿]+")
+_PART_RE = re.compile(r"[_.\-/]+")
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿]")
+
+# tsvector positions are limited to 16383
+MAX_POSITION = 16383
+MAX_QUERY_TOKENS = 32
+BACKFILL_BATCH_SIZE = 500
+
+
+def tokenize(content: str) -> List[str]:
+    if not content:
+        return []
+    content = unicodedata.normalize("NFKC", content).lower()
+
+    tokens = []
+    for match in _TOKEN_RE.finditer(content):
+        token = match.group(0)
+        if _CJK_RE.match(token):
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            token = token.strip("_.-/")
+            if not token:
+                continue
+            tokens.append(token)
+            parts = [p for p in _PART_RE.split(token) if p]
+            if len(parts) > 1:
+                tokens.extend(parts)
+    return tokens
+
+
+def to_tsvector_literal(content: str) -> str:
+    """
+    Build a tsvector literal ('tok':pos ...) from our own tokens.
+    Cast with CAST(:x AS tsvector) so Postgres does not re-parse the lexemes.
+    """
+    lexemes = []
+    for position, token in enumerate(tokenize(content), 1):
+        lexemes.append(f"'{token}':{min(position, MAX_POSITION)}")
+    return " ".join(lexemes)
+
+
+def to_tsquery_literal(query: str) -> str:
+    """
+    OR-query over the distinct query tokens; ts_rank_cd rewards chunks that match more of them.
+    Returns None when the query has no usable tokens.
+    """
+    seen = []
+    for token in tokenize(query):
+        if token not in seen:
+            seen.append(token)
+        if len(seen) >= MAX_QUERY_TOKENS:
+            break
+    if not seen:
+        return None
+    return " | ".join(f"'{token}'" for token in seen)
+
+
+def backfill_lexical_vectors() -> int:
+    """
+    Fill content_tsv for chunks ingested before the keyword channel existed.
+    """
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("SELECT id, content FROM documents WHERE content_tsv IS NULL LIMIT :batch"),
+                {"batch": BACKFILL_BATCH_SIZE}
+            ).fetchall()
+            if not rows:
+                break
+            conn.execute(
+                text("UPDATE documents SET content_tsv = CAST(:tsv AS tsvector) WHERE id = :id"),
+                [{"id": row[0], "tsv": to_tsvector_literal(row[1] or "")} for row in rows]
+            )
+        total += len(rows)
+
+    if total:
+        print(f"Backfilled keyword index for {total} document chunks")
+    return total
+
+
+def start_lexical_backfill():
+    """
+    Run the backfill in a daemon thread so a large knowledge base does not delay startup.
+    Chunks without content_tsv are simply not found by the keyword channel until then.
+    """
+    def run():
+        try:
+            backfill_lexical_vectors()
+        except Exception as e:
+            print(f"Error backfilling keyword index: {e}")
+
+    thread = threading.Thread(target=run, name="lexical-backfill", daemon=True)
+    thread.start()
+    return thread
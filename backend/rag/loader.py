@@ -1,9 +1,15 @@
 import json
 import os
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
 from db import engine
-from llm.embedding import embed_text
+from llm.embedding import embed_batch, embedding_model_id
 from rag.splitter import split_ops_doc
+from rag.schema import COMMON_KB
+from rag.lexical import to_tsvector_literal
+from rag.manifest import record_manifest
+from rag.embedding_store import content_hash, lookup_embeddings, save_embeddings, vector_literal
+from rag.answer_cache import bump_kb_generation, invalidate_chunks
 
 try:
     from docx import Document
@@ -15,6 +21,12 @@ try:
 except ImportError:
     pd = None
 
+# Define China Timezone
+CN_TZ = timezone(timedelta(hours=8))
+
+def get_current_time_str():
+    return datetime.now(CN_TZ).strftime("%Y-%m-%d %H:%M:%S")
+
 def read_file_content(file_path: str) -> str:
     """
     Read content from file based on extension.
@@ -54,15 +66,17 @@ def delete_document_by_source(source: str):
     """
     try:
         with engine.begin() as conn:
-            conn.execute(
-                text("DELETE FROM documents WHERE metadata->>'source' = :source"),
+            deleted = conn.execute(
+                text("DELETE FROM documents WHERE source = :source RETURNING id"),
                 {"source": source}
-            )
+            ).fetchall()
+            # Only answers built from these chunks are dropped from the answer cache
+            invalidate_chunks(conn, [row[0] for row in deleted])
             print(f"Deleted existing documents for source: {source}")
     except Exception as e:
         print(f"Error deleting existing documents: {e}")
 
-def load_document(file_path: str, metadata: dict, kb_type: str = "user"):
+def load_document(file_path: str, metadata: dict, kb_type: str = "user", progress=None):
     try:
         content = read_file_content(file_path)
     except Exception as e:
@@ -76,27 +90,120 @@ def load_document(file_path: str, metadata: dict, kb_type: str = "user"):
     # Add kb_type to metadata
     metadata["kb_type"] = kb_type
 
-    # Deduplicate before inserting
-    if "source" in metadata:
-        delete_document_by_source(metadata["source"])
+    # Deduplicate: the old version is replaced inside the same write transaction
+    chunk_count = load_text_content(content, metadata, replace_source="source" in metadata, progress=progress)
+
+    # Remember what was ingested so /reprocess_docs can skip unchanged files
+    try:
+        record_manifest(file_path, chunk_count, kb_type=kb_type)
+    except Exception as e:
+        print(f"Error recording manifest for {file_path}: {e}")
+    return chunk_count
+
+def document_columns(metadata: dict) -> dict:
+    """
+    Typed column values for a chunk, promoted out of the metadata JSONB.
+    Chunks without kb_type (learned QA, manual training) are shared by all KBs.
+    """
+    return {
+        "kb_type": metadata.get("kb_type") or COMMON_KB,
+        "source": metadata.get("source"),
+        "filename": metadata.get("filename"),
+        "doc_type": metadata.get("type"),
+        "upload_time": metadata.get("upload_time") or metadata.get("created_at"),
+    }
+
+# Rows per multi-row INSERT statement
+INSERT_PAGE_SIZE = 200
+
+INSERT_COLUMNS = ["content", "metadata", "embedding", "kb_type", "source", "filename", "doc_type", "upload_time", "content_tsv", "chunk_index", "embedding_model"]
+INSERT_CASTS = {"embedding": "vector", "upload_time": "timestamp", "content_tsv": "tsvector"}
 
-    load_text_content(content, metadata)
+def insert_document_rows(conn, rows: list):
+    """
+    Write chunk rows with multi-row INSERTs (one round trip per INSERT_PAGE_SIZE rows).
+    """
+    for start in range(0, len(rows), INSERT_PAGE_SIZE):
+        page = rows[start:start + INSERT_PAGE_SIZE]
+        values = []
+        params = {}
+        for i, row in enumerate(page):
+            placeholders = []
+            for column in INSERT_COLUMNS:
+                name = f"{column}_{i}"
+                params[name] = row[column]
+                if column in INSERT_CASTS:
+                    placeholders.append(f"CAST(:{name} AS {INSERT_CASTS[column]})")
+                else:
+                    placeholders.append(f":{name}")
+            values.append(f"({', '.join(placeholders)})")
+
+        conn.execute(
+            text(f"INSERT INTO documents ({', '.join(INSERT_COLUMNS)}) VALUES {', '.join(values)}"),
+            params
+        )
+
+def load_text_content(content: str, metadata: dict, replace_source: bool = False, progress=None) -> int:
+    """
+    Split, embed and store a document. Returns the number of chunks written.
 
-def load_text_content(content: str, metadata: dict):
+    Phase 1 (no transaction open): reuse stored vectors and call the embedding service
+    for the rest. Phase 2: one short transaction that replaces the old version of the
+    source (if replace_source) and bulk-inserts all chunks, so readers never see a
+    half-loaded document and no connection is held during network calls.
+
+    progress: optional callback progress(done, total) in chunks.
+    """
     chunks = split_ops_doc(content)
+    columns = document_columns(metadata)
+
+    # Reuse vectors of chunks this model has already embedded (unchanged paragraphs)
+    model_id = embedding_model_id()
+    hashes = [content_hash(chunk) for chunk in chunks]
+    with engine.connect() as conn:
+        known = lookup_embeddings(conn, model_id, hashes)
+
+    # Embed the remaining chunks in batches (one request per batch, not per chunk)
+    missing = {}
+    for chunk, chunk_hash in zip(chunks, hashes):
+        if chunk_hash not in known and chunk_hash not in missing:
+            missing[chunk_hash] = chunk
+    reused = len(chunks) - len(missing)
+    if progress:
+        progress(reused, len(chunks))
+    vectors = embed_batch(
+        list(missing.values()),
+        progress=(lambda done: progress(reused + done, len(chunks))) if progress else None
+    )
+    new_embeddings = list(zip(missing.keys(), vectors))
+    known.update(new_embeddings)
+
+    metadata_json = json.dumps(metadata)
+    rows = [
+        {
+            "content": chunk,
+            "metadata": metadata_json,
+            "embedding": vector_literal(known[chunk_hash]),
+            "content_tsv": to_tsvector_literal(chunk),
+            # Position in the document: lets the context builder merge neighbouring chunks
+            "chunk_index": index,
+            "embedding_model": model_id,
+            **columns
+        }
+        for index, (chunk, chunk_hash) in enumerate(zip(chunks, hashes))
+    ]
 
     with engine.begin() as conn:
+        if replace_source and columns["source"]:
+            deleted = conn.execute(
+                text("DELETE FROM documents WHERE source = :source RETURNING id"),
+                {"source": columns["source"]}
+            ).fetchall()
+            invalidate_chunks(conn, [row[0] for row in deleted])
+        insert_document_rows(conn, rows)
+        save_embeddings(conn, model_id, new_embeddings)
+    # New chunks may change answers of this KB (and of 'all'); other KBs keep their cache
+    bump_kb_generation(columns["kb_type"])
 
-        for chunk in chunks:
-            vector = embed_text(chunk)
-            conn.execute(
-                text("""
-                    INSERT INTO documents (content, metadata, embedding)
-                    VALUES (:content, :metadata, :embedding)
-                """),
-                {
-                    "content": chunk,
-                    "metadata": json.dumps(metadata),
-                    "embedding": vector
-                }
-            )
+    print(f"Loaded {len(chunks)} chunks ({reused} reused, {len(new_embeddings)} embedded)")
+    return len(chunks)
@@ -0,0 +1,72 @@
+import hashlib
+import os
+from typing import Optional
+from sqlalchemy import text
+from db import engine
+
+# File manifest for incremental sync of the uploads directory.
+# One row per ingested file: what was on disk when it was ingested and how many chunks it produced.
+
+# Bump when splitting/cleaning changes, so the next sync re-ingests every file
+INGEST_VERSION = 1
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def ensure_manifest_table():
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS file_manifest (
+                path TEXT PRIMARY KEY,
+                size BIGINT,
+                mtime DOUBLE PRECISION,
+                sha256 VARCHAR(64),
+                ingest_version INTEGER,
+                chunk_count INTEGER,
+                kb_type VARCHAR(20),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def record_manifest(path: str, chunk_count: int, kb_type: Optional[str] = None,
+                    sha256: Optional[str] = None, conn=None):
+    """
+    Upsert the manifest row for a file after it has been ingested.
+    chunk_count/kb_type = None keeps the stored value (stat refresh only).
+    """
+    stat = os.stat(path)
+    params = {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": sha256 or file_sha256(path),
+        "version": INGEST_VERSION,
+        "chunks": chunk_count,
+        "kb_type": kb_type,
+    }
+    sql = text("""
+        INSERT INTO file_manifest (path, size, mtime, sha256, ingest_version, chunk_count, kb_type, updated_at)
+        VALUES (:path, :size, :mtime, :sha256, :version, :chunks, :kb_type, CURRENT_TIMESTAMP)
+        ON CONFLICT (path) DO UPDATE SET
+            size = EXCLUDED.size,
+            mtime = EXCLUDED.mtime,
+            sha256 = EXCLUDED.sha256,
+            ingest_version = EXCLUDED.ingest_version,
+            chunk_count = COALESCE(EXCLUDED.chunk_count, file_manifest.chunk_count),
+            kb_type = COALESCE(EXCLUDED.kb_type, file_manifest.kb_type),
+            updated_at = CURRENT_TIMESTAMP
+    """)
+    if conn is not None:
+        conn.execute(sql, params)
+    else:
+        with engine.begin() as conn:
+            conn.execute(sql, params)
@@ -1,53 +1,76 @@
 # rag/qa.py
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Tuple
+import asyncio
 import os
-from rag.retriever import retrieve_similar_documents
+import time
+from rag.retriever import retrieve_similar_documents, aretrieve_similar_documents
+from rag.context import build_context
+from rag.rerank import get_reranker, get_rerank_config, recall_depth
+from rag.timings import StageTimings, record_timings
+from rag.answer_cache import lookup_answer, store_answer, is_cacheable
+from rag.router import INTENT_CHAT, INTENT_OPS, get_router_config, route_question, route_embedding
+from llm.embedding import embed_text, aembed_text, embedding_model_id
 
 from llm.factory import get_llm_client
 
-def call_llm(prompt: str, image: Optional[str] = None) -> str:
+def _vision_model(provider: str) -> Optional[str]:
+    # 如果有图片，强制使用支持视觉的模型
+    if provider == "zhipu":
+        return "glm-4v"
+    elif provider == "ollama":
+        return "llava" # 假设 ollama 使用 llava
+    return None
+
+
+def build_messages(prompt: str, image: Optional[str], provider: str) -> List[dict]:
+    # 构造对话历史
+    if image:
+        if provider == "zhipu":
+            return [{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": image}}
+                ]
+            }]
+        # Ollama vision format might vary, simple fallback or standard
+        # 目前主要支持 Zhipu GLM-4V
+        return [{"role": "user", "content": prompt, "images": [image]}] # Ollama often uses 'images' field
+    return [{"role": "user", "content": prompt}]
+
+
+def call_llm(prompt: str, image: Optional[str] = None, max_tokens: Optional[int] = None) -> str:
     """
     调用统一 LLM 接口生成回答
     支持 ZhipuAI 和 Ollama (通过 LLM_PROVIDER 环境变量切换)
     """
     try:
         provider = os.getenv("LLM_PROVIDER", "zhipu").lower()
-        
-        # 如果有图片，强制使用支持视觉的模型
-        model = None
-        if image:
-            if provider == "zhipu":
-                model = "glm-4v"
-            elif provider == "ollama":
-                model = "llava" # 假设 ollama 使用 llava
-        
-        client = get_llm_client(model=model)
-        
-        # 构造对话历史
-        messages = []
-        if image:
-            if provider == "zhipu":
-                messages = [{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": image}}
-                    ]
-                }]
-            else:
-                # Ollama vision format might vary, simple fallback or standard
-                # 假设 Ollama 客户端能处理 content list 或者我们需要在这里适配
-                # 这里暂时假设 OllamaClient 需要适配，或者简单处理
-                # 目前主要支持 Zhipu GLM-4V
-                messages = [{"role": "user", "content": prompt, "images": [image]}] # Ollama often uses 'images' field
-        else:
-            messages = [{"role": "user", "content": prompt}]
-            
-        return client.chat(messages)
+        client = get_llm_client(model=_vision_model(provider) if image else None)
+        return client.chat(build_messages(prompt, image, provider), max_tokens=max_tokens)
     except Exception as e:
         return f"调用 LLM 失败: {str(e)}"
 
 
+async def acall_llm(prompt: str, image: Optional[str] = None, max_tokens: Optional[int] = None) -> str:
+    try:
+        provider = os.getenv("LLM_PROVIDER", "zhipu").lower()
+        client = get_llm_client(model=_vision_model(provider) if image else None)
+        return await client.achat(build_messages(prompt, image, provider), max_tokens=max_tokens)
+    except Exception as e:
+        return f"调用 LLM 失败: {str(e)}"
+
+
+async def astream_llm(prompt: str, image: Optional[str] = None, max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+    try:
+        provider = os.getenv("LLM_PROVIDER", "zhipu").lower()
+        client = get_llm_client(model=_vision_model(provider) if image else None)
+        async for chunk in client.astream_chat(build_messages(prompt, image, provider), max_tokens=max_tokens):
+            yield chunk
+    except Exception as e:
+        yield f"调用 LLM 失败: {str(e)}"
+
+
 SYSTEM_PROMPT = """你是一名资深运维工程师助手。
 
 你的任务是根据用户问题和提供的【参考文档】进行回答。
@@ -78,25 +101,6 @@ CHAT_PROMPT = """你是一名资深运维工程师助手。
 """
 
 
-def build_context(docs):
-    context_parts = []
-    for i, doc in enumerate(docs, 1):
-        # doc structure: (id, content, metadata, distance)
-        content = doc[1]
-        metadata = doc[2]
-        
-        context_parts.append(
-            f"""【文档 {i}】
-内容：
-{content}
-
-元数据：
-{metadata}
-"""
-        )
-    return "\n".join(context_parts)
-
-
 def build_prompt(question: str, context: str) -> str:
     return f"""
 【参考文档】
@@ -106,37 +110,230 @@ def build_prompt(question: str, context: str) -> str:
 {question}
 """
 
-def answer_question(question: str, image: Optional[str] = None, kb_type: str = "user") -> Dict:
-    # 1. 检索 (传入 kb_type)
-    docs = retrieve_similar_documents(question, kb_type=kb_type)
+def build_chat_prompt(question: str) -> str:
+    # 闲聊：不检索，不带参考文档
+    return f"{CHAT_PROMPT}\n\n【用户问题】\n{question}\n"
 
+def collect_sources(docs) -> List[Dict]:
     sources = []
     seen_filenames = set()
-    if docs:
-        for doc in docs:
-            # doc structure: (id, content, metadata, distance)
-            meta = doc[2]
-            if meta and "filename" in meta:
-                filename = meta.get("filename")
-                if filename not in seen_filenames:
-                    sources.append({
-                        "id": doc[0],
-                        "filename": filename,
-                        "source": meta.get("source"),
-                        "score": doc[3] if len(doc) > 3 else 0.0
-                    })
-                    seen_filenames.add(filename)
+    for doc in docs or []:
+        # doc structure: (id, content, metadata, distance)
+        meta = doc[2]
+        if meta and "filename" in meta:
+            filename = meta.get("filename")
+            if filename not in seen_filenames:
+                sources.append({
+                    "id": doc[0],
+                    "filename": filename,
+                    "source": meta.get("source"),
+                    "score": doc[3] if len(doc) > 3 else 0.0
+                })
+                seen_filenames.add(filename)
+    return sources
+
+
+def assemble_prompt(question: str, docs) -> Tuple[str, List[Dict]]:
+    sources = collect_sources(docs)
 
     # 2. 构建 Prompt
-    context = build_context(docs) if docs else "（未检索到相关文档）"
-    
+    # 去重、合并相邻分块、按 token 预算截取 (rag/context.py)
+    context = build_context(docs)
+
     # 组合 System Prompt 和 User Prompt
     full_prompt = f"{SYSTEM_PROMPT}\n\n{build_prompt(question, context)}"
+    return full_prompt, sources
+
+
+class PreparedAnswer:
+    """
+    Retrieval result for one question: the prompt to send, the sources to show, and
+    what the answer cache needs to store the answer afterwards. A cache hit carries
+    the cached answer instead of a prompt. timings collects per-stage latency.
+    intent is the router's decision; chat answers are capped at max_tokens.
+    """
+    def __init__(self, question: str, kb_type: str, sources: List[Dict], prompt: Optional[str] = None,
+                 cached_answer: Optional[str] = None, cache_entry: Optional[Dict] = None,
+                 timings: Optional[StageTimings] = None, intent: str = INTENT_OPS,
+                 max_tokens: Optional[int] = None):
+        self.question = question
+        self.kb_type = kb_type
+        self.sources = sources
+        self.prompt = prompt
+        self.cached_answer = cached_answer
+        self.cache_entry = cache_entry
+        self.timings = timings or StageTimings()
+        self.intent = intent
+        self.max_tokens = max_tokens
+
+    def store(self, answer: str):
+        # cache_entry is None for image questions, cache hits and when the cache is unavailable
+        if self.cache_entry is None or not is_cacheable(answer):
+            return
+        store_answer(answer=answer, sources=self.sources, question=self.question,
+                     kb_type=self.kb_type, **self.cache_entry)
+
+    def finish(self, answer: Optional[str] = None):
+        if answer is not None:
+            self.store(answer)
+        record_timings(self.timings)
+
+    def result(self, answer: str) -> Dict:
+        return {
+            "answer": answer,
+            "sources": self.sources,
+            "cached": self.cached_answer is not None,
+            "intent": self.intent,
+            "timings": self.timings.to_dict(),
+        }
+
+
+def _lookup_cache(question: str, kb_type: str, query_embedding, timings: StageTimings):
+    """
+    Returns (PreparedAnswer for a cache hit or None, cache_entry for storing the answer later).
+    """
+    model_id = embedding_model_id()
+    with timings.stage("answer_cache"):
+        cached = lookup_answer(model_id, kb_type, query_embedding)
+    if cached and "answer" in cached:
+        return PreparedAnswer(question, kb_type, cached["sources"], cached_answer=cached["answer"], timings=timings), None
+    if cached is not None:
+        return None, {"model_id": model_id, "generation": cached["generation"], "query_embedding": query_embedding}
+    return None, None
+
+
+def _from_docs(question: str, kb_type: str, docs, cache_entry: Optional[Dict], timings: StageTimings) -> PreparedAnswer:
+    # 2. 构建 Prompt
+    with timings.stage("context"):
+        full_prompt, sources = assemble_prompt(question, docs)
+    if cache_entry is not None:
+        cache_entry["chunk_ids"] = [doc[0] for doc in docs or []]
+    return PreparedAnswer(question, kb_type, sources, prompt=full_prompt, cache_entry=cache_entry, timings=timings)
+
+
+def _prepare(question: str, kb_type: str, query_embedding, use_cache: bool, timings: StageTimings) -> PreparedAnswer:
+    cache_entry = None
+    if use_cache:
+        hit, cache_entry = _lookup_cache(question, kb_type, query_embedding, timings)
+        if hit is not None:
+            return hit
+
+    # 1. 检索 (传入 kb_type)：召回 recall_k 个候选，重排后保留 final_k 个
+    with timings.stage("retrieve"):
+        candidates = retrieve_similar_documents(
+            question, kb_type=kb_type, top_k=recall_depth(), query_embedding=query_embedding
+        )
+    with timings.stage("rerank"):
+        docs = get_reranker().rerank(question, candidates, get_rerank_config()["final_k"])
+    return _from_docs(question, kb_type, docs, cache_entry, timings)
+
+
+async def _aprepare(question: str, kb_type: str, query_embedding, use_cache: bool, timings: StageTimings) -> PreparedAnswer:
+    # 检索走 asyncpg 连接池；答案缓存和重排 (同步 HTTP / NumPy) 放到线程里执行
+    cache_entry = None
+    if use_cache:
+        hit, cache_entry = await asyncio.to_thread(_lookup_cache, question, kb_type, query_embedding, timings)
+        if hit is not None:
+            return hit
+
+    with timings.stage("retrieve"):
+        candidates = await aretrieve_similar_documents(
+            question, kb_type=kb_type, top_k=recall_depth(), query_embedding=query_embedding
+        )
+    with timings.stage("rerank"):
+        docs = await asyncio.to_thread(get_reranker().rerank, question, candidates, get_rerank_config()["final_k"])
+    return _from_docs(question, kb_type, docs, cache_entry, timings)
+
+
+def _prepare_chat(question: str, kb_type: str, reason: str, timings: StageTimings) -> PreparedAnswer:
+    print(f"Intent router: chat ({reason}), skipping retrieval")
+    return PreparedAnswer(question, kb_type, [], prompt=build_chat_prompt(question), timings=timings,
+                          intent=INTENT_CHAT, max_tokens=get_router_config()["chat_max_tokens"])
+
+
+def prepare_answer(question: str, image: Optional[str] = None, kb_type: str = "user") -> PreparedAnswer:
+    """
+    意图路由 -> 查询向量 -> 语义答案缓存 -> 检索 -> 重排 -> 构建 Prompt
+    闲聊直接用短 Prompt，不做向量化和检索
+    带图片的问题不走答案缓存 (答案依赖图片内容)
+    """
+    timings = StageTimings()
+    with timings.stage("route"):
+        intent, reason = route_question(question, image)
+    if intent == INTENT_CHAT:
+        return _prepare_chat(question, kb_type, reason, timings)
+
+    with timings.stage("embed"):
+        query_embedding = embed_text(question)
+    if intent is None:
+        # 规则无法判断：用同一个查询向量做原型分类，检索时复用
+        with timings.stage("route"):
+            intent, reason = route_embedding(query_embedding)
+        if intent == INTENT_CHAT:
+            return _prepare_chat(question, kb_type, reason, timings)
+    return _prepare(question, kb_type, query_embedding, not image, timings)
+
+
+async def aprepare_answer(question: str, image: Optional[str] = None, kb_type: str = "user") -> PreparedAnswer:
+    # 查询向量走 httpx 异步连接池，检索走 asyncpg 连接池
+    timings = StageTimings()
+    with timings.stage("route"):
+        intent, reason = route_question(question, image)
+    if intent == INTENT_CHAT:
+        return _prepare_chat(question, kb_type, reason, timings)
+
+    with timings.stage("embed"):
+        query_embedding = await aembed_text(question)
+    if intent is None:
+        # 原型向量首次构建需要同步 embedding 调用
+        with timings.stage("route"):
+            intent, reason = await asyncio.to_thread(route_embedding, query_embedding)
+        if intent == INTENT_CHAT:
+            return _prepare_chat(question, kb_type, reason, timings)
+    return await _aprepare(question, kb_type, query_embedding, not image, timings)
+
+
+def answer_question(question: str, image: Optional[str] = None, kb_type: str = "user") -> Dict:
+    prepared = prepare_answer(question, image, kb_type=kb_type)
+    if prepared.cached_answer is not None:
+        prepared.finish()
+        return prepared.result(prepared.cached_answer)
 
     # 3. 调用 LLM
-    answer = call_llm(full_prompt, image=image)
-    
-    return {
-        "answer": answer,
-        "sources": sources
-    }
+    with prepared.timings.stage("llm"):
+        answer = call_llm(prepared.prompt, image=image, max_tokens=prepared.max_tokens)
+    prepared.finish(answer)
+    return prepared.result(answer)
+
+
+async def aanswer_question(question: str, image: Optional[str] = None, kb_type: str = "user") -> Dict:
+    prepared = await aprepare_answer(question, image, kb_type=kb_type)
+    if prepared.cached_answer is not None:
+        prepared.finish()
+        return prepared.result(prepared.cached_answer)
+
+    with prepared.timings.stage("llm"):
+        answer = await acall_llm(prepared.prompt, image=image, max_tokens=prepared.max_tokens)
+    await asyncio.to_thread(prepared.finish, answer)
+    return prepared.result(answer)
+
+
+async def astream_answer(question: str, image: Optional[str] = None, kb_type: str = "user") -> Tuple[PreparedAnswer, AsyncIterator[str]]:
+    prepared = await aprepare_answer(question, image, kb_type=kb_type)
+
+    async def tokens():
+        if prepared.cached_answer is not None:
+            prepared.finish()
+            yield prepared.cached_answer
+            return
+        parts = []
+        start = time.perf_counter()
+        async for chunk in astream_llm(prepared.prompt, image=image, max_tokens=prepared.max_tokens):
+            if not parts:
+                prepared.timings.add("llm_first_token", time.perf_counter() - start)
+            parts.append(chunk)
+            yield chunk
+        prepared.timings.add("llm", time.perf_counter() - start)
+        await asyncio.to_thread(prepared.finish, "".join(parts))
+
+    return prepared, tokens()
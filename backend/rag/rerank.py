@@ -0,0 +1,176 @@
+import threading
+from abc import ABC, abstractmethod
+from typing import List
+import numpy as np
+from config_loader import config
+from rag.lexical import tokenize
+
+# Reranking stage between retrieval and context assembly:
+# retrieval recalls rerank.recall_k candidates cheaply, the reranker keeps the best final_k.
+# Candidate rows have the retriever's shape: (id, content, metadata, distance, chunk_index).
+
+
+def get_rerank_config() -> dict:
+    rerank_config = (config.rag or {}).get("rerank", {}) or {}
+    http_config = rerank_config.get("http", {}) or {}
+    return {
+        # none / bm25 / http
+        "type": str(rerank_config.get("type", "none")).lower(),
+        "recall_k": int(rerank_config.get("recall_k", 50)),
+        "final_k": int(rerank_config.get("final_k", 3)),
+        "bm25_k1": float(rerank_config.get("bm25_k1", 1.5)),
+        "bm25_b": float(rerank_config.get("bm25_b", 0.75)),
+        "http": {
+            "base_url": (http_config.get("base_url") or "").rstrip("/"),
+            "model": http_config.get("model") or "bge-reranker-v2-m3",
+            "api_key": http_config.get("api_key") or "",
+            "timeout": float(http_config.get("timeout", 10)),
+        },
+    }
+
+
+class Reranker(ABC):
+    name = "base"
+
+    @abstractmethod
+    def rerank(self, query: str, docs: list, top_k: int) -> list:
+        """
+        Return at most top_k of docs, best first.
+        """
+        pass
+
+
+class NoopReranker(Reranker):
+    name = "none"
+
+    def rerank(self, query: str, docs: list, top_k: int) -> list:
+        return list(docs)[:top_k]
+
+
+class BM25Reranker(Reranker):
+    """
+    Okapi BM25 over the candidate set only (IDF from the candidates), using the same
+    tokenizer as the keyword channel. The term-frequency matrix is scored in one NumPy pass.
+    """
+    name = "bm25"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    def scores(self, query: str, texts: List[str]) -> np.ndarray:
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        if not query_terms or not texts:
+            return np.zeros(len(texts))
+        term_index = {term: i for i, term in enumerate(query_terms)}
+
+        # tf[d, t]: occurrences of query term t in candidate d
+        tf = np.zeros((len(texts), len(query_terms)), dtype=np.float32)
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for d, content in enumerate(texts):
+            tokens = tokenize(content)
+            lengths[d] = len(tokens)
+            for token in tokens:
+                t = term_index.get(token)
+                if t is not None:
+                    tf[d, t] += 1
+
+        n_docs = len(texts)
+        df = np.count_nonzero(tf, axis=0)
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+        avg_length = lengths.mean() or 1.0
+        norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+        weighted = tf * (self.k1 + 1) / (tf + norm[:, None])
+        return weighted @ idf
+
+    def rerank(self, query: str, docs: list, top_k: int) -> list:
+        docs = list(docs)
+        scores = self.scores(query, [doc[1] or "" for doc in docs])
+        # Stable: ties (including "no query term at all") keep the retrieval order
+        order = np.argsort(-scores, kind="stable")
+        return [docs[i] for i in order[:top_k]]
+
+
+class HTTPReranker(Reranker):
+    """
+    Cross-encoder served behind an OpenAI-style /rerank endpoint
+    (bge-reranker via vLLM, Xinference, Jina/Cohere-compatible servers, or TEI).
+    Falls back to the retrieval order if the service fails.
+    """
+    name = "http"
+
+    def __init__(self, base_url: str, model: str, api_key: str = "", timeout: float = 10):
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def rerank(self, query: str, docs: list, top_k: int) -> list:
+        from llm.http import get_http_client
+
+        docs = list(docs)
+        if not docs:
+            return []
+        texts = [doc[1] or "" for doc in docs]
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        payload = {
+            "model": self.model,
+            "query": query,
+            "documents": texts,
+            # TEI names the field "texts"
+            "texts": texts,
+            "top_n": top_k,
+        }
+        try:
+            response = get_http_client().post(f"{self.base_url}/rerank", headers=headers, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+            # Jina/Cohere/vLLM: {"results": [{"index", "relevance_score"}]}; TEI: [{"index", "score"}]
+            results = data.get("results", []) if isinstance(data, dict) else data
+            ranked = sorted(
+                results,
+                key=lambda item: item.get("relevance_score", item.get("score", 0.0)),
+                reverse=True
+            )
+            return [docs[item["index"]] for item in ranked[:top_k]]
+        except Exception as e:
+            print(f"Error calling rerank service ({self.base_url}/rerank), keeping retrieval order: {e}")
+            return docs[:top_k]
+
+
+_reranker = None
+_reranker_key = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Reranker:
+    """
+    Process-wide reranker built from rag.rerank; rebuilt when the config changes.
+    """
+    global _reranker, _reranker_key
+    cfg = get_rerank_config()
+    key = (cfg["type"], cfg["bm25_k1"], cfg["bm25_b"], tuple(sorted(cfg["http"].items())))
+    if _reranker is None or _reranker_key != key:
+        with _reranker_lock:
+            if cfg["type"] == "bm25":
+                _reranker = BM25Reranker(k1=cfg["bm25_k1"], b=cfg["bm25_b"])
+            elif cfg["type"] == "http" and cfg["http"]["base_url"]:
+                _reranker = HTTPReranker(**cfg["http"])
+            else:
+                if cfg["type"] not in ("none", "noop"):
+                    print(f"Warning: rerank type '{cfg['type']}' not usable, reranking disabled")
+                _reranker = NoopReranker()
+            _reranker_key = key
+    return _reranker
+
+
+def recall_depth() -> int:
+    """
+    Candidates to retrieve: final_k when reranking is off, recall_k otherwise.
+    """
+    cfg = get_rerank_config()
+    if isinstance(get_reranker(), NoopReranker):
+        return cfg["final_k"]
+    return max(cfg["recall_k"], cfg["final_k"])
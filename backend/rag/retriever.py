@@ -1,41 +1,113 @@
 from sqlalchemy import text
-from db import engine
-from llm.embedding import embed_text
+from db import engine, get_async_engine
+from config_loader import config
+from llm.embedding import embed_text, aembed_text
+from rag.vector_index import distance_sql, apply_search_params, aapply_search_params
+from rag.schema import COMMON_KB
+from rag.lexical import to_tsquery_literal
 
-def retrieve_similar_documents(query: str, kb_type: str = "user", top_k: int = 3):
-    query_embedding = embed_text(query)
+def get_hybrid_config() -> dict:
+    hybrid_config = (config.rag or {}).get("hybrid", {}) or {}
+    return {
+        "enabled": bool(hybrid_config.get("enabled", True)),
+        "candidates": int(hybrid_config.get("candidates", 20)),
+        "rrf_k": int(hybrid_config.get("rrf_k", 60)),
+    }
+
+def reciprocal_rank_fusion(rankings, k: int = 60):
+    """
+    Merge several ranked lists of rows (first column = id) with RRF:
+    score(d) = sum over lists of 1 / (k + rank(d)).
+    Returns rows ordered by fused score, best first.
+    """
+    scores = {}
+    rows = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            doc_id = row[0]
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+            rows.setdefault(doc_id, row)
+    ordered = sorted(scores, key=lambda doc_id: scores[doc_id], reverse=True)
+    return [rows[doc_id] for doc_id in ordered]
+
+def build_search(query: str, kb_type: str, top_k: int, query_embedding) -> dict:
+    """
+    SQL and parameters for both retrieval channels; shared by the sync and async paths.
+    """
+    hybrid = get_hybrid_config()
+
+    # Distance operator follows rag.vector_index.metric so the ANN index is used
+    distance = distance_sql("embedding", ":query_embedding")
+
+    # kb_type is a typed, indexed column (see rag/schema.py)
+    if kb_type == "all":
+        kb_filter = ""
+        params = {"query_embedding": query_embedding}
+    else:
+        kb_filter = "AND kb_type IN (:kb_type, :common_kb)"
+        params = {"query_embedding": query_embedding, "kb_type": kb_type, "common_kb": COMMON_KB}
+
+    tsquery = to_tsquery_literal(query) if hybrid["enabled"] else None
+    limit = max(top_k, hybrid["candidates"]) if tsquery else top_k
+
+    # 1. Vector channel
+    vector_sql = text(f"""
+        SELECT id, content, metadata, {distance} AS distance, chunk_index
+        FROM documents
+        WHERE TRUE {kb_filter}
+        ORDER BY distance ASC
+        LIMIT :limit;
+        """)
+
+    # 2. Keyword channel (exact alarm codes, device models, command names)
+    lexical_sql = text(f"""
+        SELECT id, content, metadata, {distance} AS distance, chunk_index
+        FROM documents
+        WHERE content_tsv @@ CAST(:tsquery AS tsquery) {kb_filter}
+        ORDER BY ts_rank_cd(content_tsv, CAST(:tsquery AS tsquery)) DESC
+        LIMIT :limit;
+        """) if tsquery else None
+
+    return {
+        "filtered": kb_type != "all",
+        "vector_sql": vector_sql,
+        "vector_params": {**params, "limit": limit},
+        "lexical_sql": lexical_sql,
+        "lexical_params": {**params, "tsquery": tsquery, "limit": limit},
+        "rrf_k": hybrid["rrf_k"],
+    }
+
+def retrieve_similar_documents(query: str, kb_type: str = "user", top_k: int = 3, query_embedding=None):
+    """
+    query_embedding: precomputed query vector (async callers embed on the event loop)
+    """
+    if query_embedding is None:
+        query_embedding = embed_text(query)
+    search = build_search(query, kb_type, top_k, query_embedding)
 
     with engine.connect() as connection:
-        # Construct SQL based on kb_type
-        if kb_type == "all":
-             sql = """
-            SELECT id, content, metadata, embedding <-> (:query_embedding)::vector AS distance
-            FROM documents
-            ORDER BY distance ASC
-            LIMIT :top_k;
-            """
-             params = {
-                "query_embedding": query_embedding,
-                "top_k": top_k
-            }
-        else:
-             sql = """
-            SELECT id, content, metadata, embedding <-> (:query_embedding)::vector AS distance
-            FROM documents
-            WHERE metadata->>'kb_type' = :kb_type OR metadata->>'kb_type' IS NULL
-            ORDER BY distance ASC
-            LIMIT :top_k;
-            """
-             params = {
-                "query_embedding": query_embedding,
-                "top_k": top_k,
-                "kb_type": kb_type
-            }
-
-        # Use JSONB operator ->> to extract text value from metadata
-        result = connection.execute(
-            text(sql),
-            params
-        )
-
-        return result.fetchall()
+        apply_search_params(connection, filtered=search["filtered"], limit=search["vector_params"]["limit"])
+        vector_rows = connection.execute(search["vector_sql"], search["vector_params"]).fetchall()
+        if search["lexical_sql"] is None:
+            return vector_rows[:top_k]
+        lexical_rows = connection.execute(search["lexical_sql"], search["lexical_params"]).fetchall()
+
+    # 3. Fuse both channels so a small top_k still reaches keyword-only hits
+    return reciprocal_rank_fusion([vector_rows, lexical_rows], k=search["rrf_k"])[:top_k]
+
+async def aretrieve_similar_documents(query: str, kb_type: str = "user", top_k: int = 3, query_embedding=None):
+    """
+    retrieve_similar_documents on the asyncpg pool (request path).
+    """
+    if query_embedding is None:
+        query_embedding = await aembed_text(query)
+    search = build_search(query, kb_type, top_k, query_embedding)
+
+    async with get_async_engine().connect() as connection:
+        await aapply_search_params(connection, filtered=search["filtered"], limit=search["vector_params"]["limit"])
+        vector_rows = (await connection.execute(search["vector_sql"], search["vector_params"])).fetchall()
+        if search["lexical_sql"] is None:
+            return vector_rows[:top_k]
+        lexical_rows = (await connection.execute(search["lexical_sql"], search["lexical_params"])).fetchall()
+
+    return reciprocal_rank_fusion([vector_rows, lexical_rows], k=search["rrf_k"])[:top_k]
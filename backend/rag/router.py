@@ -0,0 +1,161 @@
+import re
+import threading
+from typing import List, Optional, Tuple
+from config_loader import config
+from llm.embedding_cache import normalize_text
+
+# Intent routing before retrieval:
+#   chat -> short CHAT_PROMPT, small max_tokens, no embedding / retrieval
+#   ops  -> full RAG pipeline
+# Stage 1 is a keyword/rule classifier (microseconds). Questions it cannot decide
+# go to ops, or, with router.prototypes enabled, to a nearest-prototype classifier
+# over a few example questions whose vectors are embedded once and cached.
+
+INTENT_CHAT = "chat"
+INTENT_OPS = "ops"
+
+# Whole-message small talk (after stripping punctuation / whitespace)
+CHAT_PHRASES = {
+    "你好", "您好", "你好呀", "hi", "hello", "hey", "在吗", "在不在", "早", "早上好", "上午好",
+    "中午好", "下午好", "晚上好", "晚安", "谢谢", "谢谢你", "谢谢您", "多谢", "感谢", "非常感谢",
+    "thanks", "thank you", "thx", "好的", "好", "ok", "okay", "收到", "明白了", "知道了", "嗯",
+    "嗯嗯", "哈哈", "哈哈哈", "再见", "拜拜", "bye", "辛苦了", "你真棒", "厉害", "牛",
+    "你是谁", "你叫什么", "你叫什么名字", "你能做什么", "你会什么", "介绍一下你自己",
+}
+
+# Chat openers that may be followed by a few more characters ("你好，小助手")
+CHAT_PREFIXES = ("你好", "您好", "谢谢", "感谢", "早上好", "晚上好", "hello", "hi ", "thanks")
+
+# What may follow a chat opener ("你好，小助手")
+CHAT_ADDRESSEES = {"小助手", "助手", "机器人", "你", "您", "大家"}
+
+# Any of these means the message is about operations work, whatever else it contains
+OPS_KEYWORDS = (
+    "报错", "错误", "故障", "告警", "异常", "失败", "超时", "无法", "不能", "怎么", "如何", "为什么",
+    "配置", "重启", "部署", "安装", "升级", "日志", "排查", "处理", "恢复", "数据库", "服务器",
+    "网络", "端口", "磁盘", "内存", "cpu", "基站", "天线", "设备", "指标", "流程", "步骤", "命令",
+    "error", "fail", "timeout", "alarm",
+)
+
+# Alarm codes, IPs, versions: digits are a strong ops signal
+_DIGIT_RE = re.compile(r"\d")
+_PUNCT_RE = re.compile(r"[\s,.!?;:~，。！？；：～、…\-_'\"“”‘’()（）]+")
+
+# Longest message still considered for the chat-prefix rule
+MAX_CHAT_CHARS = 16
+
+# Examples for the prototype classifier
+CHAT_PROTOTYPES = [
+    "你好", "谢谢你的帮助", "你是谁", "今天天气怎么样", "讲个笑话", "你真厉害", "再见",
+]
+OPS_PROTOTYPES = [
+    "数据库连接超时如何排查", "服务器磁盘满了怎么处理", "基站告警如何恢复",
+    "应用启动报错怎么解决", "如何修改系统配置", "网络不通如何定位",
+]
+
+
+def get_router_config() -> dict:
+    router_config = (config.rag or {}).get("router", {}) or {}
+    return {
+        "enabled": bool(router_config.get("enabled", True)),
+        "prototypes": bool(router_config.get("prototypes", False)),
+        # Chat wins only if it beats the best ops prototype by this cosine margin
+        "margin": float(router_config.get("margin", 0.05)),
+        "chat_max_tokens": int(router_config.get("chat_max_tokens", 256)),
+    }
+
+
+def classify_rules(question: str) -> Tuple[Optional[str], str]:
+    """
+    Returns (intent, reason); intent None means undecided.
+    """
+    text = normalize_text(question).casefold()
+    compact = _PUNCT_RE.sub("", text)
+    if not compact:
+        return INTENT_CHAT, "empty"
+
+    if any(keyword in text for keyword in OPS_KEYWORDS):
+        return INTENT_OPS, "ops_keyword"
+    if _DIGIT_RE.search(compact):
+        return INTENT_OPS, "digits"
+
+    if compact in CHAT_PHRASES or _PUNCT_RE.sub(" ", text).strip() in CHAT_PHRASES:
+        return INTENT_CHAT, "chat_phrase"
+    if len(compact) <= MAX_CHAT_CHARS and text.startswith(CHAT_PREFIXES):
+        # "你好，小助手" is chat; "你好，VPN连不上" is a question behind a greeting
+        prefix = next(p for p in CHAT_PREFIXES if text.startswith(p))
+        rest = _PUNCT_RE.sub("", text[len(prefix):])
+        if not rest or rest in CHAT_PHRASES or rest in CHAT_ADDRESSEES:
+            return INTENT_CHAT, "chat_prefix"
+    return None, "undecided"
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = sum(x * x for x in a) ** 0.5
+    norm_b = sum(y * y for y in b) ** 0.5
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+_prototype_vectors = {}
+_prototype_lock = threading.Lock()
+
+
+def get_prototype_vectors() -> dict:
+    """
+    {intent: [vector, ...]} for the current embedding model. Built once per model;
+    embed_text also keeps them in the persistent embedding cache across restarts.
+    """
+    from llm.embedding import embed_text, embedding_model_id
+
+    model_id = embedding_model_id()
+    vectors = _prototype_vectors.get(model_id)
+    if vectors is None:
+        with _prototype_lock:
+            vectors = _prototype_vectors.get(model_id)
+            if vectors is None:
+                vectors = {
+                    INTENT_CHAT: [embed_text(q) for q in CHAT_PROTOTYPES],
+                    INTENT_OPS: [embed_text(q) for q in OPS_PROTOTYPES],
+                }
+                _prototype_vectors[model_id] = vectors
+    return vectors
+
+
+def classify_embedding(query_embedding: List[float]) -> Tuple[str, str]:
+    cfg = get_router_config()
+    vectors = get_prototype_vectors()
+    chat_score = max((_cosine(query_embedding, v) for v in vectors[INTENT_CHAT]), default=0.0)
+    ops_score = max((_cosine(query_embedding, v) for v in vectors[INTENT_OPS]), default=0.0)
+    if chat_score > ops_score + cfg["margin"]:
+        return INTENT_CHAT, f"prototype:{chat_score:.2f}>{ops_score:.2f}"
+    return INTENT_OPS, f"prototype:{ops_score:.2f}>={chat_score:.2f}"
+
+
+def route_question(question: str, image: Optional[str] = None) -> Tuple[Optional[str], str]:
+    """
+    Returns (intent, reason). intent None means the rules could not decide and the
+    prototype classifier is enabled: the caller embeds the question (retrieval reuses
+    the vector) and calls route_embedding().
+    """
+    cfg = get_router_config()
+    if not cfg["enabled"]:
+        return INTENT_OPS, "disabled"
+    if image:
+        # Screenshots of errors always need the vision model and the knowledge base
+        return INTENT_OPS, "image"
+
+    intent, reason = classify_rules(question)
+    if intent is None and not cfg["prototypes"]:
+        return INTENT_OPS, reason
+    return intent, reason
+
+
+def route_embedding(query_embedding: List[float]) -> Tuple[str, str]:
+    try:
+        return classify_embedding(query_embedding)
+    except Exception as e:
+        print(f"Error in prototype intent classifier: {e}")
+        return INTENT_OPS, "prototype_error"
@@ -0,0 +1,98 @@
+from sqlalchemy import text
+from db import engine
+
+# kb_type for chunks that are visible to every knowledge base
+# (learned QA, manual training). Replaces the old "metadata->>'kb_type' IS NULL" rule.
+COMMON_KB = "common"
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def ensure_document_columns():
+    """
+    Promote hot metadata keys out of JSONB into typed, indexed columns.
+    Idempotent: safe to run on every startup.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS kb_type VARCHAR(20)"))
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS source TEXT"))
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS filename VARCHAR(255)"))
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS doc_type VARCHAR(50)"))
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS upload_time TIMESTAMP"))
+        # Keyword channel for hybrid retrieval, filled by rag.lexical
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_tsv tsvector"))
+        # Position of the chunk within its document (adjacent-chunk merging in rag.context)
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_index INTEGER"))
+        # Model that produced the vector (llm.embedding.embedding_model_id); NULL for chunks
+        # written before it was recorded, whose model is unknown
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedding_model VARCHAR(200)"))
+
+    backfill_document_columns()
+    backfill_chunk_index()
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS documents_kb_type_idx ON documents (kb_type)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS documents_source_idx ON documents (source)"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS documents_filename_idx ON documents (filename) WHERE filename IS NOT NULL"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS documents_content_tsv_idx ON documents USING gin (content_tsv)"))
+
+
+def backfill_document_columns() -> int:
+    """
+    Copy values from metadata into the typed columns for rows written before the migration.
+    Runs in small batches so the table is never locked for long.
+    """
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            result = conn.execute(
+                text("""
+                    UPDATE documents SET
+                        kb_type = COALESCE(NULLIF(metadata->>'kb_type', ''), :common),
+                        source = metadata->>'source',
+                        filename = metadata->>'filename',
+                        doc_type = metadata->>'type',
+                        upload_time = CASE
+                            WHEN metadata->>'upload_time' ~ '^\\d{4}-\\d{2}-\\d{2}'
+                                THEN (metadata->>'upload_time')::timestamp
+                            WHEN metadata->>'created_at' ~ '^\\d{4}-\\d{2}-\\d{2}'
+                                THEN (metadata->>'created_at')::timestamp
+                        END
+                    WHERE id IN (
+                        SELECT id FROM documents WHERE kb_type IS NULL LIMIT :batch
+                    )
+                """),
+                {"common": COMMON_KB, "batch": BACKFILL_BATCH_SIZE}
+            )
+            updated = result.rowcount or 0
+
+        total += updated
+        if updated < BACKFILL_BATCH_SIZE:
+            break
+
+    if total:
+        print(f"Backfilled typed columns for {total} document chunks")
+    return total
+
+
+def backfill_chunk_index() -> int:
+    """
+    Chunks of one file are inserted in order, so id order within a source is chunk order.
+    Learned QA entries share a source but are separate documents: each is its own chunk 0.
+    """
+    with engine.begin() as conn:
+        result = conn.execute(text("""
+            UPDATE documents d SET chunk_index = CASE WHEN d.doc_type = 'learned_qa' THEN 0 ELSE t.position END
+            FROM (
+                SELECT id, (row_number() OVER (PARTITION BY source ORDER BY id) - 1)::int AS position
+                FROM documents
+                WHERE source IN (SELECT DISTINCT source FROM documents WHERE chunk_index IS NULL)
+            ) t
+            WHERE d.id = t.id AND d.chunk_index IS NULL
+        """))
+        updated = result.rowcount or 0
+    if updated:
+        print(f"Backfilled chunk positions for {updated} document chunks")
+    return updated
@@ -0,0 +1,186 @@
+import os
+from sqlalchemy import text
+from db import engine
+from rag.loader import load_document, get_current_time_str
+from rag.manifest import INGEST_VERSION, file_sha256, record_manifest
+from rag.answer_cache import invalidate_chunks
+
+def scan_directory(upload_dir: str) -> dict:
+    """
+    path -> (size, mtime) for regular files directly under upload_dir.
+    """
+    disk_files = {}
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                disk_files[os.path.join(upload_dir, entry.name)] = (stat.st_size, stat.st_mtime)
+    return disk_files
+
+def load_manifest(upload_dir: str) -> dict:
+    prefix = upload_dir + os.sep
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT path, size, mtime, sha256, ingest_version, kb_type FROM file_manifest")
+        ).fetchall()
+    # Only consider files that look like they are in 'uploads/' to avoid deleting other things
+    return {
+        row[0]: {"size": row[1], "mtime": row[2], "sha256": row[3], "version": row[4], "kb_type": row[5]}
+        for row in rows if row[0].startswith(prefix)
+    }
+
+def adopt_unmanifested_files(paths: list) -> dict:
+    """
+    Files ingested before the manifest existed: if documents already has chunks for them,
+    record them in the manifest instead of re-ingesting. Returns the adopted entries.
+    """
+    if not paths:
+        return {}
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT source, COUNT(*), MAX(kb_type) FROM documents
+                WHERE source = ANY(:paths)
+                GROUP BY source
+            """),
+            {"paths": paths}
+        ).fetchall()
+
+    adopted = {}
+    for source, chunk_count, kb_type in rows:
+        sha256 = file_sha256(source)
+        record_manifest(source, chunk_count, kb_type=kb_type, sha256=sha256)
+        stat = os.stat(source)
+        adopted[source] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256,
+                           "version": INGEST_VERSION, "kb_type": kb_type}
+    return adopted
+
+def find_orphaned_sources(upload_dir: str, known_paths) -> list:
+    """
+    Sources under upload_dir that still have chunks in documents but are neither on disk
+    nor in the manifest: files deleted before the manifest existed.
+    """
+    prefix = upload_dir + os.sep
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT DISTINCT source FROM documents WHERE left(source, length(:prefix)) = :prefix"),
+            {"prefix": prefix}
+        ).fetchall()
+    return [row[0] for row in rows if row[0] not in known_paths]
+
+def sync_upload_dir(upload_dir: str = "uploads", force: bool = False, progress=None) -> dict:
+    """
+    Incremental sync of the uploads directory driven by the file manifest:
+    new files are ingested, files whose content hash changed are re-ingested,
+    files gone from disk are removed. Unchanged files cost one stat() each.
+    force: re-ingest every file (unchanged chunks still reuse stored embeddings) and
+           reconcile documents.source against the disk.
+    progress: optional callback progress(done, total) in files.
+    """
+    if not os.path.exists(upload_dir):
+        return {"message": "Uploads directory does not exist", "processed": 0, "deleted": 0, "skipped": 0, "errors": []}
+
+    # 1. Disk state vs manifest
+    disk_files = scan_directory(upload_dir)
+    manifest = load_manifest(upload_dir)
+    # Full documents.source scan only on the first manifest-driven sync or on force;
+    # afterwards every deletion is seen through the manifest
+    reconcile = force or not manifest
+    manifest.update(adopt_unmanifested_files([p for p in disk_files if p not in manifest]))
+
+    files_to_add = []
+    files_to_update = []
+    skipped_count = 0
+    touched = []
+
+    for file_path, (size, mtime) in sorted(disk_files.items()):
+        entry = manifest.get(file_path)
+        if entry is None:
+            files_to_add.append(file_path)
+        elif force or (entry["version"] or 0) < INGEST_VERSION:
+            files_to_update.append(file_path)
+        elif entry["size"] == size and entry["mtime"] == mtime:
+            skipped_count += 1
+        elif file_sha256(file_path) == entry["sha256"]:
+            # Touched but not modified (copy, restore from backup): just refresh stat info
+            touched.append(file_path)
+            skipped_count += 1
+        else:
+            files_to_update.append(file_path)
+
+    files_to_delete = [p for p in manifest if p not in disk_files]
+    if reconcile:
+        files_to_delete += find_orphaned_sources(upload_dir, set(disk_files) | set(manifest))
+
+    deleted_count = 0
+    processed_count = 0
+    errors = []
+
+    # 2. Handle Deletions
+    if files_to_delete:
+        try:
+            with engine.begin() as conn:
+                for source in files_to_delete:
+                    # Delete from documents (vector store)
+                    deleted = conn.execute(text("DELETE FROM documents WHERE source = :s RETURNING id"), {"s": source}).fetchall()
+                    invalidate_chunks(conn, [row[0] for row in deleted])
+                    # Delete from uploaded_files table to sync UI status
+                    conn.execute(text("DELETE FROM uploaded_files WHERE file_path = :s"), {"s": source})
+                    conn.execute(text("DELETE FROM file_manifest WHERE path = :s"), {"s": source})
+                    deleted_count += 1
+        except Exception as e:
+             errors.append(f"Deletion error: {str(e)}")
+
+    for file_path in touched:
+        try:
+            record_manifest(file_path, None, sha256=manifest[file_path]["sha256"])
+        except Exception as e:
+            errors.append(f"{os.path.basename(file_path)}: {str(e)}")
+
+    # 3. Handle Additions / Changes
+    files_to_process = files_to_add + files_to_update
+    for i, file_path in enumerate(files_to_process):
+        try:
+             filename = os.path.basename(file_path)
+             metadata = {
+                 "source": file_path,
+                 "filename": filename,
+                 "type": "manual_reprocess",
+                 "upload_time": get_current_time_str()
+             }
+             # Changed files keep their KB; new files default to user KB
+             kb_type = (manifest.get(file_path) or {}).get("kb_type") or "user"
+             chunk_count = load_document(file_path, metadata, kb_type=kb_type)
+             if chunk_count is None:
+                 # Empty or unreadable: remember it so it is not retried until it changes
+                 record_manifest(file_path, 0, kb_type=kb_type)
+             processed_count += 1
+
+             # Add to uploaded_files if not exists (to show in Admin UI)
+             with engine.begin() as conn:
+                 res = conn.execute(text("SELECT id FROM uploaded_files WHERE file_path = :p"), {"p": file_path}).fetchone()
+                 if not res:
+                     conn.execute(
+                        text("INSERT INTO uploaded_files (filename, file_path, uploader, status) VALUES (:f, :p, :u, :s)"),
+                        {"f": filename, "p": file_path, "u": "system_scan", "s": "approved"}
+                    )
+        except Exception as e:
+             errors.append(f"{os.path.basename(file_path)}: {str(e)}")
+        if progress:
+            progress(i + 1, len(files_to_process))
+
+    msg = f"已同步：新增 {len(files_to_add)} 个，更新 {len(files_to_update)} 个，剔除 {deleted_count} 个"
+    if skipped_count > 0:
+        msg += f"，跳过 {skipped_count} 个未变化文件"
+    if errors:
+        msg += f" (有 {len(errors)} 个错误)"
+
+    return {
+        "message": msg,
+        "processed": processed_count,
+        "added": len(files_to_add),
+        "updated": len(files_to_update),
+        "deleted": deleted_count,
+        "skipped": skipped_count,
+        "errors": errors
+    }
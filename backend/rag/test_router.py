@@ -0,0 +1,23 @@
+# rag/test_router.py
+from rag.router import INTENT_CHAT, classify_rules
+
+# Greeting followed by an ops question: must not be routed to the chat prompt
+GREETING_THEN_QUESTION = ["你好，VPN连不上", "谢谢，交换机掉线了", "你好，OLT离线", "你好，ping不通网关"]
+SMALL_TALK = ["你好", "谢谢你", "你好，小助手", "hello!", "谢谢"]
+
+
+def test_greeting_prefix_with_question_is_not_chat():
+    for question in GREETING_THEN_QUESTION:
+        intent, reason = classify_rules(question)
+        assert intent != INTENT_CHAT, (question, intent, reason)
+
+
+def test_small_talk_is_chat():
+    for question in SMALL_TALK:
+        intent, reason = classify_rules(question)
+        assert intent == INTENT_CHAT, (question, intent, reason)
+
+
+if __name__ == "__main__":
+    for question in GREETING_THEN_QUESTION + SMALL_TALK:
+        print(question, classify_rules(question))
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict
+
+# Per-stage latency of the answer pipeline (embed, cache, retrieve, rerank, context, llm).
+# Each request collects a StageTimings; finished timings are folded into process-wide
+# aggregates exposed by /debug/rag_timings.
+
+# Samples kept per stage for percentiles
+WINDOW_SIZE = 500
+
+
+class StageTimings:
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, float]:
+        # Milliseconds, rounded for logs and API responses
+        return {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+
+
+class TimingAggregator:
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self.window_size = window_size
+
+    def record(self, timings: StageTimings):
+        with self._lock:
+            for name, seconds in timings.stages.items():
+                samples = self._samples.setdefault(name, deque(maxlen=self.window_size))
+                samples.append(seconds)
+                self._counts[name] = self._counts.get(name, 0) + 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for name, samples in snapshot.items():
+            if not samples:
+                continue
+            result[name] = {
+                "count": counts.get(name, 0),
+                "avg_ms": round(sum(samples) / len(samples) * 1000, 1),
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 1),
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+                "max_ms": round(samples[-1] * 1000, 1),
+            }
+        return result
+
+
+aggregator = TimingAggregator()
+
+
+def record_timings(timings: StageTimings):
+    aggregator.record(timings)
+
+
+def get_timing_summary() -> dict:
+    return aggregator.summary()
@@ -0,0 +1,232 @@
+import threading
+from sqlalchemy import text
+from db import engine, advisory_lock
+from config_loader import config
+
+INDEX_NAME = "documents_embedding_idx"
+# Advisory lock: one index build at a time across API / worker processes
+BUILD_LOCK = "documents_embedding_idx_build"
+
+# metric -> (operator class, distance operator)
+# ip: pgvector's <#> returns the *negative* inner product, so ORDER BY ... ASC still works.
+METRICS = {
+    "l2": ("vector_l2_ops", "<->"),
+    "cosine": ("vector_cosine_ops", "<=>"),
+    "ip": ("vector_ip_ops", "<#>"),
+}
+
+INDEX_TYPES = ("hnsw", "ivfflat", "none")
+
+
+def get_index_config() -> dict:
+    """
+    Read rag.vector_index from config.yaml with defaults filled in.
+    """
+    index_config = (config.rag or {}).get("vector_index", {}) or {}
+
+    index_type = str(index_config.get("type", "hnsw")).lower()
+    if index_type not in INDEX_TYPES:
+        print(f"Warning: unknown vector index type '{index_type}', falling back to hnsw")
+        index_type = "hnsw"
+
+    metric = str(index_config.get("metric", "l2")).lower()
+    if metric not in METRICS:
+        print(f"Warning: unknown vector metric '{metric}', falling back to l2")
+        metric = "l2"
+
+    return {
+        "type": index_type,
+        "metric": metric,
+        "m": int(index_config.get("m", 16)),
+        "ef_construction": int(index_config.get("ef_construction", 64)),
+        "lists": int(index_config.get("lists", 100)),
+        "ef_search": int(index_config.get("ef_search", 40)),
+        "probes": int(index_config.get("probes", 10)),
+        # off / relaxed_order / strict_order (ivfflat only supports relaxed_order)
+        "iterative_scan": str(index_config.get("iterative_scan", "relaxed_order")).lower(),
+        "maintenance_work_mem": index_config.get("maintenance_work_mem"),
+    }
+
+
+def distance_operator() -> str:
+    """
+    Distance operator matching the configured metric, so queries can use the index.
+    """
+    return METRICS[get_index_config()["metric"]][1]
+
+
+def distance_sql(column: str = "embedding", param: str = ":query_embedding") -> str:
+    return f"{column} {distance_operator()} ({param})::vector"
+
+
+def build_index_sql(index_name: str = INDEX_NAME, concurrently: bool = True) -> str:
+    cfg = get_index_config()
+    if cfg["type"] == "none":
+        return None
+
+    opclass = METRICS[cfg["metric"]][0]
+    if cfg["type"] == "hnsw":
+        params = f"m = {cfg['m']}, ef_construction = {cfg['ef_construction']}"
+    else:
+        params = f"lists = {cfg['lists']}"
+
+    keyword = "CONCURRENTLY " if concurrently else ""
+    return (
+        f"CREATE INDEX {keyword}IF NOT EXISTS {index_name} "
+        f"ON documents USING {cfg['type']} (embedding {opclass}) WITH ({params})"
+    )
+
+
+def get_index_definition(conn):
+    row = conn.execute(
+        text("SELECT indexdef FROM pg_indexes WHERE tablename = 'documents' AND indexname = :name"),
+        {"name": INDEX_NAME}
+    ).fetchone()
+    return row[0] if row else None
+
+
+def index_matches_config(indexdef: str) -> bool:
+    cfg = get_index_config()
+    if cfg["type"] == "none":
+        return indexdef is None
+    if not indexdef:
+        return False
+
+    opclass = METRICS[cfg["metric"]][0]
+    indexdef = indexdef.lower()
+    if f"using {cfg['type']} " not in indexdef or opclass not in indexdef:
+        return False
+
+    if cfg["type"] == "hnsw":
+        expected = [f"m='{cfg['m']}'", f"ef_construction='{cfg['ef_construction']}'"]
+    else:
+        expected = [f"lists='{cfg['lists']}'"]
+    return all(p in indexdef for p in expected)
+
+
+def _set_build_options(conn):
+    cfg = get_index_config()
+    if cfg["maintenance_work_mem"]:
+        # SET does not accept bind parameters
+        mem = str(cfg["maintenance_work_mem"]).replace("'", "")
+        conn.execute(text(f"SET maintenance_work_mem = '{mem}'"))
+
+
+def rebuild_vector_index(only_if_mismatch: bool = False) -> bool:
+    """
+    Build a fresh index under a temporary name without blocking reads/writes,
+    then swap it in. Used when the configured type/metric/params change.
+    Returns False when another process is already building (advisory lock).
+    """
+    cfg = get_index_config()
+    tmp_name = f"{INDEX_NAME}_new"
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block (lock conn is AUTOCOMMIT)
+    with advisory_lock(BUILD_LOCK) as conn:
+        if conn is None:
+            print("Vector index build already running in another process, skipping")
+            return False
+        if only_if_mismatch and index_matches_config(get_index_definition(conn)):
+            # Another process finished the build before we got the lock
+            return True
+
+        # Only a leftover from a crashed build can exist here: nobody else holds the lock
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}"))
+        if cfg["type"] == "none":
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}"))
+            print("Vector index dropped (rag.vector_index.type = none)")
+            return True
+
+        _set_build_options(conn)
+        print(f"Building {cfg['type']} index ({cfg['metric']}) on documents.embedding, this may take a while...")
+        conn.execute(text(build_index_sql(tmp_name, concurrently=True)))
+
+        # Swap while still holding the lock
+        with engine.begin() as swap_conn:
+            swap_conn.execute(text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+            swap_conn.execute(text(f"ALTER INDEX {tmp_name} RENAME TO {INDEX_NAME}"))
+    print(f"✅ Vector index {INDEX_NAME} rebuilt")
+    return True
+
+
+def ensure_vector_index():
+    """
+    Called on startup: if the index is missing or no longer matches config, build it
+    in a background thread (the API serves meanwhile, searches fall back to a scan).
+    Returns the thread, or None when nothing needs to be built.
+    """
+    with engine.connect() as conn:
+        indexdef = get_index_definition(conn)
+
+    if index_matches_config(indexdef):
+        return None
+
+    def run():
+        try:
+            rebuild_vector_index(only_if_mismatch=True)
+        except Exception as e:
+            print(f"⚠️ Vector index build failed (retrieval falls back to sequential scan): {e}")
+
+    print("Vector index missing or out of date with rag.vector_index, building in the background")
+    thread = threading.Thread(target=run, name="vector-index-build", daemon=True)
+    thread.start()
+    return thread
+
+
+ITERATIVE_SCAN_MODES = {
+    "hnsw": ("off", "relaxed_order", "strict_order"),
+    "ivfflat": ("off", "relaxed_order"),
+}
+
+
+def search_param_statements(filtered: bool = False, limit: int = 0) -> list:
+    """
+    Per-query ANN search parameters as SET LOCAL statements. SET LOCAL only lasts
+    for the current transaction, so pooled connections are not affected.
+
+    filtered: the query has a WHERE clause (e.g. kb_type). Iterative index scans
+    keep scanning until LIMIT rows pass the filter instead of returning too few.
+    limit: rows the query asks for; an HNSW scan returns at most ef_search rows,
+    so ef_search is raised to the limit when it is smaller.
+    """
+    cfg = get_index_config()
+    index_type = cfg["type"]
+    if index_type == "hnsw":
+        statements = [f"SET LOCAL hnsw.ef_search = {max(cfg['ef_search'], int(limit))}"]
+    elif index_type == "ivfflat":
+        statements = [f"SET LOCAL ivfflat.probes = {cfg['probes']}"]
+    else:
+        return []
+
+    if filtered and cfg["iterative_scan"] in ITERATIVE_SCAN_MODES[index_type]:
+        statements.append(f"SET LOCAL {index_type}.iterative_scan = {cfg['iterative_scan']}")
+    return statements
+
+
+def apply_search_params(conn, filtered: bool = False, limit: int = 0):
+    for statement in search_param_statements(filtered, limit):
+        conn.execute(text(statement))
+
+
+async def aapply_search_params(conn, filtered: bool = False, limit: int = 0):
+    # Same as apply_search_params on an AsyncConnection (db.get_async_engine)
+    for statement in search_param_statements(filtered, limit):
+        await conn.execute(text(statement))
+
+
+def get_index_status() -> dict:
+    with engine.connect() as conn:
+        indexdef = get_index_definition(conn)
+        size = None
+        if indexdef:
+            size = conn.execute(
+                text("SELECT pg_size_pretty(pg_relation_size(CAST(:name AS regclass)))"),
+                {"name": INDEX_NAME}
+            ).scalar()
+
+    return {
+        "config": get_index_config(),
+        "index": indexdef,
+        "size": size,
+        "matches_config": index_matches_config(indexdef),
+    }
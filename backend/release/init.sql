@@ -19,6 +19,7 @@ CREATE TABLE IF NOT EXISTS chat_logs (
     image_path VARCHAR(512),
     status VARCHAR(20) DEFAULT 'normal',
     sources JSONB,
+    intent VARCHAR(20),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -27,8 +28,13 @@ CREATE TABLE IF NOT EXISTS learned_qa (
     id SERIAL PRIMARY KEY,
     question TEXT NOT NULL,
     answer TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- sha256 of the normalized question (see rag/learned_qa.py), filled by the backend
+    question_hash VARCHAR(64),
+    embedding vector(1024),
+    embedding_model VARCHAR(200)
 );
+CREATE UNIQUE INDEX IF NOT EXISTS learned_qa_question_hash_idx ON learned_qa (question_hash);
 
 -- 5. Create question_history table
 CREATE TABLE IF NOT EXISTS question_history (
@@ -54,11 +60,28 @@ CREATE TABLE IF NOT EXISTS documents (
     id SERIAL PRIMARY KEY,
     content TEXT,
     metadata JSONB,
-    embedding vector(1024)
+    embedding vector(1024),
+    -- Typed copies of hot metadata keys (filtered/indexed by the backend)
+    kb_type VARCHAR(20),
+    source TEXT,
+    filename VARCHAR(255),
+    doc_type VARCHAR(50),
+    upload_time TIMESTAMP,
+    -- Keyword channel for hybrid retrieval (tokens are built by the backend, see rag/lexical.py)
+    content_tsv tsvector,
+    -- Position of the chunk within its document
+    chunk_index INTEGER
 );
 
+CREATE INDEX IF NOT EXISTS documents_kb_type_idx ON documents (kb_type);
+CREATE INDEX IF NOT EXISTS documents_source_idx ON documents (source);
+CREATE INDEX IF NOT EXISTS documents_filename_idx ON documents (filename) WHERE filename IS NOT NULL;
+CREATE INDEX IF NOT EXISTS documents_content_tsv_idx ON documents USING gin (content_tsv);
+
 -- 8. Create index for faster vector search (optional but recommended)
--- CREATE INDEX ON documents USING ivfflat (embedding vector_l2_ops) WITH (lists = 100);
+-- The backend creates/rebuilds this index on startup according to rag.vector_index in config.yaml.
+-- The operator class must match the configured metric (l2 -> vector_l2_ops, cosine -> vector_cosine_ops, ip -> vector_ip_ops).
+-- CREATE INDEX IF NOT EXISTS documents_embedding_idx ON documents USING hnsw (embedding vector_l2_ops) WITH (m = 16, ef_construction = 64);
 
 -- 9. Insert default admin user (password: admin123)
 -- Hash generated using bcrypt
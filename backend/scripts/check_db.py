@@ -14,7 +14,7 @@ def check_db_for_file():
     
     with engine.connect() as conn:
         result = conn.execute(
-            text("SELECT count(*), content FROM documents WHERE metadata->>'filename' = :filename GROUP BY content LIMIT 1"),
+            text("SELECT count(*), content FROM documents WHERE filename = :filename GROUP BY content LIMIT 1"),
             {"filename": filename}
         ).fetchall()
         